@@ -0,0 +1,329 @@
+"""
+Stage by stage benchmark of the D-Nikud pipeline on a synthetic corpus.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pipeline --num_chars 200000 --batch_sizes 8 32 --max_lengths 256 1024 \
+        --output bench_results.json [--baseline previous_results.json]
+
+Every stage reports chars/sec, p50/p99 latency (per repetition for the text stages, per batch for the model
+stages) and the peak RSS of the process so far, which only grows from stage to stage. The text stages also report the
+peak of the Python and numpy memory they allocate, traced in one more untimed run.
+"""
+# general
+import argparse
+import contextlib
+import io
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# ML
+import numpy as np
+import torch
+from transformers import AutoTokenizer
+
+# DL
+from benchmarks.synthetic_corpus import write_corpus
+from src.checkpoints import load_model_weights
+from src.models import DNikudModel, ModelConfig, apply_heads, build_model, run_lstms, trim_batch
+from src.models_utils import predict
+from src.running_params import MAX_LENGTH_SEN
+from src.utiles_data import NikudDataset, Nikud, extract_text_to_compare_nakdimon, iter_lines, iter_segments, \
+    prepare_inference_sentences, prepare_sentences
+
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def traced_peak_mb(func):
+    """Peak of the memory func allocates through Python and numpy (not torch), over the memory already in use."""
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / (1024 * 1024)
+
+
+def synchronize(device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+
+def summarize(latencies, num_chars):
+    latencies = np.array(latencies)
+    total = float(latencies.sum())
+    return {
+        'runs': len(latencies),
+        'total_sec': total,
+        'p50_sec': float(np.percentile(latencies, 50)),
+        'p99_sec': float(np.percentile(latencies, 99)),
+        'chars_per_sec': num_chars / total if total > 0 else None,
+        # cumulative: the peak of the whole process up to the end of this stage
+        'process_peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def time_repeated(func, repeats):
+    latencies = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        latencies.append(time.perf_counter() - start)
+    return latencies, result
+
+
+def bench_text_stage(func, repeats, num_chars):
+    latencies, result = time_repeated(func, repeats)
+    stats = summarize(latencies, num_chars * repeats)
+    stats['peak_traced_mb'] = traced_peak_mb(func)
+    return stats, result
+
+
+@contextlib.contextmanager
+def quiet():
+    # read_data and back_2_text print and draw progress bars
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def bench_text_stages(corpus_path, tokenizer, repeats):
+    with open(corpus_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    num_chars = len(text)
+    results = {}
+
+    results['combine_sentences'], _ = bench_text_stage(
+        lambda: list(iter_segments(iter_lines(text), max_length=MAX_LENGTH_SEN)), repeats, num_chars)
+
+    dataset = NikudDataset(tokenizer, max_length=MAX_LENGTH_SEN)
+    with quiet():
+        results['read_data'], (dataset.data, dataset.origin_data) = bench_text_stage(
+            lambda: dataset.read_data(corpus_path), repeats, num_chars)
+
+    with quiet():
+        results['prepare_data'], dataset.prepered_data = bench_text_stage(
+            lambda: prepare_sentences(tokenizer, dataset.data, MAX_LENGTH_SEN), repeats, num_chars)
+    results['prepare_data']['prepared_bytes'] = int(dataset.prepered_data.nbytes)
+
+    inference_dataset = NikudDataset(tokenizer, max_length=MAX_LENGTH_SEN)
+    results['read_inference_text'], _ = bench_text_stage(lambda: inference_dataset.read_inference_text(text),
+                                                         repeats, num_chars)
+
+    with quiet():
+        results['prepare_inference_data'], inference_dataset.prepered_data = bench_text_stage(
+            lambda: prepare_inference_sentences(tokenizer, [sentence for sentence, _ in inference_dataset.data],
+                                                inference_dataset.origin_data, MAX_LENGTH_SEN), repeats, num_chars)
+    results['prepare_inference_data']['prepared_bytes'] = int(inference_dataset.prepered_data.nbytes)
+
+    # the gold labels stand in for predictions, rebuilding the text costs the same
+    labels = dataset.prepered_data[:][2].numpy()
+    with quiet():
+        results['back_2_text'], text_with_labels = bench_text_stage(lambda: dataset.back_2_text(labels=labels),
+                                                                    repeats, num_chars)
+
+    results['extract_text_to_compare_nakdimon'], _ = bench_text_stage(
+        lambda: extract_text_to_compare_nakdimon(text_with_labels), repeats, len(text_with_labels))
+
+    return results, dataset
+
+
+def timed(loader, latencies):
+    """Yields the batches of loader, recording how long the consumer spends on each one."""
+    for batch in loader:
+        start = time.perf_counter()
+        yield batch
+        latencies.append(time.perf_counter() - start)
+
+
+def bench_model_stages(model, tokenizer, dataset, batch_size, max_length, max_batches, device):
+    with quiet():
+        prepared = prepare_sentences(tokenizer, dataset.data, max_length)
+    rows = min(len(prepared), max_batches * batch_size)
+    batches = [list(range(start, min(start + batch_size, rows))) for start in range(0, rows, batch_size)]
+    # special tokens are not characters
+    num_chars = int((prepared.lengths[:rows] - 2).clip(min=0).sum())
+
+    encoder_latencies = []
+    lstm_latencies = []
+    model.eval()
+    # a distilled student has no encoder to time apart
+    split_batches = prepared.loader(batch_size, batch_sampler=batches) if isinstance(model, DNikudModel) else []
+    with torch.no_grad():
+        for inputs, attention_mask, _ in split_batches:
+            inputs = inputs.to(device)
+            attention_mask = attention_mask.to(device)
+
+            synchronize(device)
+            start = time.perf_counter()
+            last_hidden_state = model.model(inputs, attention_mask=attention_mask).last_hidden_state
+            synchronize(device)
+            encoder_latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            lstm2 = run_lstms([model.lstm1, model.lstm2], last_hidden_state, attention_mask)
+            apply_heads(model, lstm2)
+            synchronize(device)
+            lstm_latencies.append(time.perf_counter() - start)
+
+    with quiet():
+        inference_prepared = prepare_inference_sentences(tokenizer, [sentence for sentence, _ in dataset.data],
+                                                         dataset.origin_data, max_length)
+    # the same sentences in batches of similar lengths, each run only up to its longest row
+    order = np.argsort(prepared.lengths[:rows], kind='stable')
+    length_batches = [order[start:start + batch_size].tolist() for start in range(0, rows, batch_size)]
+    trimmed_latencies = []
+    max_abs_diff = 0.0
+    trimmed_batches = (prepared.loader(batch_size, batch_sampler=length_batches) if isinstance(model, DNikudModel)
+                       else [])
+    with torch.no_grad():
+        for inputs, attention_mask, _ in trimmed_batches:
+            inputs = inputs.to(device)
+            attention_mask = attention_mask.to(device)
+
+            synchronize(device)
+            start = time.perf_counter()
+            trimmed_inputs, trimmed_attention_mask = trim_batch(inputs, attention_mask)
+            trimmed = model.model(trimmed_inputs, attention_mask=trimmed_attention_mask).last_hidden_state
+            synchronize(device)
+            trimmed_latencies.append(time.perf_counter() - start)
+
+            # the padded execution of the same batch, for its real tokens only
+            padded = model.model(inputs, attention_mask=attention_mask).last_hidden_state[:, :trimmed.shape[1]]
+            real = trimmed_attention_mask.bool()
+            max_abs_diff = max(max_abs_diff, float((padded[real] - trimmed[real]).abs().max()))
+
+    predict_latencies = {}
+    for name, trim_padding in [('predict', True), ('predict_padded', False)]:
+        predict_latencies[name] = []
+        model.trim_padding = trim_padding
+        predict(model, timed(inference_prepared.loader(batch_size, batch_sampler=batches), predict_latencies[name]),
+                device)
+    model.trim_padding = True
+
+    results = {
+        'batch_size': batch_size,
+        'max_length': max_length,
+        'sentences': rows,
+        'predict': summarize(predict_latencies['predict'], num_chars),
+        'predict_padded': summarize(predict_latencies['predict_padded'], num_chars),
+    }
+    if encoder_latencies:
+        results['encoder'] = summarize(encoder_latencies, num_chars)
+        results['encoder_trimmed'] = summarize(trimmed_latencies, num_chars)
+        results['encoder_trimmed']['max_abs_diff'] = max_abs_diff
+        results['lstm_heads'] = summarize(lstm_latencies, num_chars)
+    return results
+
+
+def flatten_results(results):
+    flat = {f'text/{stage}': stats for stage, stats in results['text_stages'].items()}
+    for run in results['model_stages']:
+        for stage in [stage for stage in ['encoder', 'encoder_trimmed', 'lstm_heads', 'predict', 'predict_padded']
+                      if stage in run]:
+            flat[f"model/{stage}/bs{run['batch_size']}/len{run['max_length']}"] = run[stage]
+    return flat
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    baseline_flat = flatten_results(baseline)
+    for key, stats in flatten_results(results).items():
+        if key not in baseline_flat:
+            continue
+        before, after = baseline_flat[key]['p50_sec'], stats['p50_sec']
+        if before > 0 and after > before * (1 + tolerance):
+            regressions.append({'stage': key, 'baseline_p50_sec': before, 'p50_sec': after,
+                                'slowdown': after / before})
+    return regressions
+
+
+def run_benchmarks(model, tokenizer, corpus_path, batch_sizes, max_lengths, repeats, max_batches, device):
+    text_results, dataset = bench_text_stages(corpus_path, tokenizer, repeats)
+    model_results = [bench_model_stages(model, tokenizer, dataset, batch_size, max_length, max_batches, device)
+                     for max_length in max_lengths
+                     for batch_size in batch_sizes]
+    return {'text_stages': text_results, 'model_stages': model_results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description="""Benchmark the D-nikud pipeline""")
+    parser.add_argument('--num_chars', type=int, default=200000, help='size of the synthetic corpus')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic corpus')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 32], help='batch sizes to sweep')
+    parser.add_argument('--max_lengths', type=int, nargs='+', default=[256, MAX_LENGTH_SEN],
+                        help='sequence lengths to sweep')
+    parser.add_argument('--repeats', type=int, default=3, help='repetitions of every text stage')
+    parser.add_argument('--max_batches', type=int, default=10, help='batches per model stage run')
+    parser.add_argument('-ptmp', '--pretrain_model_path', type=str, default=None,
+                        help='model weights, random weights are timed when not given')
+    parser.add_argument('--model_config', type=str, default='models/config.yml', help='model config file')
+    parser.add_argument('--encoder_num_layers', type=int, default=None,
+                        help='time only the first encoder layers (the config value is used when not given)')
+    parser.add_argument('--tokenizer', type=str, default='tau/tavbert-he', help='tokenizer name or local path')
+    parser.add_argument('--output', type=str, default='bench_results.json', help='results json file')
+    parser.add_argument('--baseline', type=str, default=None, help='previous results json to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative p50 slowdown against the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    config = ModelConfig.load_from_file(args.model_config)
+    if args.encoder_num_layers is not None:
+        config.encoder_num_layers = args.encoder_num_layers
+    model = build_model(config, len(Nikud.label_2_id["nikud"]), len(Nikud.label_2_id["dagesh"]),
+                        len(Nikud.label_2_id["sin"]), device=DEVICE).to(DEVICE)
+    if args.pretrain_model_path is not None:
+        load_model_weights(model, args.pretrain_model_path, map_location=DEVICE)
+
+    with tempfile.TemporaryDirectory() as corpus_folder:
+        corpus_path = write_corpus(corpus_folder, args.num_chars, seed=args.seed)
+        results = run_benchmarks(model, tokenizer, corpus_path, args.batch_sizes, args.max_lengths, args.repeats,
+                                 args.max_batches, DEVICE)
+
+    results['meta'] = {
+        'date': datetime.now().isoformat(),
+        'device': DEVICE,
+        'torch': torch.__version__,
+        'python': platform.python_version(),
+        'num_threads': torch.get_num_threads(),
+        'num_chars': args.num_chars,
+        'seed': args.seed,
+        'pretrain_model_path': args.pretrain_model_path,
+        'encoder_num_layers': getattr(config, 'encoder_num_layers', None) or config.num_hidden_layers,
+    }
+
+    exit_code = 0
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        results['regressions'] = find_regressions(results, baseline, args.tolerance)
+        for regression in results['regressions']:
+            print(f"REGRESSION {regression['stage']}: p50 {regression['baseline_p50_sec']:.4f}s -> "
+                  f"{regression['p50_sec']:.4f}s (x{regression['slowdown']:.2f})")
+        exit_code = 1 if results['regressions'] else 0
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    for key, stats in flatten_results(results).items():
+        traced = f"  stage peak {stats['peak_traced_mb']:.0f}MB" if 'peak_traced_mb' in stats else ''
+        print(f"{key:45s} p50 {stats['p50_sec']:.4f}s  p99 {stats['p99_sec']:.4f}s  "
+              f"{stats['chars_per_sec'] or 0:,.0f} chars/sec  process peak RSS so far "
+              f"{stats['process_peak_rss_mb']:.0f}MB{traced}")
+
+    sys.exit(exit_code)
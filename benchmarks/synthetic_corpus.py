@@ -0,0 +1,69 @@
+# general
+import os
+import random
+
+from src.utiles_data import Letter, Letters, Nikud
+
+PUNCTUATION = [".", ",", "?", "!", ":"]
+
+
+def generate_word(rnd, min_letters=2, max_letters=7, with_nikud=True):
+    letter = Letter("")
+    word = ""
+    for _ in range(rnd.randint(min_letters, max_letters)):
+        c = rnd.choice(Letters.hebrew)
+        word += c
+        if not with_nikud:
+            continue
+        if letter.can_dagesh(c) and rnd.random() < 0.3:
+            word += chr(Nikud.DAGESH_LETTER)
+        if letter.can_sin(c):
+            word += chr(rnd.choice(Nikud.sin[1:]))
+        if letter.can_nikud(c) and rnd.random() < 0.8:
+            word += chr(
+                rnd.choice(
+                    [
+                        Nikud.nikud_dict[name]
+                        for name in [
+                            "SHVA",
+                            "HIRIK",
+                            "TZEIRE",
+                            "SEGOL",
+                            "PATAKH",
+                            "KAMATZ",
+                            "HOLAM",
+                            "KUBUTZ",
+                        ]
+                    ]
+                )
+            )
+    return word
+
+
+def generate_text(num_chars, seed=0, with_nikud=True, mean_line_words=12):
+    """
+    Generates diacritized (or plain) Hebrew-like text of about num_chars characters.
+
+    Letters and marks are drawn at random under the same constraints Letter applies,
+    so every generated letter parses into valid labels.
+    """
+    rnd = random.Random(seed)
+    lines = []
+    size = 0
+    while size < num_chars:
+        words = [
+            generate_word(rnd, with_nikud=with_nikud)
+            for _ in range(max(1, int(rnd.expovariate(1 / mean_line_words))))
+        ]
+        line = " ".join(words) + rnd.choice(PUNCTUATION) + "\n"
+        lines.append(line)
+        size += len(line)
+    return "".join(lines)
+
+
+def write_corpus(folder, num_chars, seed=0, with_nikud=True, file_name="corpus.txt"):
+    os.makedirs(folder, exist_ok=True)
+    file_path = os.path.join(folder, file_name)
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(generate_text(num_chars, seed=seed, with_nikud=with_nikud))
+    return file_path
@@ -1,12 +1,16 @@
 from typing import Dict, List, Any
 from transformers import AutoConfig, AutoTokenizer
-from src.models import DNikudModel, ModelConfig
-from src.running_params import BATCH_SIZE, MAX_LENGTH_SEN
-from src.utiles_data import Nikud, NikudDataset
-from src.models_utils import predict_single, predict
+from src.checkpoints import load_model_weights
+from src.diacritizer import Diacritizer
+from src.lexicon import Lexicon
+from src.instrumentation import Instrumentation, get_instrumentation, set_instrumentation
+from src.models import ModelConfig, build_model
+from src.running_params import MAX_LENGTH_SEN
+from src.utiles_data import Nikud, prepare_sentences
 import torch
 import os
-from tqdm import tqdm
+import threading
+from collections import OrderedDict
 
 
 class EndpointHandler:
@@ -14,19 +18,69 @@ class EndpointHandler:
         self.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
         self.tokenizer = AutoTokenizer.from_pretrained("tau/tavbert-he")
-        dir_model_config = os.path.join("models", "config.yml")
+        # DNIKUD_MODEL_CONFIG / DNIKUD_MODEL_PATH select other weights, e.g. a distilled student
+        dir_model_config = os.environ.get(
+            "DNIKUD_MODEL_CONFIG", os.path.join("models", "config.yml")
+        )
+        model_path = os.environ.get(
+            "DNIKUD_MODEL_PATH", "./models/Dnikud_best_model.pth"
+        )
         self.config = ModelConfig.load_from_file(dir_model_config)
-        self.model = DNikudModel(
-            self.config,
+        self.model = self.load_model(self.config, model_path)
+        self.max_length = MAX_LENGTH_SEN
+
+        # DNIKUD_CASCADE_MODEL_CONFIG / DNIKUD_CASCADE_MODEL_PATH / DNIKUD_CASCADE_THRESHOLD
+        # add a cheap model predicting first, see main.py calibrate_cascade
+        self.cascade_model = None
+        self.cascade_threshold = None
+        cascade_model_path = os.environ.get("DNIKUD_CASCADE_MODEL_PATH")
+        if cascade_model_path is not None:
+            self.cascade_model = self.load_model(
+                ModelConfig.load_from_file(os.environ["DNIKUD_CASCADE_MODEL_CONFIG"]),
+                cascade_model_path,
+            )
+            self.cascade_threshold = float(os.environ["DNIKUD_CASCADE_THRESHOLD"])
+
+        # DNIKUD_LEXICON: sentences whose words all have one known vocalization skip the model
+        lexicon_folder = os.environ.get("DNIKUD_LEXICON")
+        self.lexicon = Lexicon.load(lexicon_folder) if lexicon_folder else None
+        self.lexicon_min_count = int(os.environ.get("DNIKUD_LEXICON_MIN_COUNT", "1"))
+
+        # DNIKUD_METRICS_JSONL / DNIKUD_METRICS_PORT turn the instrumentation on
+        metrics_jsonl = os.environ.get("DNIKUD_METRICS_JSONL")
+        metrics_port = os.environ.get("DNIKUD_METRICS_PORT")
+        if metrics_jsonl is not None or metrics_port is not None:
+            set_instrumentation(
+                Instrumentation(
+                    jsonl_path=metrics_jsonl,
+                    prometheus_port=int(metrics_port) if metrics_port else None,
+                )
+            )
+        self.instrumentation = get_instrumentation()
+        self.diacritizer = Diacritizer(
+            self.model,
+            self.tokenizer,
+            self.DEVICE,
+            cascade_model=self.cascade_model,
+            cascade_threshold=self.cascade_threshold,
+            lexicon=self.lexicon,
+            lexicon_min_count=self.lexicon_min_count,
+        )
+
+        # segments of the last version of every document, least recently used first
+        self.documents = OrderedDict()
+        self.documents_lock = threading.Lock()
+        self.max_documents = int(os.environ.get("DNIKUD_MAX_DOCUMENTS", "1000"))
+
+    def load_model(self, config, model_path):
+        model = build_model(
+            config,
             len(Nikud.label_2_id["nikud"]),
             len(Nikud.label_2_id["dagesh"]),
             len(Nikud.label_2_id["sin"]),
             device=self.DEVICE,
         ).to(self.DEVICE)
-        state_dict_model = self.model.state_dict()
-        state_dict_model.update(torch.load("./models/Dnikud_best_model.pth"))
-        self.model.load_state_dict(state_dict_model)
-        self.max_length = MAX_LENGTH_SEN
+        return load_model_weights(model, model_path, map_location=self.DEVICE)
 
     def back_2_text(self, labels, text):
         nikud = Nikud()
@@ -45,68 +99,75 @@ class EndpointHandler:
 
     def prepare_data(self, data, name="train"):
         print("Data = ", data)
-        dataset = []
-        for index, (sentence, label) in tqdm(
-            enumerate(data), desc=f"Prepare data {name}"
-        ):
-            encoded_sequence = self.tokenizer.encode_plus(
-                sentence,
-                add_special_tokens=True,
-                max_length=self.max_length,
-                padding="max_length",
-                truncation=True,
-                return_attention_mask=True,
-                return_tensors="pt",
+        self.prepered_data = prepare_sentences(
+            self.tokenizer, data, self.max_length, name=name
+        )
+
+    def split_text(self, text):
+        """The non empty segments of text, as predict_single_text() predicts them."""
+        return self.diacritizer.split_text(text)
+
+    def predict_single_text(self, text, keep_marks=False):
+        return self.diacritizer.predict_text(text, keep_marks=keep_marks)
+
+    def predict_segments(self, segments, keep_marks=False):
+        """The diacritized text of every non empty segment of split_text()."""
+        return self.diacritizer.predict_segments(segments, keep_marks=keep_marks)
+
+    def predict_document(self, document_id, text, keep_marks=False):
+        """
+        Diacritizes a new version of a document. Only the segments that are not
+        in its previous version are predicted; the others reuse their cached
+        result. An edit can move the merge boundaries of the segments after it
+        up to the next empty line, so the cost follows the edited paragraphs.
+
+        Args:
+            document_id (str): Id of the document, e.g. given by the editor.
+            text (str): The whole new text of the document.
+            keep_marks (bool): Keep the marks already in the text.
+
+        Returns:
+            str: The diacritized text of the document.
+        """
+        with self.instrumentation.span("parse"):
+            segments = self.split_text(text)
+        with self.documents_lock:
+            previous = self.documents.pop(document_id, {})
+        missing = list(
+            dict.fromkeys(
+                segment for segment in segments if (keep_marks, segment) not in previous
             )
-            label_lists = [
-                [letter.nikud, letter.dagesh, letter.sin] for letter in label
-            ]
-            label = torch.tensor(
-                [
-                    [
-                        Nikud.PAD_OR_IRRELEVANT,
-                        Nikud.PAD_OR_IRRELEVANT,
-                        Nikud.PAD_OR_IRRELEVANT,
-                    ]
-                ]
-                + label_lists[: (self.max_length - 1)]
-                + [
-                    [
-                        Nikud.PAD_OR_IRRELEVANT,
-                        Nikud.PAD_OR_IRRELEVANT,
-                        Nikud.PAD_OR_IRRELEVANT,
-                    ]
-                    for i in range(self.max_length - len(label) - 1)
-                ]
+        )
+        predicted = (
+            dict(zip(missing, self.predict_segments(missing, keep_marks=keep_marks)))
+            if missing
+            else {}
+        )
+        # only the segments of the current version are kept
+        current = {
+            (keep_marks, segment): (
+                previous[(keep_marks, segment)]
+                if (keep_marks, segment) in previous
+                else predicted[segment]
             )
+            for segment in segments
+        }
+        with self.documents_lock:
+            self.documents[document_id] = current
+            while len(self.documents) > self.max_documents:
+                self.documents.popitem(last=False)
+        self.instrumentation.count("document_segments", len(segments))
+        self.instrumentation.count("document_segments_predicted", len(missing))
+        return "".join(current[(keep_marks, segment)] for segment in segments)
 
-            dataset.append(
-                (
-                    encoded_sequence["input_ids"][0],
-                    encoded_sequence["attention_mask"][0],
-                    label,
-                )
-            )
+    def forget_document(self, document_id):
+        """Drops the cached segments of a closed document."""
+        with self.documents_lock:
+            self.documents.pop(document_id, None)
 
-        self.prepered_data = dataset
-
-    def predict_single_text(
-        self,
-        text,
-    ):
-        dataset = NikudDataset(tokenizer=self.tokenizer, max_length=MAX_LENGTH_SEN)
-        data, orig_data = dataset.read_single_text(text)
-        print("data", data, len(data))
-        dataset.prepare_data(name="inference")
-        mtb_prediction_dl = torch.utils.data.DataLoader(
-            dataset.prepered_data, batch_size=BATCH_SIZE
-        )
-        # print("dataset", dataset, len(dataset))
-        # data = self.tokenizer(text, return_tensors="pt")
-        all_labels = predict(self.model, mtb_prediction_dl, self.DEVICE)
-        text_data_with_labels = dataset.back_2_text(labels=all_labels)
-        # all_labels = predict_single(self.model, dataset, self.DEVICE)
-        return text_data_with_labels
+    def metrics(self):
+        """Prometheus text of the instrumentation, empty when it is disabled."""
+        return self.instrumentation.prometheus_text()
 
     def __call__(self, data: Dict[str, Any]) -> List[Dict[str, Any]]:
         """
@@ -114,10 +175,16 @@ class EndpointHandler:
         """
 
         # get inputs
+        keep_marks = bool(data.pop("keep_marks", False))
+        document_id = data.pop("document_id", None)
         inputs = data.pop("text", data)
 
+        # a document id re-predicts only what changed since its previous version
+        if document_id is not None:
+            return self.predict_document(document_id, inputs, keep_marks=keep_marks)
+
         # run normal prediction
-        prediction = self.predict_single_text(inputs)
+        prediction = self.predict_single_text(inputs, keep_marks=keep_marks)
 
         # result = []
         # for pred in prediction:
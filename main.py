@@ -1,5 +1,6 @@
 # general
 import argparse
+import json
 import os
 import sys
 from datetime import datetime
@@ -8,18 +9,30 @@ from logging.handlers import RotatingFileHandler
 from pathlib import Path
 
 # ML
+import numpy as np
 import torch
 import torch.nn as nn
 from transformers import AutoConfig, AutoTokenizer
 
 # DL
-from src.models import DNikudModel, ModelConfig
-from src.models_utils import training, evaluate, predict
-from src.plot_helpers import generate_plot_by_nikud_dagesh_sin_dict, \
-    generate_word_and_letter_accuracy_plot
+from src.checkpoints import BEST_FILE, atomic_save, load_model_weights, to_cpu
+from src.corpus_manifest import MANIFEST_FILE, build_manifest, corpus_files, diff_manifest, load_manifest, \
+    save_manifest
+from src.corpus_stats import corpus_stats, histograms
+from src.data_split import SPLITS, load_split, load_split_manifest, split_corpus
+from src.diacritizer import Diacritizer
+from src.lexicon import Lexicon, evaluate_lexicon
+from src.instrumentation import Instrumentation, get_instrumentation, set_instrumentation
+from src.models import DNikudModel, ModelConfig, build_model
+from src.models_utils import training, speed_accuracy_report, sentence_scores_by_length, group_accuracy, \
+    plot_confusion_matrices, calibrate_cascade
+from src.metrics_log import MetricsLogReader
+from src.plot_helpers import plot_metrics_log
 from src.running_params import BATCH_SIZE, MAX_LENGTH_SEN
-from src.utiles_data import NikudDataset, Nikud, create_missing_folders, \
-    extract_text_to_compare_nakdimon
+from src.serving import BatchingServer, serve_stdio, serve_unix_socket
+from src.utiles_data import NikudDataset, Nikud, HardExampleBatchSampler, PackedBatchSampler, create_missing_folders, \
+    plot_label_histograms, array_label_histograms, extract_text_to_compare_nakdimon, \
+    iter_extract_text_to_compare_nakdimon, COMPARE_NAKDIMON_CHUNK_SIZE
 
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
 assert DEVICE == 'cuda'
@@ -56,12 +69,7 @@ def get_logger(log_level, name_func, date_time=datetime.now().strftime('%d_%m_%y
     return logger
 
 
-def evaluate_text(path, dnikud_model, tokenizer_tavbert, logger, plots_folder=None, batch_size=BATCH_SIZE):
-    path_name = os.path.basename(path)
-
-    msg = f"evaluate text: {path_name} on D-nikud Model"
-    logger.debug(msg)
-
+def read_evaluation_data(path, tokenizer_tavbert, logger):
     if os.path.isfile(path):
         dataset = NikudDataset(tokenizer_tavbert, file=path, logger=logger, max_length=MAX_LENGTH_SEN)
     elif os.path.isdir(path):
@@ -70,35 +78,90 @@ def evaluate_text(path, dnikud_model, tokenizer_tavbert, logger, plots_folder=No
         raise Exception("input path doesnt exist")
 
     dataset.prepare_data(name="evaluate")
-    mtb_dl = torch.utils.data.DataLoader(dataset.prepered_data, batch_size=batch_size)
-
-    word_level_correct, letter_level_correct_dev = evaluate(dnikud_model, mtb_dl, plots_folder, device=DEVICE)
+    return dataset
+
+
+def skipped_sub_folder(folder):
+    return "not_use" in folder or "NakdanResults" in folder
+
+
+def folder_groups(input_path, dataset):
+    """
+    Sentence indices of input_path and of every sub folder holding evaluated files, keyed by normalized path. Like the
+    sub folders evaluation always did, the not_use and NakdanResults folders get no group of their own.
+    """
+    input_path = os.path.normpath(input_path)
+    folder_files = {}
+    for file_index, file_path in enumerate(dataset.files):
+        folder = os.path.dirname(os.path.normpath(file_path))
+        while True:
+            if folder == input_path or not skipped_sub_folder(folder):
+                folder_files.setdefault(folder, []).append(file_index)
+            if folder == input_path or os.path.dirname(folder) in (folder, ''):
+                break
+            folder = os.path.dirname(folder)
+    folder_files.setdefault(input_path, list(range(len(dataset.files))))
+    return {folder: np.flatnonzero(np.isin(dataset.sentence_files, file_indices))
+            for folder, file_indices in sorted(folder_files.items())}
+
+
+def evaluate_text(path, dnikud_model, tokenizer_tavbert, logger, plots_folder=None, batch_size=BATCH_SIZE, dataset=None):
+    path_name = os.path.basename(path)
 
-    msg = f"Dnikud Model\n{path_name} evaluate\nLetter level accuracy:{letter_level_correct_dev}\n" \
-          f"Word level accuracy: {word_level_correct}"
+    msg = f"evaluate text: {path_name} on D-nikud Model"
     logger.debug(msg)
 
-
-def predict_text(text_file, tokenizer_tavbert, output_file, logger, dnikud_model, compare_nakdimon=False):
-    dataset = NikudDataset(tokenizer_tavbert, file=text_file, logger=logger, max_length=MAX_LENGTH_SEN)
-
-    dataset.prepare_data(name="prediction")
-    mtb_prediction_dl = torch.utils.data.DataLoader(dataset.prepered_data, batch_size=BATCH_SIZE)
-    all_labels = predict(dnikud_model, mtb_prediction_dl, DEVICE)
-    text_data_with_labels = dataset.back_2_text(labels=all_labels)
-
-    if output_file is None:
-        for line in text_data_with_labels:
-            print(line)
-    else:
-        with open(output_file, "w", encoding='utf-8') as f:
-            if compare_nakdimon:
-                f.write(extract_text_to_compare_nakdimon(text_data_with_labels))
-            else:
-                f.write(text_data_with_labels)
+    if dataset is None:
+        dataset = read_evaluation_data(path, tokenizer_tavbert, logger)
+    # one forward pass gives the accuracy, the confusion matrices and the scores of any group of sentences
+    confusion = {}
+    scores = sentence_scores_by_length(dnikud_model, dataset.prepered_data, batch_size, DEVICE, confusion=confusion)
+    plot_confusion_matrices(confusion["true"], confusion["predicted"], plots_folder)
+    accuracy = group_accuracy(scores, {path: np.arange(len(dataset))})[path]
+
+    msg = f"Dnikud Model\n{path_name} evaluate\nLetter level accuracy:{accuracy['letter_level_correct']}\n" \
+          f"Word level accuracy: {accuracy['word_level_correct']}\n" \
+          f"nikud/dagesh/sin letter level accuracy: {accuracy['nikud_letter_level_correct']}/" \
+          f"{accuracy['dagesh_letter_level_correct']}/{accuracy['sin_letter_level_correct']}"
+    logger.debug(msg)
+    return scores
+
+
+def predict_text(text_file, tokenizer_tavbert, output_file, logger, dnikud_model, compare_nakdimon=False,
+                 cascade_model=None, cascade_threshold=None, lexicon=None, lexicon_min_count=1, keep_marks=False):
+    instrumentation = get_instrumentation()
+    with instrumentation.span("parse"):
+        msg = f'read file: {text_file}'
+        logger.debug(msg)
+        with open(text_file, 'r', encoding='utf-8') as f:
+            text = f.read()
+        dataset = NikudDataset(tokenizer_tavbert, max_length=MAX_LENGTH_SEN)
+        dataset.read_inference_text(text, keep_marks=keep_marks)
+
+    with instrumentation.span("tokenize"):
+        dataset.prepare_inference_data(name="prediction")
+
+    diacritizer = Diacritizer(dnikud_model, tokenizer_tavbert, DEVICE, cascade_model=cascade_model,
+                              cascade_threshold=cascade_threshold, lexicon=lexicon, lexicon_min_count=lexicon_min_count,
+                              logger=logger)
+    all_labels = diacritizer.predict_labels(dataset, keep_marks=keep_marks)
+    with instrumentation.span("decode"):
+        text_data_with_labels = dataset.back_2_text(labels=all_labels)
+
+    with instrumentation.span("write"):
+        if output_file is None:
+            for line in text_data_with_labels:
+                print(line)
+        else:
+            with open(output_file, "w", encoding='utf-8') as f:
+                if compare_nakdimon:
+                    f.write(extract_text_to_compare_nakdimon(text_data_with_labels))
+                else:
+                    f.write(text_data_with_labels)
 
 
-def predict_folder(folder, output_folder, logger, tokenizer_tavbert, dnikud_model, compare_nakdimon=False):
+def predict_folder(folder, output_folder, logger, tokenizer_tavbert, dnikud_model, compare_nakdimon=False,
+                   cascade_model=None, cascade_threshold=None, lexicon=None, lexicon_min_count=1, keep_marks=False):
     create_missing_folders(output_folder)
 
     for filename in os.listdir(folder):
@@ -110,12 +173,16 @@ def predict_folder(folder, output_folder, logger, tokenizer_tavbert, dnikud_mode
                          output_file=output_file,
                          logger=logger,
                          tokenizer_tavbert=tokenizer_tavbert,
-                         dnikud_model=dnikud_model, compare_nakdimon=compare_nakdimon)
+                         dnikud_model=dnikud_model, compare_nakdimon=compare_nakdimon,
+                         cascade_model=cascade_model, cascade_threshold=cascade_threshold,
+                         lexicon=lexicon, lexicon_min_count=lexicon_min_count, keep_marks=keep_marks)
         elif os.path.isdir(file_path) and filename != ".git" and filename != "README.md":
             sub_folder = file_path
             sub_folder_output = os.path.join(output_folder, filename)
             predict_folder(sub_folder, sub_folder_output, logger, tokenizer_tavbert, dnikud_model,
-                           compare_nakdimon=compare_nakdimon)
+                           compare_nakdimon=compare_nakdimon, cascade_model=cascade_model,
+                           cascade_threshold=cascade_threshold, lexicon=lexicon, lexicon_min_count=lexicon_min_count,
+                           keep_marks=keep_marks)
 
 
 def update_compare_folder(folder, output_folder):
@@ -126,10 +193,10 @@ def update_compare_folder(folder, output_folder):
 
         if filename.lower().endswith('.txt') and os.path.isfile(file_path):
             output_file = os.path.join(output_folder, filename)
-            with open(file_path, "r", encoding='utf-8') as f:
-                text_data_with_labels = f.read()
-            with open(output_file, "w", encoding='utf-8') as f:
-                f.write(extract_text_to_compare_nakdimon(text_data_with_labels))
+            with open(file_path, "r", encoding='utf-8') as f_in, open(output_file, "w", encoding='utf-8') as f_out:
+                chunks = iter(lambda: f_in.read(COMPARE_NAKDIMON_CHUNK_SIZE), "")
+                for text_data_with_labels in iter_extract_text_to_compare_nakdimon(chunks):
+                    f_out.write(text_data_with_labels)
         elif os.path.isdir(file_path) and filename != ".git":
             sub_folder = file_path
             sub_folder_output = os.path.join(output_folder, filename)
@@ -149,116 +216,318 @@ def check_files_excepted(folder):
             check_files_excepted(file_path)
 
 
-def do_predict(input_path, output_path, tokenizer_tavbert, logger, dnikud_model, compare_nakdimon):
+def do_predict(input_path, output_path, tokenizer_tavbert, logger, dnikud_model, compare_nakdimon, cascade_model=None,
+               cascade_threshold=None, lexicon_folder=None, lexicon_min_count=1, keep_marks=False):
+    lexicon = Lexicon.load(lexicon_folder) if lexicon_folder is not None else None
     if os.path.isdir(input_path):
         predict_folder(input_path, output_path, logger, tokenizer_tavbert, dnikud_model,
-                       compare_nakdimon=compare_nakdimon)
+                       compare_nakdimon=compare_nakdimon, cascade_model=cascade_model,
+                       cascade_threshold=cascade_threshold, lexicon=lexicon, lexicon_min_count=lexicon_min_count,
+                       keep_marks=keep_marks)
     elif os.path.isfile(input_path):
         predict_text(input_path,
                      output_file=output_path,
                      logger=logger,
                      tokenizer_tavbert=tokenizer_tavbert,
-                     dnikud_model=dnikud_model, compare_nakdimon=compare_nakdimon)
+                     dnikud_model=dnikud_model, compare_nakdimon=compare_nakdimon,
+                     cascade_model=cascade_model, cascade_threshold=cascade_threshold,
+                     lexicon=lexicon, lexicon_min_count=lexicon_min_count, keep_marks=keep_marks)
     else:
         raise Exception("Input file not exist")
 
+    instrumentation = get_instrumentation()
+    if cascade_model is not None and instrumentation.enabled:
+        msg = f'cascade escalation rate: {instrumentation.snapshot()["counters"].get("escalation_rate")}'
+        logger.info(msg)
+    if lexicon is not None and instrumentation.enabled:
+        counters = instrumentation.snapshot()["counters"]
+        msg = f'lexicon hit rate: {counters.get("lexicon_hit_rate")}, ' \
+              f'sentences skipping the model: {counters.get("lexicon_skip_rate")}'
+        logger.info(msg)
+    if keep_marks and instrumentation.enabled:
+        msg = f'already vocalized sentences: {instrumentation.snapshot()["counters"].get("keep_marks_skip_rate")}'
+        logger.info(msg)
+
+
+def log_folders_accuracy(folders_accuracy, logger):
+    for folder, accuracy in folders_accuracy.items():
+        msg = f'evaluate sub folder: {folder}\n' \
+              f'Letter level accuracy:{accuracy["letter_level_correct"]}\n' \
+              f'Word level accuracy: {accuracy["word_level_correct"]}'
+        logger.info(msg)
+
+
+def do_evaluate(input_path, logger, dnikud_model, tokenizer_tavbert, plots_folder, eval_sub_folders=False,
+                lexicon_folder=None, lexicon_min_count=1):
+    msg = f'evaluate all_data: {input_path}'
+    logger.info(msg)
 
-def evaluate_folder(folder_path, logger, dnikud_model, tokenizer_tavbert, plots_folder):
-    msg = f'evaluate sub folder: {folder_path}'
+    dataset = read_evaluation_data(input_path, tokenizer_tavbert, logger)
+    scores = evaluate_text(input_path,
+                           dnikud_model=dnikud_model,
+                           tokenizer_tavbert=tokenizer_tavbert,
+                           logger=logger,
+                           plots_folder=plots_folder,
+                           batch_size=BATCH_SIZE,
+                           dataset=dataset)
+
+    msg = f'\n\n~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n\n'
     logger.info(msg)
 
-    evaluate_text(folder_path,
-                  dnikud_model=dnikud_model,
-                  tokenizer_tavbert=tokenizer_tavbert,
-                  logger=logger,
-                  plots_folder=plots_folder,
-                  batch_size=BATCH_SIZE)
+    if eval_sub_folders and os.path.isdir(input_path):
+        # the sub folders are scored from the sentences already read, tagged by their file
+        groups = folder_groups(input_path, dataset)
+        del groups[os.path.normpath(input_path)]
+        log_folders_accuracy(group_accuracy(scores, groups), logger)
+
+    if lexicon_folder is not None:
+        lexicon_accuracy = evaluate_lexicon(Lexicon.load(lexicon_folder), dataset.origin_data, dataset.prepered_data,
+                                            scores, min_count=lexicon_min_count)
+        msg = f'lexicon fast path: {lexicon_accuracy}'
+        logger.info(msg)
+
+
+def checkpoint_files(checkpoints):
+    files = []
+    for checkpoint in checkpoints:
+        if os.path.isdir(checkpoint):
+            files.extend(sorted(os.path.join(checkpoint, name) for name in os.listdir(checkpoint)
+                                if name.endswith('.pth')))
+        else:
+            files.append(checkpoint)
+    return files
+
+
+def do_evaluate_checkpoints(input_path, checkpoints, logger, dnikud_model, tokenizer_tavbert, output_file,
+                            eval_sub_folders=False, batch_size=BATCH_SIZE):
+    files = checkpoint_files(checkpoints)
+    if not files:
+        raise Exception(f"no checkpoint (.pth) files in: {' '.join(checkpoints)}")
+
+    # parsed and tokenized once for all the checkpoints, the batches are built again for each one
+    dataset = read_evaluation_data(input_path, tokenizer_tavbert, logger)
+    input_path = os.path.normpath(input_path)
+    if eval_sub_folders and os.path.isdir(input_path):
+        groups = folder_groups(input_path, dataset)
+    else:
+        groups = {input_path: np.arange(len(dataset))}
+
+    results = {}
+    for checkpoint in files:
+        msg = f'evaluate checkpoint: {checkpoint}'
+        logger.info(msg)
+
+        load_weights(dnikud_model, checkpoint)
+        scores = sentence_scores_by_length(dnikud_model, dataset.prepered_data, batch_size, DEVICE)
+        results[checkpoint] = group_accuracy(scores, groups)
+        log_folders_accuracy(results[checkpoint], logger)
 
-    msg = f'\n***************************************\n'
+    best_checkpoint = max(results, key=lambda checkpoint: results[checkpoint][input_path]['letter_level_correct'] or 0)
+    msg = f'best checkpoint: {best_checkpoint}'
     logger.info(msg)
 
-    for sub_folder_name in os.listdir(folder_path):
-        sub_folder_path = os.path.join(folder_path, sub_folder_name)
+    with open(output_file, 'w') as f:
+        json.dump({'input_path': input_path, 'best_checkpoint': best_checkpoint, 'checkpoints': results}, f, indent=4)
 
-        if (not os.path.isdir(sub_folder_path)
-                or sub_folder_path == ".git"
-                or "not_use" in sub_folder_path
-                or "NakdanResults" in sub_folder_path):
-            continue
 
-        evaluate_folder(sub_folder_path, logger, dnikud_model, tokenizer_tavbert, plots_folder)
+def do_calibrate_cascade(input_path, logger, dnikud_model, cascade_model, tokenizer_tavbert, max_accuracy_loss,
+                         output_file, batch_size=BATCH_SIZE):
+    dataset = read_evaluation_data(input_path, tokenizer_tavbert, logger)
+    calibration = calibrate_cascade(cascade_model, dnikud_model, dataset.prepered_data, max_accuracy_loss, batch_size,
+                                    DEVICE)
+    msg = f'cascade threshold: {calibration["threshold"]}, escalation rate: {calibration["escalation_rate"]}, ' \
+          f'letter accuracy: {calibration["letter_level_correct"]} (cheap model ' \
+          f'{calibration["cheap_letter_level_correct"]}, full model {calibration["full_letter_level_correct"]})'
+    logger.info(msg)
 
+    with open(output_file, 'w') as f:
+        json.dump({'input_path': input_path, **calibration}, f, indent=4)
 
-def do_evaluate(input_path, logger, dnikud_model, tokenizer_tavbert, plots_folder, eval_sub_folders=False):
-    msg = f'evaluate all_data: {input_path}'
+
+def do_build_lexicon(input_path, output_folder, logger):
+    lexicon = Lexicon.build_from_folder(input_path, logger=logger)
+    lexicon.save(output_folder)
+    msg = f'lexicon of {input_path}: {len(lexicon)} words, {int((lexicon.ambiguity == 1).sum())} unambiguous, ' \
+          f'saved to {output_folder}'
     logger.info(msg)
 
-    evaluate_text(input_path,
-                  dnikud_model=dnikud_model,
-                  tokenizer_tavbert=tokenizer_tavbert,
-                  logger=logger,
-                  plots_folder=plots_folder,
-                  batch_size=BATCH_SIZE)
 
-    msg = f'\n\n~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n\n'
+def do_serve(tokenizer_tavbert, logger, dnikud_model, socket_path=None, plain=False, max_batch_requests=32,
+             batch_wait_ms=5.0, cascade_model=None, cascade_threshold=None, lexicon_folder=None, lexicon_min_count=1):
+    lexicon = Lexicon.load(lexicon_folder) if lexicon_folder is not None else None
+    diacritizer = Diacritizer(dnikud_model, tokenizer_tavbert, device=DEVICE, cascade_model=cascade_model,
+                              cascade_threshold=cascade_threshold, lexicon=lexicon,
+                              lexicon_min_count=lexicon_min_count, logger=logger)
+    server = BatchingServer(diacritizer, max_batch_requests=max_batch_requests, batch_wait=batch_wait_ms / 1000,
+                            logger=logger)
+    try:
+        if socket_path is not None:
+            serve_unix_socket(server, socket_path, plain=plain, logger=logger)
+        else:
+            # the responses own stdout, whatever else prints goes to stderr
+            stdout = sys.stdout
+            sys.stdout = sys.stderr
+            msg = 'serving on stdin/stdout'
+            logger.info(msg)
+            serve_stdio(server, sys.stdin, stdout, plain=plain)
+    finally:
+        server.close()
+
+    instrumentation = get_instrumentation()
+    if instrumentation.enabled:
+        counters = instrumentation.snapshot()["counters"]
+        msg = f'served {counters.get("serve_requests")} requests in {counters.get("serve_batches")} batches'
+        logger.info(msg)
+
+
+def do_stats(input_path, logger, plots_folder, cache_file=None, num_workers=None, output_file=None):
+    files = [input_path] if os.path.isfile(input_path) else corpus_files(input_path)
+    total, per_file = corpus_stats(files, cache_path=cache_file, num_workers=num_workers, logger=logger)
+
+    lengths = np.repeat(np.arange(len(total['sentence_lengths'])), total['sentence_lengths'])
+    msg = f'files: {total["files"]}, sentences: {total["sentences"]}, letters: {total["letters"]}, ' \
+          f'hebrew letters: {total["hebrew_letters"]}'
     logger.info(msg)
+    if len(lengths):
+        msg = f'sentence length: mean {lengths.mean():.1f}, median {np.median(lengths):.0f}, ' \
+              f'p95 {np.percentile(lengths, 95):.0f}, max {lengths.max()}'
+        logger.info(msg)
+    for name in ['nikud', 'dagesh', 'sin']:
+        counts = {Nikud.sign_2_name.get(Nikud.id_2_label[name][label_id], 'WITHOUT'): count
+                  for label_id, count in enumerate(total['labels'][name])}
+        msg = f'{name} labels: {counts}, irrelevant letters: {total["irrelevant"][name]}'
+        logger.info(msg)
 
-    if eval_sub_folders:
-        for sub_folder_name in os.listdir(input_path):
-            sub_folder_path = os.path.join(input_path, sub_folder_name)
+    create_missing_folders(plots_folder)
+    plot_label_histograms(histograms(total), plots_folder=plots_folder)
+    if output_file is not None:
+        with open(output_file, 'w') as f:
+            json.dump({'input_path': input_path, 'total': total, 'files': per_file}, f, indent=4)
 
-            if (not os.path.isdir(sub_folder_path)
-                    or sub_folder_path == ".git"
-                    or "not_use" in sub_folder_path
-                    or "NakdanResults" in sub_folder_path):
-                continue
 
-            evaluate_folder(sub_folder_path, logger, dnikud_model, tokenizer_tavbert, plots_folder)
+def do_split(input_path, output_folder, tokenizer_tavbert, logger, ratios, split_by, shard_size, seed,
+             num_workers=None):
+    split_corpus(input_path, output_folder, tokenizer_tavbert, ratios=ratios, split_by=split_by,
+                 shard_size=shard_size, seed=seed, num_workers=num_workers, logger=logger)
 
 
-def do_train(logger, plots_folder, dir_model_config, tokenizer_tavbert, dnikud_model, output_trained_model_dir,
-             data_folder, n_epochs, checkpoints_frequency, learning_rate, batch_size):
-    msg = 'Loading data...'
-    logger.debug(msg)
+def load_model(config, model_path):
+    model = build_model(config, len(Nikud.label_2_id["nikud"]), len(Nikud.label_2_id["dagesh"]),
+                        len(Nikud.label_2_id["sin"]), device=DEVICE).to(DEVICE)
+    return load_weights(model, model_path)
 
-    dataset_train = NikudDataset(tokenizer_tavbert,
-                                 folder=os.path.join(data_folder, "train"),
-                                 logger=logger,
-                                 max_length=MAX_LENGTH_SEN,
-                                 is_train=True)
-    dataset_dev = NikudDataset(tokenizer=tokenizer_tavbert,
-                               folder=os.path.join(data_folder, "dev"),
-                               logger=logger,
-                               max_length=dataset_train.max_length,
-                               is_train=True)
-    dataset_test = NikudDataset(tokenizer=tokenizer_tavbert,
-                                folder=os.path.join(data_folder, "test"),
-                                logger=logger,
-                                max_length=dataset_train.max_length,
-                                is_train=True)
-
-    dataset_train.show_data_labels(plots_folder=plots_folder)
-
-    msg = f'Max length of data: {dataset_train.max_length}'
-    logger.debug(msg)
 
-    msg = f'Num rows in train data: {len(dataset_train.data)}, ' \
-          f'Num rows in dev data: {len(dataset_dev.data)}, ' \
-          f'Num rows in test data: {len(dataset_test.data)}'
-    logger.debug(msg)
+def load_weights(model, model_path):
+    return load_model_weights(model, model_path)
 
-    msg = 'Loading tokenizer and prepare data...'
-    logger.debug(msg)
 
-    dataset_train.prepare_data(name="train")
-    dataset_dev.prepare_data(name="dev")
-    dataset_test.prepare_data(name="test")
+def do_train(logger, plots_folder, dir_model_config, tokenizer_tavbert, dnikud_model, output_trained_model_dir,
+             data_folder, n_epochs, checkpoints_frequency, learning_rate, batch_size, keep_top_n=3, resume_from=None,
+             hard_example_fraction=0.0, curriculum_epochs=0, eval_every_steps=None, dev_subsample=None,
+             early_stopping_patience=None, early_stopping_metric='all_nikud_letter', lr_scheduler=None,
+             lr_scheduler_factor=0.5, lr_scheduler_patience=1, incremental_from=None, replay_ratio=1.0,
+             teacher_model=None, distillation_temperature=2.0, distillation_alpha=0.5, prepared_data_folder=None,
+             pack_sequences=False):
+    msg = 'Loading data...'
+    logger.debug(msg)
 
-    mtb_train_dl = torch.utils.data.DataLoader(dataset_train.prepered_data, batch_size=batch_size)
-    mtb_dev_dl = torch.utils.data.DataLoader(dataset_dev.prepered_data, batch_size=batch_size)
+    if prepared_data_folder is not None:
+        split_manifest = load_split_manifest(prepared_data_folder)
+        prepared_train, prepared_dev, prepared_test = [load_split(prepared_data_folder, split, split_manifest)
+                                                       for split in SPLITS]
+        max_length = split_manifest['max_length']
+        plot_label_histograms(array_label_histograms(prepared_train.labels), plots_folder=plots_folder)
+    else:
+        train_folder = os.path.join(data_folder, "train")
+        train_manifest = build_manifest(train_folder)
+        if incremental_from is None:
+            dataset_train = NikudDataset(tokenizer_tavbert,
+                                         folder=train_folder,
+                                         logger=logger,
+                                         max_length=MAX_LENGTH_SEN,
+                                         is_train=True)
+        else:
+            changed_files, unchanged_files = diff_manifest(load_manifest(incremental_from), train_manifest)
+            msg = f'incremental training: {len(changed_files)} new or changed train files, ' \
+                  f'{len(unchanged_files)} unchanged'
+            logger.info(msg)
+            if not changed_files:
+                msg = 'no new or changed train files since the previous run, nothing to train'
+                logger.info(msg)
+                # the model it starts from stays the best one, so the next --incremental_from finds it here
+                atomic_save(to_cpu(dnikud_model.state_dict()), os.path.join(output_trained_model_dir, BEST_FILE))
+                save_manifest(train_manifest, os.path.join(output_trained_model_dir, MANIFEST_FILE))
+                return
+
+            dataset_train = NikudDataset(tokenizer_tavbert,
+                                         files=[os.path.join(train_folder, file) for file in changed_files],
+                                         logger=logger,
+                                         max_length=MAX_LENGTH_SEN,
+                                         is_train=True)
+            # a replay of the old data keeps the model from forgetting it
+            num_replay = dataset_train.add_replay_data(
+                [os.path.join(train_folder, file) for file in unchanged_files],
+                int(replay_ratio * len(dataset_train.data)), logger)
+            msg = f'incremental training on {len(dataset_train.data) - num_replay} new sentences ' \
+                  f'and {num_replay} replayed sentences'
+            logger.info(msg)
+        save_manifest(train_manifest, os.path.join(output_trained_model_dir, MANIFEST_FILE))
+        dataset_dev = NikudDataset(tokenizer=tokenizer_tavbert,
+                                   folder=os.path.join(data_folder, "dev"),
+                                   logger=logger,
+                                   max_length=dataset_train.max_length,
+                                   is_train=True)
+        dataset_test = NikudDataset(tokenizer=tokenizer_tavbert,
+                                    folder=os.path.join(data_folder, "test"),
+                                    logger=logger,
+                                    max_length=dataset_train.max_length,
+                                    is_train=True)
+
+        dataset_train.show_data_labels(plots_folder=plots_folder)
+
+        msg = f'Max length of data: {dataset_train.max_length}'
+        logger.debug(msg)
+
+        msg = f'Num rows in train data: {len(dataset_train.data)}, ' \
+              f'Num rows in dev data: {len(dataset_dev.data)}, ' \
+              f'Num rows in test data: {len(dataset_test.data)}'
+        logger.debug(msg)
+
+        msg = 'Loading tokenizer and prepare data...'
+        logger.debug(msg)
+
+        dataset_train.prepare_data(name="train")
+        dataset_dev.prepare_data(name="dev")
+        dataset_test.prepare_data(name="test")
+        prepared_train, prepared_dev, prepared_test = (dataset_train.prepered_data, dataset_dev.prepered_data,
+                                                       dataset_test.prepered_data)
+        max_length = dataset_train.max_length
+
+    train_sampler = None
+    train_batches = None
+    if hard_example_fraction > 0 or curriculum_epochs > 0:
+        train_sampler = HardExampleBatchSampler(prepared_train.lengths, batch_size,
+                                                hard_fraction=hard_example_fraction,
+                                                curriculum_epochs=curriculum_epochs)
+        train_batches = train_sampler
+    elif pack_sequences:
+        train_batches = PackedBatchSampler(prepared_train.lengths, prepared_train.max_length, batch_size)
+        msg = f'packed {len(prepared_train)} train sentences into {len(train_batches.windows)} rows, ' \
+              f'{train_batches.fill_ratio:.1%} of their tokens are not padding'
+        logger.info(msg)
+    mtb_train_dl = prepared_train.loader(batch_size=batch_size, batch_sampler=train_batches,
+                                         with_indices=train_sampler is not None)
+    mtb_dev_dl = prepared_dev.loader(batch_size=batch_size)
+    mtb_dev_subsample_dl = None
+    if dev_subsample is not None and dev_subsample < len(prepared_dev):
+        # the same sentences every evaluation, so the evaluations are comparable
+        dev_indices = np.sort(np.random.default_rng(0).choice(len(prepared_dev), size=dev_subsample,
+                                                               replace=False)).tolist()
+        dev_batches = [dev_indices[start:start + batch_size] for start in range(0, len(dev_indices), batch_size)]
+        mtb_dev_subsample_dl = prepared_dev.loader(batch_size=batch_size, batch_sampler=dev_batches)
 
     if not os.path.isfile(dir_model_config):
-        our_model_config = ModelConfig(dataset_train.max_length)
+        our_model_config = ModelConfig(max_length)
         our_model_config.save_to_file(dir_model_config)
 
     optimizer = torch.optim.Adam(dnikud_model.parameters(), lr=learning_rate)
@@ -270,7 +539,14 @@ def do_train(logger, plots_folder, dir_model_config, tokenizer_tavbert, dnikud_m
     criterion_dagesh = nn.CrossEntropyLoss(ignore_index=Nikud.PAD_OR_IRRELEVANT).to(DEVICE)
     criterion_sin = nn.CrossEntropyLoss(ignore_index=Nikud.PAD_OR_IRRELEVANT).to(DEVICE)
 
-    training_params = {"n_epochs": n_epochs, "checkpoints_frequency": checkpoints_frequency}
+    training_params = {"n_epochs": n_epochs, "checkpoints_frequency": checkpoints_frequency, "keep_top_n": keep_top_n,
+                       "resume_from": resume_from, "eval_every_steps": eval_every_steps,
+                       "early_stopping_patience": early_stopping_patience,
+                       "early_stopping_metric": early_stopping_metric, "lr_scheduler": lr_scheduler,
+                       "lr_scheduler_factor": lr_scheduler_factor, "lr_scheduler_patience": lr_scheduler_patience}
+    if teacher_model is not None:
+        training_params["distillation_temperature"] = distillation_temperature
+        training_params["distillation_alpha"] = distillation_alpha
     (best_model_details, best_accuracy, epochs_loss_train_values, steps_loss_train_values, loss_dev_values,
      accuracy_dev_values) = training(
         dnikud_model,
@@ -283,14 +559,26 @@ def do_train(logger, plots_folder, dir_model_config, tokenizer_tavbert, dnikud_m
         logger,
         output_trained_model_dir,
         optimizer,
-        device=DEVICE
+        device=DEVICE,
+        teacher_model=teacher_model,
+        train_sampler=train_sampler,
+        dev_subsample_loader=mtb_dev_subsample_dl
     )
 
-    generate_plot_by_nikud_dagesh_sin_dict(epochs_loss_train_values, "Train epochs loss", "Loss", plots_folder)
-    generate_plot_by_nikud_dagesh_sin_dict(steps_loss_train_values, "Train steps loss", "Loss", plots_folder)
-    generate_plot_by_nikud_dagesh_sin_dict(loss_dev_values, "Dev epochs loss", "Loss", plots_folder)
-    generate_plot_by_nikud_dagesh_sin_dict(accuracy_dev_values, "Dev accuracy", "Accuracy", plots_folder)
-    generate_word_and_letter_accuracy_plot(accuracy_dev_values, "Accuracy", plots_folder)
+    plot_metrics_log(MetricsLogReader(os.path.join(output_trained_model_dir, "metrics.jsonl")), plots_folder)
+
+    if teacher_model is not None:
+        msg = 'comparing the distilled student with its teacher on the test data...'
+        logger.debug(msg)
+
+        load_weights(dnikud_model, os.path.join(output_trained_model_dir, "best_model.pth"))
+        mtb_test_dl = prepared_test.loader(batch_size=batch_size)
+        report = speed_accuracy_report({"teacher": teacher_model, "student": dnikud_model}, mtb_test_dl,
+                                       os.path.join(plots_folder, "distillation"), device=DEVICE)
+        with open(os.path.join(output_trained_model_dir, "distillation_report.json"), "w") as f:
+            json.dump(report, f, indent=4)
+        msg = f'distillation report: {report}'
+        logger.info(msg)
 
     msg = 'Done'
     logger.info(msg)
@@ -304,6 +592,16 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--log', dest='log_level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         default='DEBUG', help='Set the logging level')
     parser.add_argument('-m', '--output_model_dir', type=str, default='models', help='save directory for model')
+    parser.add_argument('--model_config', type=str, default=os.path.join('models', 'config.yml'),
+                        help='config of the model weights given by --pretrain_model_path')
+    parser.add_argument('--metrics_jsonl', type=str, default=None,
+                        help='append timings and counters of the prediction stages to this JSONL file')
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help='serve the metrics in Prometheus text format on this local port')
+    parser.add_argument('--profile_dir', type=str, default=None,
+                        help='capture a torch.profiler trace of some batches into this folder')
+    parser.add_argument('--profile_window', type=int, nargs=2, default=[5, 10], metavar=('START', 'STEPS'),
+                        help='first batch and number of batches to profile')
     subparsers = parser.add_subparsers(help='sub-command help', dest='command', required=True)
 
     parser_predict = subparsers.add_parser('predict', help='diacritize a text files ')
@@ -314,6 +612,22 @@ if __name__ == '__main__':
                                 help='pre-train model path - use only if you want to use trained model weights')
     parser_predict.add_argument('-c', '--compare', dest='compare_nakdimon',
                                 default=False, help='predict text for comparing with Nakdimon')
+    parser_predict.add_argument('--cascade_model_path', type=str, default=None,
+                                help='weights of a cheap model (e.g. a distilled student) predicting first, only the '
+                                     'sentences it is unsure of are predicted again by the -ptmp model')
+    parser_predict.add_argument('--cascade_model_config', type=str, default=None,
+                                help='config of the --cascade_model_path weights')
+    parser_predict.add_argument('--cascade_threshold', type=float, default=None,
+                                help='sentences whose lowest mark probability is below this escalate to the -ptmp '
+                                     'model, see calibrate_cascade')
+    parser_predict.add_argument('--lexicon', dest='lexicon_folder', type=str, default=None,
+                                help='lexicon folder written by build_lexicon: sentences whose words all have one '
+                                     'known vocalization skip the model')
+    parser_predict.add_argument('--lexicon_min_count', type=int, default=1,
+                                help='times a word must have been seen for the lexicon to vocalize it')
+    parser_predict.add_argument('--keep_marks', action='store_true',
+                                help='keep the marks already in the input: fully vocalized sentences skip the model '
+                                     'and in the others only the letters without marks are predicted')
     parser_predict.set_defaults(func=do_predict)
 
     parser_evaluate = subparsers.add_parser('evaluate', help='evaluate D-nikud')
@@ -327,8 +641,96 @@ if __name__ == '__main__':
                                  default=False, help='accuracy calculation includes the evaluation of sub-folders '
                                                      'within the input_path folder, providing independent assessments '
                                                      'for each subfolder.')
+    parser_evaluate.add_argument('--lexicon', dest='lexicon_folder', type=str, default=None,
+                                 help='also report the hit rate and the accuracy of this lexicon fast path')
+    parser_evaluate.add_argument('--lexicon_min_count', type=int, default=1,
+                                 help='times a word must have been seen for the lexicon to vocalize it')
     parser_evaluate.set_defaults(func=do_evaluate)
 
+    parser_evaluate_checkpoints = subparsers.add_parser('evaluate_checkpoints',
+                                                        help='evaluate many checkpoints on the same data')
+    parser_evaluate_checkpoints.add_argument('input_path', help='input file or folder')
+    parser_evaluate_checkpoints.add_argument('checkpoints', nargs='+',
+                                             help='checkpoint files, or folders whose .pth files are evaluated')
+    parser_evaluate_checkpoints.add_argument('-o', '--output_file', default='checkpoints_evaluation.json',
+                                             help='json report of the accuracy of every checkpoint')
+    parser_evaluate_checkpoints.add_argument('-es', '--eval_sub_folders', dest='eval_sub_folders',
+                                             action='store_true',
+                                             help='report the accuracy of every sub folder of input_path as well')
+    parser_evaluate_checkpoints.add_argument('--batch_size', type=int, default=BATCH_SIZE, help='batch_size')
+    parser_evaluate_checkpoints.set_defaults(func=do_evaluate_checkpoints)
+
+    parser_calibrate = subparsers.add_parser('calibrate_cascade',
+                                             help='pick the confidence threshold of a cheap model on the dev data')
+    parser_calibrate.add_argument('input_path', help='labeled dev file or folder')
+    parser_calibrate.add_argument('-ptmp', '--pretrain_model_path', type=str,
+                                  default=os.path.join(Path(__file__).parent, 'models', 'Dnikud_best_model.pth'),
+                                  help='weights of the full model')
+    parser_calibrate.add_argument('--cascade_model_path', type=str, required=True, help='weights of the cheap model')
+    parser_calibrate.add_argument('--cascade_model_config', type=str, required=True,
+                                  help='config of the --cascade_model_path weights')
+    parser_calibrate.add_argument('--max_accuracy_loss', type=float, default=0.002,
+                                  help='letter accuracy the cascade may lose against the full model alone')
+    parser_calibrate.add_argument('-o', '--output_file', default='cascade_calibration.json',
+                                  help='json of the threshold and of the accuracies it gives')
+    parser_calibrate.add_argument('--batch_size', type=int, default=BATCH_SIZE, help='batch_size')
+    parser_calibrate.set_defaults(func=do_calibrate_cascade)
+
+    parser_serve = subparsers.add_parser('serve', help='keep the model loaded and diacritize the requests of clients, '
+                                                       'see serve_client.py')
+    parser_serve.add_argument('-ptmp', '--pretrain_model_path', type=str,
+                              default=os.path.join(Path(__file__).parent, 'models', 'Dnikud_best_model.pth'),
+                              help='pre-train model path - use only if you want to use trained model weights')
+    parser_serve.add_argument('--socket', dest='socket_path', type=str, default=None,
+                              help='listen on this Unix socket, by default the requests are read from stdin')
+    parser_serve.add_argument('--plain', action='store_true',
+                              help='a request is a line of text and a response its diacritized line, instead of JSON')
+    parser_serve.add_argument('--max_batch_requests', type=int, default=32,
+                              help='requests of all the clients predicted together at most')
+    parser_serve.add_argument('--batch_wait_ms', type=float, default=5.0,
+                              help='milliseconds a batch waits for more requests before it is predicted')
+    parser_serve.add_argument('--cascade_model_path', type=str, default=None,
+                              help='weights of a cheap model predicting first, see predict')
+    parser_serve.add_argument('--cascade_model_config', type=str, default=None,
+                              help='config of the --cascade_model_path weights')
+    parser_serve.add_argument('--cascade_threshold', type=float, default=None,
+                              help='confidence under which a sentence escalates to the -ptmp model')
+    parser_serve.add_argument('--lexicon', dest='lexicon_folder', type=str, default=None,
+                              help='lexicon folder written by build_lexicon, see predict')
+    parser_serve.add_argument('--lexicon_min_count', type=int, default=1,
+                              help='times a word must have been seen for the lexicon to vocalize it')
+    parser_serve.set_defaults(func=do_serve)
+
+    parser_lexicon = subparsers.add_parser('build_lexicon', help='vocalization of every word of a corpus')
+    parser_lexicon.add_argument('input_path', help='folder of diacritized text, e.g. data/train')
+    parser_lexicon.add_argument('output_folder', help='folder of the memory mapped lexicon arrays')
+    parser_lexicon.set_defaults(func=do_build_lexicon)
+
+    parser_stats = subparsers.add_parser('stats', help='statistics of the files and labels of a corpus')
+    parser_stats.add_argument('input_path', help='input file or folder')
+    parser_stats.add_argument('--cache_file', default='corpus_stats_cache.json',
+                              help='statistics of every file by its content hash, only new or changed files are read')
+    parser_stats.add_argument('--num_workers', type=int, default=None,
+                              help='processes reading the files, all the CPUs by default')
+    parser_stats.add_argument('-o', '--output_file', default=None,
+                              help='json of the statistics of the corpus and of every file')
+    parser_stats.add_argument('-df', '--plots_folder', dest='plots_folder',
+                              default=os.path.join(Path(__file__).parent, 'plots'), help='set the debug folder')
+    parser_stats.set_defaults(func=do_stats)
+
+    parser_split = subparsers.add_parser('split', help='split a raw corpus into train/dev/test shards')
+    parser_split.add_argument('input_path', help='folder of the raw corpus, e.g. D_Nikud_Data')
+    parser_split.add_argument('output_folder', help='folder of the shards and of split_manifest.json')
+    parser_split.add_argument('--ratios', type=float, nargs=3, default=[0.8, 0.1, 0.1],
+                              metavar=('TRAIN', 'DEV', 'TEST'), help='relative sizes of the splits')
+    parser_split.add_argument('--split_by', choices=['file', 'sentence'], default='file',
+                              help='keep every file in one split, or split every sentence on its own')
+    parser_split.add_argument('--shard_size', type=int, default=4096, help='sentences per shard')
+    parser_split.add_argument('--seed', type=int, default=0, help='seed of the hash assigning the splits')
+    parser_split.add_argument('--num_workers', type=int, default=None,
+                              help='processes reading the files, all the CPUs by default')
+    parser_split.set_defaults(func=do_split)
+
     # train --n_epochs 20
 
     parser_train = subparsers.add_parser('train', help='train D-nikud')
@@ -342,32 +744,128 @@ if __name__ == '__main__':
                               default=os.path.join(Path(__file__).parent, 'data'), help='Set the debug folder')
     parser_train.add_argument('--checkpoints_frequency', type=int, default=1,
                               help='checkpoints frequency for save the model')
+    parser_train.add_argument('--hard_example_fraction', type=float, default=0.0,
+                              help='share of every epoch drawn by recent sentence loss instead of in file order')
+    parser_train.add_argument('--curriculum_epochs', type=int, default=0,
+                              help='number of epochs starting from the short and easy sentences')
+    parser_train.add_argument('--pack_sequences', action='store_true',
+                              help='pack several train sentences into every row, each attending only to itself')
+    parser_train.add_argument('--eval_every_steps', type=int, default=None,
+                              help='evaluate on the dev data every this many training steps instead of every epoch')
+    parser_train.add_argument('--dev_subsample', type=int, default=None,
+                              help='evaluate on this many fixed dev sentences during training, on all of them at the end')
+    parser_train.add_argument('--early_stopping_patience', type=int, default=None,
+                              help='stop after this many dev evaluations without improvement')
+    parser_train.add_argument('--early_stopping_metric', choices=['all_nikud_letter', 'all_nikud_word'],
+                              default='all_nikud_letter', help='dev accuracy watched by early stopping and the scheduler')
+    parser_train.add_argument('--lr_scheduler', choices=['plateau'], default=None,
+                              help='reduce the learning rate when the dev accuracy stops improving')
+    parser_train.add_argument('--lr_scheduler_factor', type=float, default=0.5, help='learning rate reduction factor')
+    parser_train.add_argument('--lr_scheduler_patience', type=int, default=1,
+                              help='dev evaluations without improvement before reducing the learning rate')
+    parser_train.add_argument('--incremental_from', type=str, default=None,
+                              help='output folder (or train_manifest.json) of a previous run: fine-tune only on the '
+                                   'train files added or changed since, starting from its best model unless -ptmp '
+                                   'is given')
+    parser_train.add_argument('--replay_ratio', type=float, default=1.0,
+                              help='old sentences replayed per new sentence in incremental training')
+    parser_train.add_argument('--prepared_data_folder', type=str, default=None,
+                              help='train on the shards written by the split command instead of the text files of '
+                                   '--data_folder')
+    parser_train.add_argument('--keep_top_n', type=int, default=3,
+                              help='number of checkpoints kept, the ones with the best dev accuracy')
+    parser_train.add_argument('--resume_from', type=str, default=None,
+                              help='latest.pth of an earlier run to resume its training, optimizer included')
     parser_train.add_argument('-df', '--plots_folder', dest='plots_folder',
                               default=os.path.join(Path(__file__).parent, 'plots'), help='Set the debug folder')
+    parser_train.add_argument('--encoder_num_layers', type=int, default=None,
+                              help='run only the first layers of the TavBERT encoder and train the heads on them')
+    parser_train.add_argument('--distill_teacher_path', type=str, default=None,
+                              help='train a small student model on the soft labels of these D-nikud weights '
+                                   '(the teacher config is read from --model_config)')
+    parser_train.add_argument('--student_hidden_size', type=int, default=256, help='hidden size of the student')
+    parser_train.add_argument('--student_num_layers', type=int, default=2, help='BiLSTM layers of the student')
+    parser_train.add_argument('--distillation_temperature', type=float, default=2.0,
+                              help='softmax temperature of the soft labels')
+    parser_train.add_argument('--distillation_alpha', type=float, default=0.5,
+                              help='weight of the soft labels loss against the gold labels loss')
     parser_train.set_defaults(func=do_train)
 
     args = parser.parse_args()
+    if args.command == "train" and args.prepared_data_folder is not None and args.incremental_from is not None:
+        parser.error('--incremental_from reads the text files of --data_folder, not --prepared_data_folder')
+    if args.command == "train" and args.incremental_from is not None:
+        if not os.path.exists(args.incremental_from):
+            parser.error(f'--incremental_from not exist: {args.incremental_from}')
+        # a manifest file points at the output folder it was saved in
+        previous_run_folder = args.incremental_from if os.path.isdir(args.incremental_from) \
+            else os.path.dirname(os.path.abspath(args.incremental_from))
+        if args.pretrain_model_path is None:
+            args.pretrain_model_path = os.path.join(previous_run_folder, "best_model.pth")
+            if not os.path.isfile(args.pretrain_model_path):
+                parser.error(f'no best_model.pth next to --incremental_from {args.incremental_from}, give -ptmp')
+    if args.command == "train" and args.pack_sequences and \
+            (args.hard_example_fraction > 0 or args.curriculum_epochs > 0):
+        parser.error('--pack_sequences draws whole rows of sentences, it can\'t follow --hard_example_fraction or '
+                     '--curriculum_epochs')
+    if args.command in ["predict", "serve"] and args.cascade_model_path is not None and \
+            (args.cascade_model_config is None or args.cascade_threshold is None):
+        parser.error('--cascade_model_path needs --cascade_model_config and a --cascade_threshold from '
+                     'calibrate_cascade')
     kwargs = vars(args).copy()
     date_time = datetime.now().strftime('%d_%m_%y__%H_%M')
     logger = get_logger(kwargs['log_level'], args.command, date_time)
 
     del kwargs['log_level']
 
+    if args.metrics_jsonl is not None or args.metrics_port is not None or args.profile_dir is not None:
+        set_instrumentation(Instrumentation(jsonl_path=args.metrics_jsonl,
+                                            prometheus_port=args.metrics_port,
+                                            profile_dir=args.profile_dir,
+                                            profile_window=args.profile_window))
+    for instrumentation_arg in ['metrics_jsonl', 'metrics_port', 'profile_dir', 'profile_window']:
+        del kwargs[instrumentation_arg]
+
     kwargs['tokenizer_tavbert'] = tokenizer_tavbert
     kwargs['logger'] = logger
 
     msg = 'Loading model...'
     logger.debug(msg)
 
-    if args.command in ["evaluate", "predict"] or (args.command == "train" and args.pretrain_model_path is not None):
-        dir_model_config = os.path.join("models", "config.yml")
-        config = ModelConfig.load_from_file(dir_model_config)
-
-        dnikud_model = DNikudModel(config, len(Nikud.label_2_id["nikud"]), len(Nikud.label_2_id["dagesh"]),
+    output_model_config = None
+    if args.command == "train" and args.distill_teacher_path is not None:
+        teacher_config = ModelConfig.load_from_file(args.model_config)
+        kwargs['teacher_model'] = load_model(teacher_config, args.distill_teacher_path)
+        output_model_config = ModelConfig.student_from(teacher_config, hidden_size=args.student_hidden_size,
+                                                       num_layers=args.student_num_layers)
+        dnikud_model = build_model(output_model_config, len(Nikud.label_2_id["nikud"]), len(Nikud.label_2_id["dagesh"]),
                                    len(Nikud.label_2_id["sin"]), device=DEVICE).to(DEVICE)
-        state_dict_model = dnikud_model.state_dict()
-        state_dict_model.update(torch.load(args.pretrain_model_path))
-        dnikud_model.load_state_dict(state_dict_model)
+        if args.pretrain_model_path is not None:
+            load_weights(dnikud_model, args.pretrain_model_path)
+    elif args.command == "train" and args.encoder_num_layers is not None:
+        output_model_config = ModelConfig.load_from_file(args.model_config)
+        output_model_config.encoder_num_layers = args.encoder_num_layers
+        if args.pretrain_model_path is not None:
+            dnikud_model = load_model(output_model_config, args.pretrain_model_path)
+        else:
+            dnikud_model = DNikudModel(output_model_config,
+                                       len(Nikud.label_2_id["nikud"]),
+                                       len(Nikud.label_2_id["dagesh"]),
+                                       len(Nikud.label_2_id["sin"]),
+                                       pretrain_model="tau/tavbert-he",
+                                       device=DEVICE
+                                       ).to(DEVICE)
+    elif args.command in ["stats", "split", "build_lexicon"]:
+        dnikud_model = None
+    elif args.command == "evaluate_checkpoints":
+        # the weights of every checkpoint are loaded in turn
+        config = ModelConfig.load_from_file(args.model_config)
+        dnikud_model = build_model(config, len(Nikud.label_2_id["nikud"]), len(Nikud.label_2_id["dagesh"]),
+                                   len(Nikud.label_2_id["sin"]), device=DEVICE).to(DEVICE)
+    elif args.command in ["evaluate", "predict", "calibrate_cascade", "serve"] or \
+            (args.command == "train" and args.pretrain_model_path is not None):
+        config = ModelConfig.load_from_file(args.model_config)
+        dnikud_model = load_model(config, args.pretrain_model_path)
     else:
         base_model_name = "tau/tavbert-he"
         config = AutoConfig.from_pretrained(base_model_name)
@@ -385,12 +883,35 @@ if __name__ == '__main__':
         dir_model_config = os.path.join(kwargs['output_model_dir'], "config.yml")
         kwargs['dir_model_config'] = dir_model_config
         kwargs['output_trained_model_dir'] = output_trained_model_dir
-    del kwargs['pretrain_model_path']
+        if output_model_config is not None:
+            # a student or a truncated encoder is loaded back with --model_config pointing at this file
+            output_model_config.save_to_file(os.path.join(output_trained_model_dir, "config.yml"))
+        for model_arg in ['encoder_num_layers', 'distill_teacher_path', 'student_hidden_size', 'student_num_layers']:
+            del kwargs[model_arg]
+    kwargs.pop('pretrain_model_path', None)
+    if args.command in ["predict", "calibrate_cascade", "serve"]:
+        kwargs['cascade_model'] = None
+        if args.cascade_model_path is not None:
+            kwargs['cascade_model'] = load_model(ModelConfig.load_from_file(args.cascade_model_config),
+                                                 args.cascade_model_path)
+        del kwargs['cascade_model_path']
+        del kwargs['cascade_model_config']
+    del kwargs['model_config']
     del kwargs['output_model_dir']
     kwargs['dnikud_model'] = dnikud_model
+    if args.command in ["stats", "split", "build_lexicon"]:
+        del kwargs['dnikud_model']
+    if args.command in ["stats", "build_lexicon"]:
+        del kwargs['tokenizer_tavbert']
 
     del kwargs['command']
     del kwargs['func']
     args.func(**kwargs)
 
+    instrumentation = get_instrumentation()
+    if instrumentation.enabled:
+        msg = f'instrumentation: {instrumentation.snapshot()}'
+        logger.info(msg)
+    instrumentation.close()
+
     sys.exit(0)
@@ -0,0 +1,112 @@
+"""
+Thin client of `python main.py serve --socket PATH`: diacritizes files like
+`python main.py predict` does, without loading torch or the model.
+"""
+
+# general
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+
+
+def iter_files(input_path, output_path):
+    """(input file, output file) of a file, or of the .txt files of a folder like predict_folder()."""
+    if os.path.isfile(input_path) or input_path == '-':
+        yield input_path, output_path
+        return
+    for filename in sorted(os.listdir(input_path)):
+        file_path = os.path.join(input_path, filename)
+        if filename.lower().endswith('.txt') and os.path.isfile(file_path):
+            yield file_path, os.path.join(output_path, filename)
+        elif os.path.isdir(file_path) and filename != ".git" and filename != "README.md":
+            yield from iter_files(file_path, os.path.join(output_path, filename))
+
+
+def read_text(path):
+    if path == '-':
+        return sys.stdin.read()
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def write_text(path, text):
+    if path == '-':
+        sys.stdout.write(text)
+        return
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def predict_files(socket_path, files, compare_nakdimon=False, keep_marks=False):
+    """
+    Sends every input file to the server as one request, all of them before the first answer is read, so the server
+    batches them, and writes every answer to the output file of its id.
+
+    Raises the error of a file that could not be read or sent, and a RuntimeError when the server fails on a file or
+    does not answer every file once.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        send_errors = []
+
+        def send():
+            try:
+                with client.makefile('w', encoding='utf-8') as requests:
+                    for index, (input_file, _) in enumerate(files):
+                        request = {'id': index, 'text': read_text(input_file), 'compare_nakdimon': compare_nakdimon,
+                                   'keep_marks': keep_marks}
+                        requests.write(json.dumps(request, ensure_ascii=False) + '\n')
+            except Exception as e:
+                send_errors.append(e)
+            finally:
+                # the server answers what it got and closes, instead of waiting for more
+                try:
+                    client.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+        # output file of every request not answered yet
+        pending = {index: output_file for index, (_, output_file) in enumerate(files)}
+        with client.makefile('r', encoding='utf-8') as responses:
+            for line in responses:
+                response = json.loads(line)
+                index = response.get('id')
+                if 'error' in response:
+                    input_file = files[index][0] if index in pending else 'a request'
+                    raise RuntimeError(f'server failed on {input_file}: {response["error"]}')
+                if index not in pending:
+                    raise RuntimeError(f'unexpected answer of id {index!r} from the server')
+                write_text(pending.pop(index), response['text'])
+        sender.join()
+
+    if send_errors:
+        raise send_errors[0]
+    if pending:
+        missing = [files[index][0] for index in sorted(pending)]
+        raise RuntimeError(f'the server answered {len(files) - len(pending)} of {len(files)} files, not '
+                           f'{", ".join(missing[:3])}{", ..." if len(missing) > 3 else ""}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description="""Predict D-nikud with a running `main.py serve --socket`""")
+    parser.add_argument('input_path', help='input file or folder, - for stdin')
+    parser.add_argument('output_path', help='output file or folder, - for stdout')
+    parser.add_argument('-c', '--compare', dest='compare_nakdimon',
+                        default=False, help='predict text for comparing with Nakdimon')
+    parser.add_argument('--keep_marks', action='store_true', help='keep the marks already in the input')
+    parser.add_argument('--socket', dest='socket_path', default=os.path.join('/tmp', 'dnikud.sock'),
+                        help='Unix socket of the server')
+    args = parser.parse_args()
+
+    if args.input_path != '-' and not os.path.exists(args.input_path):
+        parser.error('Input file not exist')
+    predict_files(args.socket_path, list(iter_files(args.input_path, args.output_path)),
+                  compare_nakdimon=bool(args.compare_nakdimon), keep_marks=args.keep_marks)
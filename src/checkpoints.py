@@ -0,0 +1,284 @@
+# general
+import os
+import queue
+import re
+import threading
+
+# ML
+import numpy as np
+import torch
+
+from src.utiles_data import create_missing_folders
+
+ENCODER_FILE = "encoder.pth"
+LATEST_FILE = "latest.pth"
+BEST_FILE = "best_model.pth"
+ENCODER_LAYER_PATTERN = re.compile(r"^model\.encoder\.layer\.(\d+)\.")
+
+
+def to_cpu(obj):
+    """
+    Copies a (nested) state dict, every tensor to the CPU: the lists, dicts and
+    arrays of the copy can be written in the background while the original
+    keeps changing.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def frozen_prefixes(model):
+    """Prefixes of the top level modules whose parameters are all frozen, e.g. the TavBERT encoder."""
+    prefixes = []
+    for name, module in model.named_children():
+        parameters = list(module.parameters())
+        if parameters and not any(p.requires_grad for p in parameters):
+            prefixes.append(f"{name}.")
+    return tuple(prefixes)
+
+
+def atomic_save(obj, path):
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_model_state_dict(path, map_location=None):
+    """
+    Loads the state dict of a model from a plain state dict file or from a
+    CheckpointManager file, merging the frozen encoder it refers to.
+    """
+    state = torch.load(path, map_location=map_location)
+    if "model_state_dict" not in state:
+        return state
+    model_state = {}
+    if state.get("encoder_file") is not None:
+        encoder_path = os.path.join(os.path.dirname(path), state["encoder_file"])
+        if not os.path.isfile(encoder_path):
+            raise FileNotFoundError(
+                f"{path} holds only the trained weights and its frozen encoder "
+                f"{encoder_path} is missing: copy the encoder to it with the file, "
+                f"or use the self-contained {BEST_FILE} of the training folder"
+            )
+        model_state.update(torch.load(encoder_path, map_location=map_location))
+    model_state.update(state["model_state_dict"])
+    return model_state
+
+
+def dropped_encoder_layer(model, name):
+    """Whether name is a weight of an encoder layer that a truncated encoder dropped."""
+    encoder = getattr(getattr(model, "model", None), "encoder", None)
+    match = ENCODER_LAYER_PATTERN.match(name)
+    return (
+        encoder is not None
+        and match is not None
+        and int(match.group(1)) >= len(encoder.layer)
+    )
+
+
+def load_model_weights(model, path, map_location=None):
+    """
+    Loads the weights of load_model_state_dict() into model.
+
+    The weights of the encoder layers a truncated encoder (encoder_num_layers)
+    dropped are skipped; any other weight model doesn't have fails the load, so
+    the checkpoint of another architecture is not loaded by mistake.
+    """
+    state_dict_model = model.state_dict()
+    state_dict_model.update(
+        {
+            name: weights
+            for name, weights in load_model_state_dict(path, map_location).items()
+            if not dropped_encoder_layer(model, name)
+        }
+    )
+    model.load_state_dict(state_dict_model)
+    return model
+
+
+class CheckpointManager:
+    """
+    Saves training checkpoints without stalling the training loop.
+
+    The weights are copied to the CPU on the calling thread and written by a
+    background thread, each file to a temporary name and then renamed. The
+    frozen encoder is written once; every other file holds only the trainable
+    weights and points at it, until close() merges the encoder into
+    best_model.pth so that it can be copied and loaded on its own. Only the best keep_top_n epoch checkpoints (by
+    dev accuracy) are kept, and latest.pth holds everything needed to resume.
+
+    Args:
+        output_model_path (str): Folder of best_model.pth, latest.pth and encoder.pth.
+        model (torch.nn.Module): Model being trained.
+        keep_top_n (int): Number of epoch checkpoints kept in output_model_path/checkpoints.
+    """
+
+    def __init__(self, output_model_path, model, keep_top_n=3):
+        self.output_model_path = output_model_path
+        self.checkpoints_path = os.path.join(output_model_path, "checkpoints")
+        create_missing_folders(self.checkpoints_path)
+        self.keep_top_n = keep_top_n
+        self.frozen_prefixes = frozen_prefixes(model)
+        self.encoder_written = False
+        self.best_written = False
+        self.checkpoints = []
+
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def _write_loop(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            try:
+                job()
+            except Exception as e:
+                self._error = e
+            self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _encoder_file(self, path):
+        if not self.frozen_prefixes:
+            return None
+        return os.path.relpath(
+            os.path.join(self.output_model_path, ENCODER_FILE), os.path.dirname(path)
+        )
+
+    def snapshot(self, model):
+        """CPU copy of the trainable weights; the frozen encoder is queued for writing the first time."""
+        state_dict = model.state_dict()
+        if self.frozen_prefixes and not self.encoder_written:
+            encoder = to_cpu(
+                {k: v for k, v in state_dict.items() if k.startswith(self.frozen_prefixes)}
+            )
+            encoder_path = os.path.join(self.output_model_path, ENCODER_FILE)
+            self._queue.put(lambda: atomic_save(encoder, encoder_path))
+            self.encoder_written = True
+        return to_cpu(
+            {k: v for k, v in state_dict.items() if not k.startswith(self.frozen_prefixes)}
+        )
+
+    def save(
+        self,
+        epoch,
+        model,
+        optimizer,
+        dev_accuracy,
+        is_best=False,
+        is_checkpoint=False,
+        step=None,
+        resume_state=None,
+    ):
+        """
+        Snapshots the model once and queues the files of this epoch.
+
+        Args:
+            epoch (int): Epoch that just ended.
+            model (torch.nn.Module): Model being trained.
+            optimizer (torch.optim.Optimizer): Its optimizer, saved in latest.pth.
+            dev_accuracy (float): Dev accuracy ranking the epoch checkpoints.
+            is_best (bool): Write best_model.pth.
+            is_checkpoint (bool): Write an epoch checkpoint.
+            step (int, optional): Step of the epoch, for checkpoints saved mid-epoch.
+            resume_state (dict, optional): Extra state stored in latest.pth, copied
+                before save() returns, so the caller may keep changing it.
+
+        Returns:
+            dict: The snapshot, with the epoch and its trainable weights.
+        """
+        self._raise_error()
+        snapshot = {"epoch": epoch, "model_state_dict": self.snapshot(model)}
+
+        if is_best:
+            self._queue_best(snapshot)
+
+        if is_checkpoint:
+            name = f"checkpoint_model_epoch_{epoch + 1}"
+            if step is not None:
+                name += f"_step_{step + 1}"
+            checkpoint_path = os.path.join(self.checkpoints_path, f"{name}.pth")
+            checkpoint = {
+                **snapshot,
+                "dev_accuracy": dev_accuracy,
+                "encoder_file": self._encoder_file(checkpoint_path),
+            }
+            self._queue.put(
+                lambda: self._write_checkpoint(checkpoint, checkpoint_path, dev_accuracy)
+            )
+
+        latest_path = os.path.join(self.output_model_path, LATEST_FILE)
+        latest = {
+            **snapshot,
+            "optimizer_state_dict": to_cpu(optimizer.state_dict()),
+            "encoder_file": self._encoder_file(latest_path),
+            # copied now, training keeps changing the lists it holds
+            "resume_state": to_cpu(resume_state or {}),
+        }
+        self._queue.put(lambda: atomic_save(latest, latest_path))
+        return snapshot
+
+    def save_best(self, epoch, model):
+        """Snapshots the model and queues only best_model.pth; returns the snapshot."""
+        self._raise_error()
+        snapshot = {"epoch": epoch, "model_state_dict": self.snapshot(model)}
+        self._queue_best(snapshot)
+        return snapshot
+
+    def _queue_best(self, snapshot):
+        best_path = os.path.join(self.output_model_path, BEST_FILE)
+        best = {**snapshot, "encoder_file": self._encoder_file(best_path)}
+        self._queue.put(lambda: atomic_save(best, best_path))
+        self.best_written = True
+
+    def _write_checkpoint(self, checkpoint, path, dev_accuracy):
+        atomic_save(checkpoint, path)
+        self.checkpoints.append((dev_accuracy, path))
+        self.checkpoints.sort(key=lambda item: item[0], reverse=True)
+        for _, removed_path in self.checkpoints[self.keep_top_n :]:
+            os.remove(removed_path)
+        del self.checkpoints[self.keep_top_n :]
+
+    def wait(self):
+        """Blocks until every queued file is written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Writes the queued files, then merges the encoder into best_model.pth."""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+        if self.best_written and self.frozen_prefixes:
+            best_path = os.path.join(self.output_model_path, BEST_FILE)
+            best = torch.load(best_path, map_location="cpu")
+            best["model_state_dict"] = load_model_state_dict(best_path, "cpu")
+            best["encoder_file"] = None
+            atomic_save(best, best_path)
+
+
+def resume(path, model, optimizer, device="cpu"):
+    """
+    Loads the model and optimizer of a latest.pth written by CheckpointManager.
+
+    Returns:
+        Tuple[int, dict]: The next epoch to train and the resume_state saved with it.
+    """
+    latest = torch.load(path, map_location="cpu")
+    load_model_weights(model, path, map_location=device)
+    optimizer.load_state_dict(latest["optimizer_state_dict"])
+    resume_state = latest.get("resume_state", {})
+    return resume_state.get("next_epoch", latest["epoch"] + 1), resume_state
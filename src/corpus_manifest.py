@@ -0,0 +1,63 @@
+# general
+import hashlib
+import json
+import os
+
+import glob2
+
+MANIFEST_FILE = "train_manifest.json"
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_hash(file_path):
+    """sha256 of the content of a file, read in chunks."""
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def corpus_files(folder):
+    """The .txt files NikudDataset reads from folder."""
+    return [
+        file
+        for file in sorted(glob2.glob(f"{folder}/**/*.txt", recursive=True))
+        if "not_use" not in file and "NakdanResults" not in file
+    ]
+
+
+def build_manifest(folder):
+    """Content hash of every corpus file of folder, keyed by its path relative to folder."""
+    return {
+        os.path.relpath(file, folder): file_hash(file) for file in corpus_files(folder)
+    }
+
+
+def save_manifest(manifest, file_path):
+    with open(file_path, "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+
+
+def load_manifest(path):
+    """Loads a manifest file, or the manifest saved in a training output folder."""
+    if os.path.isdir(path):
+        path = os.path.join(path, MANIFEST_FILE)
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def diff_manifest(previous, current):
+    """
+    Splits the files of the current manifest by the previous one.
+
+    A file is unchanged if the previous manifest has its content, under any
+    path: a moved or renamed file was already trained on.
+
+    Returns:
+        Tuple[List[str], List[str]]: New or changed files, and unchanged files.
+    """
+    previous_hashes = set(previous.values())
+    changed = [file for file, sha in current.items() if sha not in previous_hashes]
+    unchanged = [file for file, sha in current.items() if sha in previous_hashes]
+    return changed, unchanged
@@ -0,0 +1,178 @@
+# general
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import glob2
+import numpy as np
+
+from src.corpus_manifest import corpus_files, file_hash
+from src.utiles_data import Letters, Nikud, NikudDataset, label_array
+
+STATS_CACHE_VERSION = 1
+CLASSES = ["nikud", "dagesh", "sin"]
+HEBREW_CODES = np.array([ord(c) for c in Letters.hebrew], dtype=np.uint32)
+
+# the parser reports every file it reads at debug level
+_quiet_logger = logging.getLogger(__name__)
+
+
+def empty_stats():
+    return {
+        "files": 0,
+        "sentences": 0,
+        "letters": 0,
+        "hebrew_letters": 0,
+        "labels": {name: [] for name in CLASSES},
+        "irrelevant": {name: 0 for name in CLASSES},
+        "sentence_lengths": [],
+    }
+
+
+def file_stats(file_path):
+    """
+    Statistics of one corpus file, parsed the way NikudDataset reads it.
+
+    Returns:
+        dict: Number of sentences, of letters and of Hebrew letters, the count
+            of every label id by class, the number of PAD_OR_IRRELEVANT
+            positions by class, and the count of every sentence length.
+    """
+    dataset = NikudDataset(None)
+    data, _ = dataset.read_data(file_path, _quiet_logger)
+    labels = label_array(data)
+    text = "".join(sentence for sentence, _ in data)
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    lengths = np.fromiter((len(sentence) for sentence, _ in data), dtype=np.int64)
+
+    stats = empty_stats()
+    stats["files"] = 1
+    stats["sentences"] = len(data)
+    stats["letters"] = len(labels)
+    stats["hebrew_letters"] = int(np.isin(codes, HEBREW_CODES).sum())
+    for i, name in enumerate(CLASSES):
+        # -1 (PAD_OR_IRRELEVANT) lands in bin 0
+        histogram = np.bincount(
+            labels[:, i].astype(np.int64) + 1,
+            minlength=len(Nikud.label_2_id[name]) + 1,
+        )
+        stats["irrelevant"][name] = int(histogram[0])
+        stats["labels"][name] = histogram[1:].tolist()
+    stats["sentence_lengths"] = np.bincount(lengths).tolist()
+    return stats
+
+
+def _add_counts(total, counts):
+    if len(counts) > len(total):
+        total.extend([0] * (len(counts) - len(total)))
+    for i, count in enumerate(counts):
+        total[i] += count
+
+
+def merge_stats(total, stats):
+    """Adds stats into total, in place."""
+    for key in ["files", "sentences", "letters", "hebrew_letters"]:
+        total[key] += stats[key]
+    for name in CLASSES:
+        _add_counts(total["labels"][name], stats["labels"][name])
+        total["irrelevant"][name] += stats["irrelevant"][name]
+    _add_counts(total["sentence_lengths"], stats["sentence_lengths"])
+    return total
+
+
+def load_stats_cache(cache_path):
+    if cache_path is None or not os.path.isfile(cache_path):
+        return {}
+    with open(cache_path, "r") as f:
+        cache = json.load(f)
+    if cache.get("version") != STATS_CACHE_VERSION:
+        return {}
+    return cache["files"]
+
+
+def save_stats_cache(cache, cache_path):
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": STATS_CACHE_VERSION, "files": cache}, f)
+    os.replace(tmp_path, cache_path)
+
+
+def corpus_stats(files, cache_path=None, num_workers=None, logger=None):
+    """
+    Statistics of a list of corpus files, every file parsed in its own process.
+
+    The statistics of every file are cached by the sha256 of its content, so
+    only new or changed files are parsed again.
+
+    Args:
+        files (List[str]): Corpus files.
+        cache_path (str, optional): JSON cache of the statistics of every file.
+        num_workers (int, optional): Number of processes, all the CPUs by default.
+        logger (logging.Logger, optional): Logger of the progress.
+
+    Returns:
+        Tuple[dict, Dict[str, dict]]: The statistics of all the files together,
+            and the statistics of every file.
+    """
+    cache = load_stats_cache(cache_path)
+    hashes = {file: file_hash(file) for file in files}
+    # files with the same content are parsed once
+    missing = sorted(
+        {sha: file for file, sha in hashes.items() if sha not in cache}.items()
+    )
+
+    msg = f"corpus stats: {len(files)} files, {len(missing)} not in the cache"
+    if logger:
+        logger.info(msg)
+    else:
+        print(msg)
+
+    if missing:
+        missing_files = [file for _, file in missing]
+        if num_workers == 1 or len(missing) == 1:
+            results = [file_stats(file) for file in missing_files]
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                results = list(executor.map(file_stats, missing_files))
+        for (sha, _), stats in zip(missing, results):
+            cache[sha] = stats
+        if cache_path is not None:
+            save_stats_cache(cache, cache_path)
+
+    per_file = {file: cache[sha] for file, sha in hashes.items()}
+    total = empty_stats()
+    for stats in per_file.values():
+        merge_stats(total, stats)
+    return total, per_file
+
+
+def folder_stats(folder, cache_path=None, num_workers=None, logger=None):
+    """Statistics of the files NikudDataset reads from folder."""
+    return corpus_stats(corpus_files(folder), cache_path, num_workers, logger)
+
+
+def info_folder(folder, cache_path=None, num_workers=None):
+    """
+    Counts the .txt files in folder and its sub folders, and the Hebrew letters in them.
+
+    Args:
+        folder (str): The path of the folder to be analyzed.
+        cache_path (str, optional): JSON cache of the statistics of every file.
+        num_workers (int, optional): Number of processes parsing the files.
+
+    Returns:
+        Tuple[int, int]: The total number of files and the total number of Hebrew letters.
+    """
+    files = [
+        file
+        for file in sorted(glob2.glob(f"{folder}/**/*.txt", recursive=True))
+        if ".git" not in file.split(os.sep)
+    ]
+    total, _ = corpus_stats(files, cache_path, num_workers)
+    return total["files"], total["hebrew_letters"]
+
+
+def histograms(stats):
+    """The label counts of stats as the arrays label_histograms() returns."""
+    return {name: np.array(stats["labels"][name], dtype=np.int64) for name in CLASSES}
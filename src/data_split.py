@@ -0,0 +1,300 @@
+# general
+import hashlib
+import json
+import logging
+import os
+import shutil
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+from src.corpus_manifest import corpus_files, file_hash
+from src.running_params import MAX_LENGTH_SEN
+from src.utiles_data import NikudDataset, NikudPreparedData, create_missing_folders, prepare_sentences
+
+SPLITS = ["train", "dev", "test"]
+SPLIT_MANIFEST_FILE = "split_manifest.json"
+# the shards are written here and moved into place once all of them are
+STAGING_FOLDER = ".split_tmp"
+SPLIT_MANIFEST_VERSION = 1
+SHARD_SIZE = 4096
+
+# the parser reports every file it reads at debug level
+_quiet_logger = logging.getLogger(__name__)
+# set in every worker by _init_worker
+_worker_options = {}
+
+
+def stable_fraction(key, seed=0):
+    """Maps a string to [0, 1) the same way on every machine and every run."""
+    digest = hashlib.blake2b(f"{seed}:{key}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64
+
+
+def assign_split(key, ratios, seed=0):
+    """The split of SPLITS a key falls in, by the cumulative ratios of the splits."""
+    fraction = stable_fraction(key, seed) * sum(ratios)
+    for split, bound in zip(SPLITS, np.cumsum(ratios)):
+        if fraction < bound:
+            return split
+    return SPLITS[-1]
+
+
+def _init_worker(tokenizer, ratios, split_by, seed, max_length):
+    _worker_options.update(
+        tokenizer=tokenizer,
+        ratios=ratios,
+        split_by=split_by,
+        seed=seed,
+        max_length=max_length,
+    )
+
+
+def _split_file(item):
+    """Parses, splits and tokenizes one file, returns the arrays of every split."""
+    file_path, key = item
+    options = _worker_options
+    dataset = NikudDataset(None, is_train=True)
+    data, _ = dataset.read_data(file_path, _quiet_logger)
+
+    if options["split_by"] == "file":
+        file_split = assign_split(key, options["ratios"], options["seed"])
+        splits = [file_split] * len(data)
+    else:
+        # by the text without diacritics, so the same sentence never lands in two splits
+        splits = [
+            assign_split(sentence, options["ratios"], options["seed"])
+            for sentence, _ in data
+        ]
+
+    results = {}
+    for split in SPLITS:
+        split_data = [row for row, row_split in zip(data, splits) if row_split == split]
+        if not split_data:
+            continue
+        prepared = prepare_sentences(
+            options["tokenizer"], split_data, options["max_length"], name=split
+        )
+        results[split] = (prepared.tokens, prepared.labels, prepared.lengths)
+    return key, file_hash(file_path), results
+
+
+class ShardWriter:
+    """
+    Cuts the sentences of one split into shards of shard_size sentences
+    (the last one may be shorter), each written as soon as it is full.
+
+    The added arrays are concatenated once per batch of full shards, each
+    shard is a slice of that concatenation.
+    """
+
+    def __init__(self, folder, split, shard_size, max_length, pad_token_id):
+        self.folder = folder
+        self.split = split
+        self.shard_size = shard_size
+        self.max_length = max_length
+        self.pad_token_id = pad_token_id
+        self.shards = []
+        self._tokens, self._labels, self._lengths = [], [], []
+        self._pending = 0
+        create_missing_folders(os.path.join(folder, split))
+
+    def add(self, tokens, labels, lengths):
+        self._tokens.append(tokens)
+        self._labels.append(labels)
+        self._lengths.append(lengths)
+        self._pending += len(lengths)
+        if self._pending >= self.shard_size:
+            self._flush(last=False)
+
+    def _flush(self, last):
+        """Writes every full shard of the pending sentences, with last also the rest."""
+        tokens = np.concatenate(self._tokens)
+        labels = np.concatenate(self._labels)
+        lengths = np.concatenate(self._lengths)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        start = 0
+        while len(lengths) - start >= self.shard_size or (last and start < len(lengths)):
+            end = min(start + self.shard_size, len(lengths))
+            self._write(
+                tokens[offsets[start] : offsets[end]],
+                labels[offsets[start] : offsets[end]],
+                lengths[start:end],
+            )
+            start = end
+        # copies, so the concatenation is freed
+        self._tokens = [tokens[offsets[start] :].copy()]
+        self._labels = [labels[offsets[start] :].copy()]
+        self._lengths = [lengths[start:].copy()]
+        self._pending = len(lengths) - start
+
+    def _write(self, tokens, labels, lengths):
+        name = os.path.join(self.split, f"shard_{len(self.shards):05d}.npz")
+        path = os.path.join(self.folder, name)
+        NikudPreparedData.from_arrays(
+            tokens,
+            labels,
+            np.concatenate([[0], np.cumsum(lengths)]),
+            self.max_length,
+            pad_token_id=self.pad_token_id,
+        ).save(path)
+        self.shards.append(
+            {
+                "file": name,
+                "sentences": len(lengths),
+                "tokens": len(tokens),
+                "sha256": file_hash(path),
+            }
+        )
+
+    def close(self):
+        if self._pending:
+            self._flush(last=True)
+        return self.shards
+
+
+def _swap_in_split(staging_folder, output_folder):
+    """Replaces the split folders of output_folder by the ones of staging_folder."""
+    for split in SPLITS:
+        old_split = os.path.join(output_folder, split)
+        if os.path.exists(old_split):
+            os.replace(old_split, os.path.join(staging_folder, f"old_{split}"))
+        os.replace(os.path.join(staging_folder, split), old_split)
+
+
+def split_corpus(
+    folder,
+    output_folder,
+    tokenizer,
+    ratios=(0.8, 0.1, 0.1),
+    split_by="file",
+    shard_size=SHARD_SIZE,
+    seed=0,
+    max_length=MAX_LENGTH_SEN,
+    num_workers=None,
+    logger=None,
+):
+    """
+    Splits a raw corpus into train/dev/test shards of tokenized sentences.
+
+    Every file is parsed and tokenized in a worker process and its sentences are
+    appended to the shards of their split in file order, so only the shards
+    being filled are held in memory. The split of a file (or of a sentence) is
+    a hash of its relative path (or of its text without diacritics), so the
+    same corpus always gives the same shards, whatever the number of workers.
+    The shards are written aside and swapped in at the end, so a failed split
+    leaves the previous one of output_folder as it was.
+
+    Args:
+        folder (str): Root of the raw corpus, e.g. D_Nikud_Data.
+        output_folder (str): Folder of the shards and of split_manifest.json.
+        tokenizer: Character level tokenizer (one token per letter).
+        ratios (Tuple[float, float, float]): Relative sizes of train, dev and test.
+        split_by (str): "file" keeps every file in one split, "sentence" splits every sentence on its own.
+        shard_size (int): Number of sentences in every shard.
+        seed (int): Changes the hash, and so the split.
+        max_length (int): Length every sentence is truncated to.
+        num_workers (int, optional): Number of processes, all the CPUs by default.
+        logger (logging.Logger, optional): Logger of the progress.
+
+    Returns:
+        dict: The manifest written to output_folder/split_manifest.json.
+    """
+    files = corpus_files(folder)
+    items = [(file, Path(os.path.relpath(file, folder)).as_posix()) for file in files]
+    msg = f"split {len(files)} files of {folder} by {split_by} into {output_folder}"
+    if logger:
+        logger.info(msg)
+    else:
+        print(msg)
+
+    staging_folder = os.path.join(output_folder, STAGING_FOLDER)
+    # left by a split that failed
+    shutil.rmtree(staging_folder, ignore_errors=True)
+    writers = {
+        split: ShardWriter(
+            staging_folder, split, shard_size, max_length, tokenizer.pad_token_id
+        )
+        for split in SPLITS
+    }
+    manifest_files = {}
+    init_args = (tokenizer, list(ratios), split_by, seed, max_length)
+    with Pool(num_workers, initializer=_init_worker, initargs=init_args) as pool:
+        for key, sha, results in pool.imap(_split_file, items):
+            manifest_files[key] = {
+                "sha256": sha,
+                "sentences": {
+                    split: len(results[split][2]) if split in results else 0
+                    for split in SPLITS
+                },
+            }
+            for split, arrays in results.items():
+                writers[split].add(*arrays)
+
+    manifest = {
+        "version": SPLIT_MANIFEST_VERSION,
+        "source": os.path.abspath(folder),
+        "split_by": split_by,
+        "ratios": list(ratios),
+        "seed": seed,
+        "max_length": max_length,
+        "pad_token_id": tokenizer.pad_token_id,
+        "shard_size": shard_size,
+        "splits": {},
+        "files": manifest_files,
+    }
+    for split, writer in writers.items():
+        shards = writer.close()
+        manifest["splits"][split] = {
+            "sentences": sum(shard["sentences"] for shard in shards),
+            "tokens": sum(shard["tokens"] for shard in shards),
+            "shards": shards,
+        }
+    # written last, a folder without it holds an unfinished split
+    manifest_path = os.path.join(output_folder, SPLIT_MANIFEST_FILE)
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=4)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    _swap_in_split(staging_folder, output_folder)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    shutil.rmtree(staging_folder)
+
+    msg = "split: " + ", ".join(
+        f"{split} {manifest['splits'][split]['sentences']} sentences" for split in SPLITS
+    )
+    if logger:
+        logger.info(msg)
+    else:
+        print(msg)
+    return manifest
+
+
+def load_split_manifest(output_folder):
+    with open(os.path.join(output_folder, SPLIT_MANIFEST_FILE), "r") as f:
+        return json.load(f)
+
+
+def load_split(output_folder, split, manifest=None):
+    """NikudPreparedData of all the shards of a split written by split_corpus()."""
+    if manifest is None:
+        manifest = load_split_manifest(output_folder)
+    paths = [
+        os.path.join(output_folder, shard["file"])
+        for shard in manifest["splits"][split]["shards"]
+    ]
+    return NikudPreparedData.load(
+        paths, manifest["max_length"], pad_token_id=manifest["pad_token_id"]
+    )
+
+
+def orgenize_data(main_folder, tokenizer, logger, **split_options):
+    """Splits main_folder into the shards of a "prepared" folder next to it."""
+    return split_corpus(
+        main_folder,
+        os.path.join(Path(main_folder).parent, "prepared"),
+        tokenizer,
+        logger=logger,
+        **split_options,
+    )
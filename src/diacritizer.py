@@ -0,0 +1,138 @@
+from src.instrumentation import get_instrumentation
+from src.lexicon import predict_with_lexicon
+from src.models_utils import cascade_predict, predict_by_length, predict_keeping_marks
+from src.running_params import BATCH_SIZE, MAX_LENGTH_SEN
+from src.utiles_data import NikudDataset
+
+
+class Diacritizer:
+    """
+    The prediction path of main.py predict/serve and of EndpointHandler: the
+    model, optionally behind a lexicon fast path and a cheap cascade model,
+    keeping the marks already in the text or not.
+
+    Args:
+        model (torch.nn.Module): The full model.
+        tokenizer: Character level tokenizer (one token per letter).
+        device (str): Device the models run on.
+        batch_size (int): Sentences per batch.
+        max_length (int): Length every sentence is truncated to.
+        cascade_model (torch.nn.Module, optional): Cheap model predicting first,
+            see cascade_predict().
+        cascade_threshold (float, optional): Confidence under which a sentence
+            escalates to the full model.
+        lexicon (Lexicon, optional): Vocalized words, see predict_with_lexicon().
+        lexicon_min_count (int): Times a word must have been seen to skip the model.
+        logger (logging.Logger, optional): Logger of what skipped the model.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device="cpu",
+        batch_size=BATCH_SIZE,
+        max_length=MAX_LENGTH_SEN,
+        cascade_model=None,
+        cascade_threshold=None,
+        lexicon=None,
+        lexicon_min_count=1,
+        logger=None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.cascade_model = cascade_model
+        self.cascade_threshold = cascade_threshold
+        self.lexicon = lexicon
+        self.lexicon_min_count = lexicon_min_count
+        self.logger = logger
+        self.instrumentation = get_instrumentation()
+
+    def _debug(self, msg):
+        if self.logger:
+            self.logger.debug(msg)
+
+    def predict_prepared(self, prepared_data):
+        """Labels of tokenized sentences, by the model or the cascade."""
+        if self.cascade_model is None:
+            return predict_by_length(
+                self.model, prepared_data, self.batch_size, self.device
+            )
+        labels, escalated = cascade_predict(
+            self.cascade_model,
+            self.model,
+            prepared_data,
+            self.batch_size,
+            self.cascade_threshold,
+            self.device,
+        )
+        self._debug(
+            f"cascade: {int(escalated.sum())} of {len(escalated)} sentences escalated "
+            f"to the full model"
+        )
+        return labels
+
+    def predict_sentences(self, prepared_data, origin_sentences):
+        """predict_prepared() behind the lexicon fast path, when there is a lexicon."""
+        if self.lexicon is None:
+            return self.predict_prepared(prepared_data)
+        labels, covered = predict_with_lexicon(
+            self.lexicon,
+            prepared_data,
+            origin_sentences,
+            self.predict_prepared,
+            min_count=self.lexicon_min_count,
+        )
+        self._debug(
+            f"lexicon: {int(covered.sum())} of {len(covered)} sentences skipped the model"
+        )
+        return labels
+
+    def predict_labels(self, dataset, keep_marks=False):
+        """
+        Labels of the sentences of a NikudDataset read by read_inference_text()
+        and prepared by prepare_inference_data().
+        """
+        if not keep_marks:
+            return self.predict_sentences(dataset.prepered_data, dataset.origin_data)
+        labels, vocalized = predict_keeping_marks(
+            dataset.prepered_data,
+            dataset.origin_data,
+            dataset.existing_labels,
+            lambda prepared_data, indices: self.predict_sentences(
+                prepared_data, [dataset.origin_data[i] for i in indices]
+            ),
+        )
+        self._debug(
+            f"keep marks: {int(vocalized.sum())} of {len(vocalized)} sentences "
+            f"already vocalized"
+        )
+        return labels
+
+    def split_text(self, text):
+        """The non empty segments of text, as the model predicts them."""
+        return [
+            segment for segment in NikudDataset(None).split_text(text) if segment != ""
+        ]
+
+    def predict_segments(self, segments, keep_marks=False):
+        """The diacritized text of every non empty segment of split_text()."""
+        if not segments:
+            return []
+        dataset = NikudDataset(tokenizer=self.tokenizer, max_length=self.max_length)
+        with self.instrumentation.span("parse"):
+            dataset.read_inference_segments(segments, keep_marks=keep_marks)
+        with self.instrumentation.span("tokenize"):
+            dataset.prepare_inference_data(name="inference")
+        labels = self.predict_labels(dataset, keep_marks=keep_marks)
+        with self.instrumentation.span("decode"):
+            return dataset.back_2_sentences(labels=labels)
+
+    def predict_text(self, text, keep_marks=False):
+        """The diacritized text."""
+        with self.instrumentation.span("parse"):
+            segments = self.split_text(text)
+        return "".join(self.predict_segments(segments, keep_marks=keep_marks))
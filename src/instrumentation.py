@@ -0,0 +1,264 @@
+# general
+import contextlib
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ML
+import torch
+
+from src.utiles_data import create_missing_folders
+
+METRICS_PREFIX = "dnikud"
+
+
+class NullInstrumentation:
+    """
+    Instrumentation that records nothing; every hook is a no-op so the hot path
+    pays a method call at most.
+    """
+
+    enabled = False
+
+    def span(self, name):
+        return contextlib.nullcontext()
+
+    def count(self, name, value=1):
+        pass
+
+    def record_batch(self, attention_mask):
+        pass
+
+    def step(self):
+        pass
+
+    def snapshot(self):
+        return {}
+
+    def prometheus_text(self):
+        return ""
+
+    def close(self):
+        pass
+
+
+class Instrumentation(NullInstrumentation):
+    """
+    Timers and counters for the prediction hot path.
+
+    Spans (parse, tokenize, forward, decode, write) accumulate count/sum/max of
+    their duration, counters accumulate sentences, chars and padded positions.
+    Results can be appended to a JSONL file, served as Prometheus text on a local
+    port, and a torch.profiler trace can be captured for a window of batches.
+
+    Args:
+        jsonl_path (str, optional): File every finished span is appended to.
+        prometheus_port (int, optional): Local port serving /metrics.
+        profile_dir (str, optional): Folder the torch.profiler chrome trace is saved to.
+        profile_window (Tuple[int, int]): First batch and number of batches to profile.
+    """
+
+    enabled = True
+
+    def __init__(
+        self,
+        jsonl_path=None,
+        prometheus_port=None,
+        profile_dir=None,
+        profile_window=(5, 10),
+    ):
+        self._lock = threading.Lock()
+        self.spans = {}
+        self.counters = {}
+        self._jsonl_file = None
+        if jsonl_path is not None:
+            create_missing_folders(os.path.dirname(os.path.abspath(jsonl_path)))
+            self._jsonl_file = open(jsonl_path, "a", encoding="utf-8")
+
+        self.profile_dir = profile_dir
+        self.profile_start, self.profile_steps = profile_window
+        self._profiler = None
+        self._steps = 0
+
+        self._server = None
+        if prometheus_port is not None:
+            self._server = start_prometheus_server(self, prometheus_port)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        profiled = (
+            torch.profiler.record_function(name)
+            if self._profiler is not None
+            else contextlib.nullcontext()
+        )
+        start = time.perf_counter()
+        with profiled:
+            yield
+        duration = time.perf_counter() - start
+        with self._lock:
+            stats = self.spans.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+            stats["count"] += 1
+            stats["sum"] += duration
+            stats["max"] = max(stats["max"], duration)
+            self._write_jsonl(
+                {"ts": time.time(), "type": "span", "name": name, "sec": duration}
+            )
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_batch(self, attention_mask):
+        """Counts the sentences, chars and padding of a (batch, length) attention mask."""
+        rows, length = attention_mask.shape
+        tokens = int(attention_mask.sum())
+        with self._lock:
+            self.counters["batches"] = self.counters.get("batches", 0) + 1
+            self.counters["sentences"] = self.counters.get("sentences", 0) + rows
+            # every row has a start and an end token
+            self.counters["chars"] = self.counters.get("chars", 0) + tokens - 2 * rows
+            self.counters["positions"] = self.counters.get("positions", 0) + rows * length
+            self.counters["tokens"] = self.counters.get("tokens", 0) + tokens
+            self.counters["batch_capacity"] = max(
+                self.counters.get("batch_capacity", 0), rows
+            )
+
+    def step(self):
+        """Marks the end of a batch, opening and closing the profiling window."""
+        if self.profile_dir is None:
+            return
+        self._steps += 1
+        if self._steps == self.profile_start and self._profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profiler = torch.profiler.profile(
+                activities=activities, record_shapes=True
+            )
+            self._profiler.__enter__()
+        elif (
+            self._profiler is not None
+            and self._steps == self.profile_start + self.profile_steps
+        ):
+            self._stop_profiler()
+
+    def _stop_profiler(self):
+        self._profiler.__exit__(None, None, None)
+        create_missing_folders(self.profile_dir)
+        trace_path = os.path.join(
+            self.profile_dir, f"trace_{os.getpid()}_{int(time.time())}.json"
+        )
+        self._profiler.export_chrome_trace(trace_path)
+        self._profiler = None
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+            spans = {name: dict(stats) for name, stats in self.spans.items()}
+        if counters.get("positions"):
+            counters["padding_ratio"] = 1 - counters["tokens"] / counters["positions"]
+        if counters.get("batches"):
+            counters["batch_fill"] = counters["sentences"] / (
+                counters["batches"] * counters["batch_capacity"]
+            )
+        if counters.get("cascade_sentences"):
+            counters["escalation_rate"] = (
+                counters.get("cascade_escalated", 0) / counters["cascade_sentences"]
+            )
+        if counters.get("lexicon_words"):
+            counters["lexicon_hit_rate"] = (
+                counters.get("lexicon_hits", 0) / counters["lexicon_words"]
+            )
+        if counters.get("lexicon_sentences"):
+            counters["lexicon_skip_rate"] = (
+                counters.get("lexicon_skipped", 0) / counters["lexicon_sentences"]
+            )
+        if counters.get("keep_marks_sentences"):
+            counters["keep_marks_skip_rate"] = (
+                counters.get("keep_marks_skipped", 0) / counters["keep_marks_sentences"]
+            )
+        return {"counters": counters, "spans": spans}
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            if name in (
+                "padding_ratio",
+                "batch_fill",
+                "batch_capacity",
+                "escalation_rate",
+                "lexicon_hit_rate",
+                "lexicon_skip_rate",
+                "keep_marks_skip_rate",
+            ):
+                lines.append(f"# TYPE {METRICS_PREFIX}_{name} gauge")
+                lines.append(f"{METRICS_PREFIX}_{name} {value}")
+            else:
+                lines.append(f"# TYPE {METRICS_PREFIX}_{name}_total counter")
+                lines.append(f"{METRICS_PREFIX}_{name}_total {value}")
+        lines.append(f"# TYPE {METRICS_PREFIX}_span_seconds summary")
+        for name, stats in sorted(snapshot["spans"].items()):
+            lines.append(
+                f'{METRICS_PREFIX}_span_seconds_sum{{span="{name}"}} {stats["sum"]}'
+            )
+            lines.append(
+                f'{METRICS_PREFIX}_span_seconds_count{{span="{name}"}} {stats["count"]}'
+            )
+            lines.append(
+                f'{METRICS_PREFIX}_span_seconds_max{{span="{name}"}} {stats["max"]}'
+            )
+        return "\n".join(lines) + "\n"
+
+    def _write_jsonl(self, record):
+        if self._jsonl_file is not None:
+            self._jsonl_file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        if self._profiler is not None:
+            self._stop_profiler()
+        snapshot = self.snapshot()
+        with self._lock:
+            self._write_jsonl({"ts": time.time(), "type": "snapshot", **snapshot})
+            if self._jsonl_file is not None:
+                self._jsonl_file.close()
+                self._jsonl_file = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+def start_prometheus_server(instrumentation, port, host="127.0.0.1"):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = instrumentation.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+_instrumentation = NullInstrumentation()
+
+
+def get_instrumentation():
+    return _instrumentation
+
+
+def set_instrumentation(instrumentation):
+    global _instrumentation
+    _instrumentation = instrumentation
+    return instrumentation
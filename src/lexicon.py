@@ -0,0 +1,287 @@
+# general
+import hashlib
+import json
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+from src.corpus_manifest import corpus_files
+from src.instrumentation import get_instrumentation
+from src.utiles_data import Nikud, NikudDataset, create_missing_folders, label_array
+
+LEXICON_VERSION = 1
+LEXICON_META_FILE = "lexicon.json"
+LEXICON_ARRAYS = ["keys", "offsets", "labels", "ambiguity", "counts"]
+# runs of Hebrew letters, with the geresh and gershayim inside them
+WORD_PATTERN = re.compile("[א-ת]+(?:['\"׳״][א-ת]*)*")
+
+
+def word_key(word):
+    """64 bit hash of a word, the same on every machine and every run."""
+    digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def iter_words(sentence):
+    """Yields (start, end) of every word of a sentence without diacritics."""
+    for match in WORD_PATTERN.finditer(sentence):
+        yield match.span()
+
+
+class Lexicon:
+    """
+    Vocalization of every word seen in a corpus, for the words that can skip the model.
+
+    The entries are sorted by the 64 bit hash of their word (keys), with offsets
+    into one flat int8 array of the [nikud, dagesh, sin] labels of their letters.
+    A word keeps its most frequent vocalization, the number of distinct ones
+    (ambiguity) and the number of times it was seen. Every array is a .npy file,
+    so a lexicon is memory mapped instead of read.
+
+    Args:
+        keys (np.ndarray): Sorted uint64 word hashes.
+        offsets (np.ndarray): int64 start of every word in labels, one more than keys.
+        labels (np.ndarray): (letters, 3) int8 labels.
+        ambiguity (np.ndarray): Number of vocalizations of every word.
+        counts (np.ndarray): Number of times every word was seen.
+        meta (dict, optional): What the lexicon was built from.
+    """
+
+    def __init__(self, keys, offsets, labels, ambiguity, counts, meta=None):
+        self.keys = keys
+        self.offsets = offsets
+        self.labels = labels
+        self.ambiguity = ambiguity
+        self.counts = counts
+        self.meta = meta or {}
+
+    @classmethod
+    def build(cls, data, origin_data):
+        """
+        Lexicon of parsed sentences.
+
+        Args:
+            data (List[Tuple[str, List[Letter]]]): Normalized sentences and their letters.
+            origin_data (List[str]): The same sentences with their original letters.
+        """
+        labels = label_array(data)
+        vocalizations = {}
+        start = 0
+        for (sentence, _), origin in zip(data, origin_data):
+            for word_start, word_end in iter_words(origin):
+                word_labels = labels[start + word_start : start + word_end]
+                vocalizations.setdefault(origin[word_start:word_end], Counter())[
+                    word_labels.tobytes()
+                ] += 1
+            start += len(sentence)
+
+        entries = sorted(
+            (word_key(word), word, counter) for word, counter in vocalizations.items()
+        )
+        lengths = np.array([len(word) for _, word, _ in entries], dtype=np.int64)
+        word_labels = [counter.most_common(1)[0][0] for _, _, counter in entries]
+        return cls(
+            np.array([key for key, _, _ in entries], dtype=np.uint64),
+            np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            np.frombuffer(b"".join(word_labels), dtype=np.int8).reshape(-1, 3),
+            np.array([len(counter) for _, _, counter in entries], dtype=np.int32),
+            np.array(
+                [sum(counter.values()) for _, _, counter in entries], dtype=np.int64
+            ),
+            meta={"sentences": len(data)},
+        )
+
+    @classmethod
+    def build_from_folder(cls, folder, logger=None):
+        """Lexicon of the files NikudDataset reads from folder, e.g. data/train."""
+        dataset = NikudDataset(None, files=corpus_files(folder), logger=logger)
+        lexicon = cls.build(dataset.data, dataset.origin_data)
+        lexicon.meta["source"] = os.path.abspath(folder)
+        return lexicon
+
+    def save(self, folder):
+        create_missing_folders(folder)
+        for name in LEXICON_ARRAYS:
+            np.save(os.path.join(folder, f"{name}.npy"), getattr(self, name))
+        meta = {
+            **self.meta,
+            "version": LEXICON_VERSION,
+            "words": len(self),
+            "unambiguous_words": int((self.ambiguity == 1).sum()),
+        }
+        with open(os.path.join(folder, LEXICON_META_FILE), "w") as f:
+            json.dump(meta, f, indent=4)
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        with open(os.path.join(folder, LEXICON_META_FILE), "r") as f:
+            meta = json.load(f)
+        if meta.get("version") != LEXICON_VERSION:
+            raise ValueError(f"lexicon version {meta.get('version')} of {folder}")
+        arrays = [
+            np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="r" if mmap else None)
+            for name in LEXICON_ARRAYS
+        ]
+        return cls(*arrays, meta=meta)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, word, min_count=1):
+        """
+        The labels of a word that always had the same vocalization.
+
+        Args:
+            word (str): Word without diacritics.
+            min_count (int): Times the word must have been seen.
+
+        Returns:
+            np.ndarray: (len(word), 3) int8 labels, or None for an unknown or
+                ambiguous word.
+        """
+        key = np.uint64(word_key(word))
+        index = int(np.searchsorted(self.keys, key))
+        if index == len(self.keys) or self.keys[index] != key:
+            return None
+        if self.ambiguity[index] != 1 or self.counts[index] < min_count:
+            return None
+        start, end = self.offsets[index], self.offsets[index + 1]
+        if end - start != len(word):
+            return None
+        return self.labels[start:end]
+
+    def cover(self, origin_sentences, max_length, min_count=1):
+        """
+        Labels of the sentences every word of which the lexicon vocalizes.
+
+        Args:
+            origin_sentences (List[str]): Sentences without diacritics, with their
+                original letters.
+            max_length (int): Length of the rows of the labels, start token included.
+            min_count (int): Times a word must have been seen.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Bool mask of the covered sentences, and
+                their (covered, max_length, 3) int8 labels laid out as predict()
+                returns them.
+        """
+        instrumentation = get_instrumentation()
+        covered = np.zeros(len(origin_sentences), dtype=bool)
+        rows = []
+        words = hits = 0
+        for index, sentence in enumerate(origin_sentences):
+            row = np.full((max_length, 3), Nikud.PAD_OR_IRRELEVANT, dtype=np.int8)
+            sentence_covered = len(sentence) < max_length - 1
+            for start, end in iter_words(sentence):
+                words += 1
+                word_labels = self.lookup(sentence[start:end], min_count)
+                if word_labels is None:
+                    sentence_covered = False
+                    continue
+                hits += 1
+                if sentence_covered:
+                    row[1 + start : 1 + end] = word_labels
+            if sentence_covered:
+                covered[index] = True
+                rows.append(row)
+        instrumentation.count("lexicon_words", words)
+        instrumentation.count("lexicon_hits", hits)
+        instrumentation.count("lexicon_sentences", len(origin_sentences))
+        instrumentation.count("lexicon_skipped", int(covered.sum()))
+        labels = (
+            np.stack(rows)
+            if rows
+            else np.zeros((0, max_length, 3), dtype=np.int8)
+        )
+        return covered, labels
+
+    def hit_rate(self, origin_sentences, min_count=1):
+        """Share of the words of the sentences the lexicon vocalizes."""
+        words = hits = 0
+        for sentence in origin_sentences:
+            for start, end in iter_words(sentence):
+                words += 1
+                hits += self.lookup(sentence[start:end], min_count) is not None
+        return hits / words if words else None
+
+
+def predict_with_lexicon(
+    lexicon, prepared_data, origin_sentences, predict_fn, min_count=1
+):
+    """
+    Labels of the sentences the lexicon covers whole, and of the others by the model.
+
+    Args:
+        lexicon (Lexicon): Vocalized words.
+        prepared_data (NikudPreparedData): The tokenized sentences.
+        origin_sentences (List[str]): The same sentences with their original letters.
+        predict_fn (Callable): Labels of a NikudPreparedData, e.g. predict_by_length().
+        min_count (int): Times a word must have been seen to skip the model.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The labels of every sentence, and a bool
+            mask of the sentences that skipped the model.
+    """
+    covered, lexicon_labels = lexicon.cover(
+        origin_sentences, prepared_data.max_length, min_count
+    )
+    labels = np.full(
+        (len(prepared_data), prepared_data.max_length, 3),
+        Nikud.PAD_OR_IRRELEVANT,
+        dtype=np.int8,
+    )
+    labels[covered] = lexicon_labels
+    if not covered.all():
+        rest = np.flatnonzero(~covered)
+        labels[rest] = predict_fn(prepared_data.subset(rest))
+    return labels, covered
+
+
+def evaluate_lexicon(lexicon, origin_sentences, prepared_data, scores, min_count=1):
+    """
+    Letter accuracy with the lexicon fast path against the model alone.
+
+    Args:
+        lexicon (Lexicon): Vocalized words.
+        origin_sentences (List[str]): Labeled sentences with their original letters.
+        prepared_data (NikudPreparedData): The same sentences, tokenized with their labels.
+        scores (Dict[str, np.ndarray]): sentence_scores() of the model on
+            prepared_data, in the order of the sentences.
+        min_count (int): Times a word must have been seen to skip the model.
+
+    Returns:
+        dict: Word hit rate, share of skipped sentences, letter accuracy of the
+            model alone and with the lexicon, and of the lexicon on the sentences
+            it covers.
+    """
+    covered, lexicon_labels = lexicon.cover(
+        origin_sentences, prepared_data.max_length, min_count
+    )
+    lexicon_letters = lexicon_correct = 0
+    for index, row in zip(np.flatnonzero(covered), lexicon_labels):
+        _, gold = prepared_data.row(index)
+        predicted = row[: len(gold)]
+        relevant = (gold != Nikud.PAD_OR_IRRELEVANT).any(axis=1)
+        correct = ((predicted == gold) | (gold == Nikud.PAD_OR_IRRELEVANT)).all(axis=1)
+        lexicon_letters += int(relevant.sum())
+        lexicon_correct += int((correct & relevant).sum())
+
+    letters = int(scores["letters"].sum())
+    model_correct = int(scores["correct_letters"].sum())
+    with_lexicon_correct = (
+        model_correct - int(scores["correct_letters"][covered].sum()) + lexicon_correct
+    )
+    return {
+        "hit_rate": lexicon.hit_rate(origin_sentences, min_count),
+        "skipped_sentences": float(covered.mean()) if len(covered) else None,
+        "skipped_letters": lexicon_letters / letters if letters else None,
+        "letter_level_correct": model_correct / letters if letters else None,
+        "letter_level_correct_with_lexicon": (
+            with_lexicon_correct / letters if letters else None
+        ),
+        "lexicon_letter_level_correct": (
+            lexicon_correct / lexicon_letters if lexicon_letters else None
+        ),
+    }
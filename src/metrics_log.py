@@ -0,0 +1,133 @@
+# general
+import json
+import os
+import time
+
+from src.utiles_data import create_missing_folders
+
+CLASSES = ["nikud", "dagesh", "sin"]
+ACCURACY_KEYS = CLASSES + ["all_nikud_letter", "all_nikud_word"]
+
+
+class MetricsLog:
+    """
+    Append-only JSONL log of the training metrics: every write adds one line, so
+    its cost does not grow with the length of the run. Every record carries the
+    run id, so runs sharing a file can be told apart.
+
+    Args:
+        path (str): JSONL file, created when missing and appended to otherwise.
+        run_id (str): Id of the training run.
+    """
+
+    def __init__(self, path, run_id):
+        create_missing_folders(os.path.dirname(os.path.abspath(path)))
+        self.path = path
+        self.run_id = run_id
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _write(self, record_type, **values):
+        record = {"run_id": self.run_id, "type": record_type, "ts": time.time(), **values}
+        self._file.write(json.dumps(record) + "\n")
+
+    def log_step(self, epoch, step, loss):
+        self._write("step", epoch=epoch, step=step, loss=loss)
+
+    def log_train_epoch(self, epoch, loss):
+        self._write("train_epoch", epoch=epoch, loss=loss)
+        self._file.flush()
+
+    def log_dev(self, epoch, loss, accuracy, step=None):
+        self._write("dev", epoch=epoch, step=step, loss=loss, accuracy=accuracy)
+        self._file.flush()
+
+    def log_full_dev(self, epoch, loss, accuracy, model):
+        """The evaluation on all the dev data of model ("final" or "best") after training."""
+        self._write("full_dev", epoch=epoch, model=model, loss=loss, accuracy=accuracy)
+        self._file.flush()
+
+    def log_resume(self, epoch):
+        """Marks that training restarts at epoch; readers drop what was logged from it on."""
+        self._write("resume", epoch=epoch)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class MetricsLogReader:
+    """
+    Follows a MetricsLog file, reading only the lines appended since the previous
+    update() into the same per-class lists training() returns.
+
+    Args:
+        path (str): JSONL file written by MetricsLog.
+        run_id (str, optional): Keep only the records of this run.
+    """
+
+    def __init__(self, path, run_id=None):
+        self.path = path
+        self.run_id = run_id
+        self.offset = 0
+        self.train_steps_loss_values = {name: [] for name in CLASSES}
+        self.train_epochs_loss_values = {name: [] for name in CLASSES}
+        self.dev_loss_values = {name: [] for name in CLASSES}
+        self.dev_accuracy_values = {name: [] for name in ACCURACY_KEYS}
+        # accuracy on all the dev data after training, by model ("final" or "best")
+        self.full_dev_accuracy = {}
+        # epoch of every record read, by type
+        self._epochs = {"step": [], "train_epoch": [], "dev": []}
+
+    def update(self):
+        """Reads the new complete lines, returns how many records were added."""
+        if not os.path.isfile(self.path):
+            return 0
+        added = 0
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            for line in f:
+                # a line still being written is read on the next update
+                if not line.endswith(b"\n"):
+                    break
+                self.offset += len(line)
+                record = json.loads(line)
+                if self.run_id is not None and record["run_id"] != self.run_id:
+                    continue
+                self._add(record)
+                added += 1
+        return added
+
+    def _lists(self, record_type):
+        return {
+            "step": [self.train_steps_loss_values],
+            "train_epoch": [self.train_epochs_loss_values],
+            "dev": [self.dev_loss_values, self.dev_accuracy_values],
+        }[record_type]
+
+    def _add(self, record):
+        if record["type"] == "resume":
+            for record_type, epochs in self._epochs.items():
+                keep = sum(1 for epoch in epochs if epoch < record["epoch"])
+                del epochs[keep:]
+                for lists in self._lists(record_type):
+                    for values in lists.values():
+                        del values[keep:]
+            return
+        if record["type"] == "full_dev":
+            self.full_dev_accuracy[record["model"]] = record["accuracy"]
+            return
+        if record["type"] == "step":
+            values = [(self.train_steps_loss_values, record["loss"])]
+        elif record["type"] == "train_epoch":
+            values = [(self.train_epochs_loss_values, record["loss"])]
+        elif record["type"] == "dev":
+            values = [
+                (self.dev_loss_values, record["loss"]),
+                (self.dev_accuracy_values, record["accuracy"]),
+            ]
+        else:
+            return
+        self._epochs[record["type"]].append(record["epoch"])
+        for lists, record_values in values:
+            for name, value in record_values.items():
+                lists[name].append(value)
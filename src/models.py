@@ -3,11 +3,103 @@ import subprocess
 import yaml
 
 # ML
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from transformers import AutoConfig, RobertaForMaskedLM, PretrainedConfig
 
 
+def run_lstms(lstms, hidden, attention_mask, segment_ids=None):
+    """
+    Runs the BiLSTMs one after the other on the real tokens of every row only.
+
+    The rows are packed by their attention_mask length, so the recurrence never
+    walks the padding and the backward direction starts at the last real token:
+    the outputs of a row don't depend on how much it is padded. The output is
+    padded back to the length of hidden, with zeros at the padding.
+
+    With segment_ids, every sentence packed in a row is its own sequence.
+    """
+    if segment_ids is not None:
+        real = segment_ids > 0
+        # the tokens of a sentence are consecutive, so are their keys
+        rows = torch.arange(segment_ids.shape[0], device=segment_ids.device).unsqueeze(1)
+        keys = (rows * (segment_ids.shape[1] + 1) + segment_ids)[real]
+        _, lengths = torch.unique_consecutive(keys, return_counts=True)
+        in_segment = torch.arange(int(lengths.max()), device=hidden.device) < lengths.unsqueeze(1)
+        segments = hidden.new_zeros(len(lengths), in_segment.shape[1], hidden.shape[2])
+        segments[in_segment] = hidden[real]
+        segments_output = run_lstms(lstms, segments, in_segment.long())
+        output = segments_output.new_zeros(*segment_ids.shape, segments_output.shape[2])
+        output[real] = segments_output[in_segment]
+        return output
+
+    lengths = attention_mask.sum(dim=1).clamp(min=1).cpu()
+    output = pack_padded_sequence(hidden, lengths, batch_first=True, enforce_sorted=False)
+    for lstm in lstms:
+        output, _ = lstm(output)
+    output, _ = pad_packed_sequence(output, batch_first=True, total_length=hidden.shape[1])
+    return output
+
+
+def segment_attention(segment_ids, padding_idx):
+    """
+    Attention mask and position ids keeping apart the sentences packed in a row:
+    every token attends only to the tokens of its own sentence, and the
+    positions restart at every sentence as if it had a row of its own.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: (batch, length, length) block
+            diagonal attention mask and (batch, length) position ids.
+    """
+    real = segment_ids > 0
+    attention_mask = (segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)) & real.unsqueeze(1)
+
+    index = torch.arange(segment_ids.shape[1], device=segment_ids.device).expand_as(segment_ids)
+    starts_segment = torch.ones_like(real)
+    starts_segment[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+    segment_start = torch.where(starts_segment, index, 0).cummax(dim=1).values
+    # RoBERTa counts positions from padding_idx + 1
+    position_ids = torch.where(real, index - segment_start + padding_idx + 1, padding_idx)
+    return attention_mask.long(), position_ids
+
+
+def trim_batch(input_ids, attention_mask, *columns):
+    """
+    Cuts the padding columns after the longest row of the batch, so the encoder
+    and the BiLSTMs don't spend their time on them. The rows are padded at
+    their end, and the masked pad tokens change nothing for the real ones.
+    columns, e.g. positions, are (batch, length) tensors (or None) cut the same way.
+    """
+    length = max(int(attention_mask.sum(dim=1).max()), 1)
+    columns = tuple(column if column is None else column[:, :length] for column in columns)
+    return (input_ids[:, :length], attention_mask[:, :length]) + columns
+
+
+def pad_logits(logits, width):
+    """Pads (batch, length, classes) logits back to the width of the batch."""
+    return tuple(F.pad(head, (0, 0, 0, width - head.shape[1])) for head in logits)
+
+
+def apply_heads(model, hidden, positions=None):
+    """Runs the dense layer and the three heads of model on every position of hidden, or only on positions."""
+    if positions is not None:
+        # gathered into (num_positions, hidden_size): padding, spaces and punctuation are skipped
+        hidden = hidden[positions]
+    dense = model.dense(hidden)
+
+    nikud = model.out_n(dense)
+    dagesh = model.out_d(dense)
+    sin = model.out_s(dense)
+
+    return nikud, dagesh, sin
+
+
 class DNikudModel(nn.Module):
+    # run every batch only up to its longest row, set to False to time the padded execution
+    trim_padding = True
+
     def __init__(self, config, nikud_size, dagesh_size, sin_size, pretrain_model=None, device='cpu'):
         super(DNikudModel, self).__init__()
 
@@ -17,6 +109,10 @@ class DNikudModel(nn.Module):
             model_base = RobertaForMaskedLM(config=config).to(device)
 
         self.model = model_base.roberta
+        encoder_num_layers = getattr(config, "encoder_num_layers", None)
+        if encoder_num_layers is not None:
+            # the top layers are removed, not computed and discarded
+            self.model.encoder.layer = self.model.encoder.layer[:encoder_num_layers]
         for name, param in self.model.named_parameters():
             param.requires_grad = False
 
@@ -27,17 +123,68 @@ class DNikudModel(nn.Module):
         self.out_d = nn.Linear(config.hidden_size, dagesh_size)
         self.out_s = nn.Linear(config.hidden_size, sin_size)
 
-    def forward(self, input_ids, attention_mask):
-        last_hidden_state = self.model(input_ids, attention_mask=attention_mask).last_hidden_state
-        lstm1, _ = self.lstm1(last_hidden_state)
-        lstm2, _ = self.lstm2(lstm1)
-        dense = self.dense(lstm2)
-
-        nikud = self.out_n(dense)
-        dagesh = self.out_d(dense)
-        sin = self.out_s(dense)
-
-        return nikud, dagesh, sin
+    def forward(self, input_ids, attention_mask, positions=None, segment_ids=None):
+        """
+        With positions, a (batch, length) bool mask, the dense layer and the heads
+        run only on those positions and return packed (num_positions, classes)
+        logits, in the order of positions.nonzero().
+
+        segment_ids, (batch, length) numbers of the sentences packed in every
+        row (from 1, 0 at the padding), keep these sentences from seeing each other.
+        """
+        width = input_ids.shape[1]
+        if self.trim_padding:
+            input_ids, attention_mask, positions, segment_ids = trim_batch(
+                input_ids, attention_mask, positions, segment_ids)
+        if segment_ids is None:
+            encoder_inputs = {"attention_mask": attention_mask}
+        else:
+            encoder_attention_mask, position_ids = segment_attention(segment_ids, self.model.embeddings.padding_idx)
+            encoder_inputs = {"attention_mask": encoder_attention_mask, "position_ids": position_ids}
+        last_hidden_state = self.model(input_ids, **encoder_inputs).last_hidden_state
+        lstm2 = run_lstms([self.lstm1, self.lstm2], last_hidden_state, attention_mask, segment_ids)
+        logits = apply_heads(self, lstm2, positions)
+        return logits if positions is not None else pad_logits(logits, width)
+
+
+class DNikudStudentModel(nn.Module):
+    """
+    Lightweight D-Nikud for fast CPU serving: a BiLSTM over character embeddings
+    instead of the TavBERT encoder, trained by distillation from DNikudModel.
+    Takes the same inputs and returns the same three heads as DNikudModel.
+    """
+
+    trim_padding = True
+
+    def __init__(self, config, nikud_size, dagesh_size, sin_size, device='cpu'):
+        super(DNikudStudentModel, self).__init__()
+
+        hidden_size = config.student_hidden_size
+        self.embedding = nn.Embedding(config.vocab_size, hidden_size, padding_idx=config.pad_token_id)
+        self.lstm = nn.LSTM(hidden_size, hidden_size, num_layers=config.student_num_layers, bidirectional=True,
+                            dropout=0.1 if config.student_num_layers > 1 else 0.0, batch_first=True)
+        self.dense = nn.Linear(2 * hidden_size, hidden_size)
+        self.out_n = nn.Linear(hidden_size, nikud_size)
+        self.out_d = nn.Linear(hidden_size, dagesh_size)
+        self.out_s = nn.Linear(hidden_size, sin_size)
+        self.to(device)
+
+    def forward(self, input_ids, attention_mask, positions=None, segment_ids=None):
+        width = input_ids.shape[1]
+        if self.trim_padding:
+            input_ids, attention_mask, positions, segment_ids = trim_batch(
+                input_ids, attention_mask, positions, segment_ids)
+        embedded = self.embedding(input_ids)
+        lstm = run_lstms([self.lstm], embedded, attention_mask, segment_ids)
+        logits = apply_heads(self, lstm, positions)
+        return logits if positions is not None else pad_logits(logits, width)
+
+
+def build_model(config, nikud_size, dagesh_size, sin_size, pretrain_model=None, device='cpu'):
+    """Builds the model described by config.dnikud_model_type ("full" when missing, or "student")."""
+    if getattr(config, "dnikud_model_type", "full") == "student":
+        return DNikudStudentModel(config, nikud_size, dagesh_size, sin_size, device=device)
+    return DNikudModel(config, nikud_size, dagesh_size, sin_size, pretrain_model=pretrain_model, device=device)
 
 
 def get_git_commit_hash():
@@ -60,6 +207,15 @@ class ModelConfig(PretrainedConfig):
         else:
             self.__dict__.update(dict)
 
+    @classmethod
+    def student_from(cls, config, hidden_size=256, num_layers=2):
+        """Config of a DNikudStudentModel sharing the vocabulary of config."""
+        student_config = cls(dict=dict(config.__dict__))
+        student_config.dnikud_model_type = "student"
+        student_config.student_hidden_size = hidden_size
+        student_config.student_num_layers = num_layers
+        return student_config
+
     def print(self):
         print(self.__dict__)
 
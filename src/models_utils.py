@@ -1,11 +1,14 @@
 # general
-import json
 import os
+import shutil
+import time
+from collections import deque
 
 # ML
 import numpy as np
 import pandas as pd
 import torch
+import torch.nn.functional as F
 
 # visual
 import matplotlib.pyplot as plt
@@ -13,10 +16,23 @@ import seaborn as sns
 from sklearn.metrics import confusion_matrix
 from tqdm import tqdm
 
+from src.checkpoints import BEST_FILE, CheckpointManager, resume
+from src.instrumentation import get_instrumentation
+from src.metrics_log import MetricsLog
 from src.running_params import DEBUG_MODE
-from src.utiles_data import Nikud, create_missing_folders
+from src.lexicon import iter_words
+from src.utiles_data import (
+    CAN_DAGESH,
+    CAN_NIKUD,
+    CAN_SIN,
+    Nikud,
+    create_missing_folders,
+    marked_labels,
+)
 
 CLASSES_LIST = ["nikud", "dagesh", "sin"]
+# steps of loss training() keeps in memory, every step is in metrics.jsonl
+TRAIN_STEPS_LOSS_WINDOW = 1000
 
 
 def calc_num_correct_words(input, letter_correct_mask):
@@ -48,45 +64,294 @@ def calc_num_correct_words(input, letter_correct_mask):
     return correct_words_count, words_count
 
 
-def predict(model, data_loader, device="cpu"):
+def cant_be_masks(marks):
+    """
+    Masks of the positions that can't take a nikud, a dagesh or a sin.
+
+    Args:
+        marks (torch.Tensor): (batch, length) capability codes of a
+            NikudInferenceData batch, or (batch, length, 3) labels, where
+            PAD_OR_IRRELEVANT marks what a position can't take.
+
+    Returns:
+        torch.Tensor: (batch, length, 3) bool mask, True where the mark is impossible.
+    """
+    if marks.dim() == 3:
+        return marks == Nikud.PAD_OR_IRRELEVANT
+    flags = torch.tensor([CAN_NIKUD, CAN_DAGESH, CAN_SIN], device=marks.device)
+    return (marks.unsqueeze(-1).long() & flags) == 0
+
+
+def predict(model, data_loader, device="cpu", return_confidence=False):
+    """
+    Predicts the labels of every sentence of data_loader.
+
+    Args:
+        model (torch.nn.Module): Model to run.
+        data_loader: Batches of (inputs, attention_mask, capability codes or labels).
+        device (str): Device the model runs on.
+        return_confidence (bool): Also return the confidence of every sentence,
+            the lowest softmax probability of a predicted mark over its letters.
+
+    Returns:
+        np.ndarray: (sentences, length, 3) int8 labels, PAD_OR_IRRELEVANT where a
+            mark is impossible, or None for no sentences. With return_confidence,
+            a tuple of the labels and the float32 confidence of every sentence,
+            1 for a sentence without any letter to mark.
+    """
     model.to(device)
+    instrumentation = get_instrumentation()
 
-    all_labels = None
+    all_labels = []
+    all_confidence = []
     with torch.no_grad():
         for index_data, data in enumerate(data_loader):
-            (inputs, attention_mask, labels_demo) = data
+            (inputs, attention_mask, marks) = data
+            instrumentation.record_batch(attention_mask)
             inputs = inputs.to(device)
             attention_mask = attention_mask.to(device)
-            labels_demo = labels_demo.to(device)
+            # int8 capability codes at inference, computed into masks on the device
+            mask_cant_be = cant_be_masks(marks.to(device))
+            # the heads run only where a letter can take some mark
+            positions = ~mask_cant_be.all(dim=2) & attention_mask.bool()
+
+            with instrumentation.span("forward"):
+                nikud_probs, dagesh_probs, sin_probs = model(
+                    inputs, attention_mask, positions=positions
+                )
+                if instrumentation.enabled and inputs.is_cuda:
+                    torch.cuda.synchronize()
 
-            mask_cant_be_nikud = np.array(labels_demo.cpu())[:, :, 0] == -1
-            mask_cant_be_dagesh = np.array(labels_demo.cpu())[:, :, 1] == -1
-            mask_cant_be_sin = np.array(labels_demo.cpu())[:, :, 2] == -1
+            with instrumentation.span("decode"):
+                pred_labels = torch.full(
+                    mask_cant_be.shape, Nikud.PAD_OR_IRRELEVANT, device=device
+                )
+                pred_labels[positions] = torch.stack(
+                    (
+                        nikud_probs.argmax(dim=1),
+                        dagesh_probs.argmax(dim=1),
+                        sin_probs.argmax(dim=1),
+                    ),
+                    dim=1,
+                )
+                pred_labels = pred_labels.masked_fill(
+                    mask_cant_be, Nikud.PAD_OR_IRRELEVANT
+                )
+                all_labels.append(pred_labels.to(torch.int8).cpu().numpy())
+                if return_confidence:
+                    all_confidence.append(
+                        sentence_confidence(
+                            (nikud_probs, dagesh_probs, sin_probs),
+                            mask_cant_be[positions],
+                            positions,
+                        )
+                        .cpu()
+                        .numpy()
+                    )
+            instrumentation.step()
+
+    if not all_labels:
+        return (None, None) if return_confidence else None
+    labels = np.concatenate(all_labels, axis=0)
+    if return_confidence:
+        return labels, np.concatenate(all_confidence)
+    return labels
+
+
+def sentence_confidence(logits, cant_be, positions):
+    """
+    The lowest probability the heads give to their predicted mark in every row.
+
+    Args:
+        logits (Tuple[torch.Tensor, ...]): (positions, classes) nikud, dagesh and
+            sin logits of the packed positions.
+        cant_be (torch.Tensor): (positions, 3) bool mask of the impossible marks,
+            which don't count.
+        positions (torch.Tensor): (batch, length) bool mask of the packed positions.
+
+    Returns:
+        torch.Tensor: (batch,) float32 confidence, 1 for a row without positions.
+    """
+    confidence = torch.stack(
+        [torch.softmax(head.float(), dim=-1).amax(dim=-1) for head in logits], dim=1
+    )
+    confidence = confidence.masked_fill(cant_be, 1.0).amin(dim=1)
+    rows = positions.nonzero()[:, 0]
+    return torch.ones(
+        positions.shape[0], device=confidence.device, dtype=torch.float32
+    ).scatter_reduce(0, rows, confidence, reduce="amin")
 
-            nikud_probs, dagesh_probs, sin_probs = model(inputs, attention_mask)
 
-            pred_nikud = np.array(torch.max(nikud_probs, 2).indices.cpu()).reshape(
-                inputs.shape[0], inputs.shape[1], 1
-            )
-            pred_dagesh = np.array(torch.max(dagesh_probs, 2).indices.cpu()).reshape(
-                inputs.shape[0], inputs.shape[1], 1
+def predict_by_length(
+    model, prepared_data, batch_size, device="cpu", return_confidence=False
+):
+    """predict() on batches of sentences of similar length, returned in the order of the sentences."""
+    batches = prepared_data.length_batches(batch_size)
+    result = predict(
+        model,
+        prepared_data.loader(batch_size, batch_sampler=batches),
+        device,
+        return_confidence=return_confidence,
+    )
+    labels, confidence = result if return_confidence else (result, None)
+    if labels is None:
+        return result
+    order = np.concatenate(batches)
+    ordered_labels = np.empty_like(labels)
+    ordered_labels[order] = labels
+    if not return_confidence:
+        return ordered_labels
+    ordered_confidence = np.empty_like(confidence)
+    ordered_confidence[order] = confidence
+    return ordered_labels, ordered_confidence
+
+
+def cascade_predict(
+    cheap_model, full_model, prepared_data, batch_size, threshold, device="cpu"
+):
+    """
+    Predicts every sentence with cheap_model, and again with full_model only the
+    sentences whose confidence (see predict()) is below threshold.
+
+    Args:
+        cheap_model (torch.nn.Module): Fast model, e.g. a distilled student.
+        full_model (torch.nn.Module): The model the uncertain sentences escalate to.
+        prepared_data (NikudPreparedData): Sentences to predict.
+        batch_size (int): Sentences per batch.
+        threshold (float): Confidence under which a sentence escalates, from
+            calibrate_cascade().
+        device (str): Device the models run on.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The labels of every sentence, and a bool
+            mask of the sentences full_model predicted.
+    """
+    cheap_model.eval()
+    full_model.eval()
+    instrumentation = get_instrumentation()
+    with instrumentation.span("cascade_cheap"):
+        labels, confidence = predict_by_length(
+            cheap_model, prepared_data, batch_size, device, return_confidence=True
+        )
+    if labels is None:
+        return None, np.zeros(0, dtype=bool)
+    escalated = confidence < threshold
+    instrumentation.count("cascade_sentences", len(escalated))
+    instrumentation.count("cascade_escalated", int(escalated.sum()))
+    if escalated.any():
+        indices = np.flatnonzero(escalated)
+        with instrumentation.span("cascade_full"):
+            full_labels = predict_by_length(
+                full_model, prepared_data.subset(indices), batch_size, device
             )
-            pred_sin = np.array(torch.max(sin_probs, 2).indices.cpu()).reshape(
-                inputs.shape[0], inputs.shape[1], 1
+        labels[indices] = full_labels
+    return labels, escalated
+
+
+def predict_keeping_marks(prepared_data, origin_sentences, existing_labels, predict_fn):
+    """
+    Keeps the marks a text already has and predicts only the others.
+
+    A sentence every word of which carries a mark is taken as fully vocalized
+    and skips the model, keeping its marks as they are. In the other sentences
+    every mark already there is kept and only the letters (and classes) without
+    one take the prediction.
+
+    Args:
+        prepared_data (NikudPreparedData): The tokenized sentences.
+        origin_sentences (List[str]): The same sentences with their original letters.
+        existing_labels (np.ndarray): (sentences, length, 3) labels of the marks
+            in the text, from NikudDataset.read_inference_text(keep_marks=True).
+        predict_fn (Callable): Labels of a subset of the sentences, called with the
+            NikudPreparedData of the subset and the indices of its sentences.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The labels of every sentence, and a bool
+            mask of the sentences that skipped the model.
+    """
+    instrumentation = get_instrumentation()
+    marked = marked_labels(existing_labels)
+    letter_marked = marked.any(axis=2)
+    vocalized = np.array(
+        [
+            all(
+                letter_marked[index, 1 + start : 1 + end].any()
+                for start, end in iter_words(sentence)
             )
+            for index, sentence in enumerate(origin_sentences)
+        ],
+        dtype=bool,
+    )
+    instrumentation.count("keep_marks_sentences", len(vocalized))
+    instrumentation.count("keep_marks_skipped", int(vocalized.sum()))
+    instrumentation.count("keep_marks_letters", int(letter_marked.sum()))
 
-            pred_nikud[mask_cant_be_nikud] = -1
-            pred_dagesh[mask_cant_be_dagesh] = -1
-            pred_sin[mask_cant_be_sin] = -1
-
-            pred_labels = np.concatenate((pred_nikud, pred_dagesh, pred_sin), axis=2)
+    labels = existing_labels.copy()
+    if not vocalized.all():
+        rest = np.flatnonzero(~vocalized)
+        predicted = predict_fn(prepared_data.subset(rest), rest)
+        labels[rest] = np.where(marked[rest], existing_labels[rest], predicted)
+    return labels, vocalized
 
-            if all_labels is None:
-                all_labels = pred_labels
-            else:
-                all_labels = np.concatenate((all_labels, pred_labels), axis=0)
 
-    return all_labels
+def calibrate_cascade(
+    cheap_model, full_model, prepared_data, max_accuracy_loss, batch_size, device="cpu"
+):
+    """
+    Picks the confidence threshold of cascade_predict() escalating the fewest
+    sentences while the letter accuracy stays within max_accuracy_loss of
+    full_model alone.
+
+    Args:
+        cheap_model (torch.nn.Module): Fast model, e.g. a distilled student.
+        full_model (torch.nn.Module): The model the uncertain sentences escalate to.
+        prepared_data (NikudPreparedData): The labeled dev sentences.
+        max_accuracy_loss (float): Letter accuracy allowed to be lost, e.g. 0.002.
+        batch_size (int): Sentences per batch.
+        device (str): Device the models run on.
+
+    Returns:
+        dict: The threshold, the escalation rate and the letter accuracy it gives
+            on the dev sentences, and the letter accuracy of each model alone.
+    """
+    cheap_model.eval()
+    full_model.eval()
+    # one pass of each model, the confidence of the cheap one along with its scores
+    cheap_scores = sentence_scores_by_length(
+        cheap_model, prepared_data, batch_size, device, return_confidence=True
+    )
+    confidence = cheap_scores["confidence"]
+    cheap_correct = cheap_scores["correct_letters"]
+    full_scores = sentence_scores_by_length(full_model, prepared_data, batch_size, device)
+    full_correct = full_scores["correct_letters"]
+    letters = max(int(full_scores["letters"].sum()), 1)
+
+    order = np.argsort(confidence, kind="stable")
+    sorted_confidence = confidence[order]
+    # correct letters when the first k sentences by confidence escalate, k = 0..n
+    gains = np.concatenate([[0], np.cumsum((full_correct - cheap_correct)[order])])
+    accuracy = (cheap_correct.sum() + gains) / letters
+    # a threshold escalates all the sentences under it, ties together
+    candidates = np.flatnonzero(
+        np.concatenate(
+            [[True], sorted_confidence[1:] > sorted_confidence[:-1], [True]]
+        )
+    )
+    target = full_correct.sum() / letters - max_accuracy_loss
+    reached = candidates[accuracy[candidates] >= target - 1e-12]
+    k = int(reached[0]) if len(reached) else len(confidence)
+    threshold = (
+        float(sorted_confidence[k]) if k < len(confidence) else float(np.nextafter(1, 2))
+    )
+    return {
+        "threshold": threshold,
+        "escalation_rate": k / max(len(confidence), 1),
+        "letter_level_correct": float(accuracy[k]),
+        "cheap_letter_level_correct": float(cheap_correct.sum() / letters),
+        "full_letter_level_correct": float(full_correct.sum() / letters),
+        "max_accuracy_loss": max_accuracy_loss,
+        "sentences": len(confidence),
+    }
 
 
 def predict_single(model, data, device="cpu"):
@@ -142,12 +407,21 @@ def training(
     output_model_path,
     optimizer,
     device="cpu",
+    teacher_model=None,
+    train_sampler=None,
+    dev_subsample_loader=None,
 ):
     max_length = None
     best_accuracy = 0.0
 
     logger.info(f"start training with training_params: {training_params}")
     model = model.to(device)
+    if teacher_model is not None:
+        # distillation: the frozen teacher supplies soft labels for every batch
+        teacher_model = teacher_model.to(device)
+        teacher_model.eval()
+        temperature = training_params.get("distillation_temperature", 2.0)
+        alpha = training_params.get("distillation_alpha", 0.5)
 
     criteria = {
         "nikud": criterion_nikud.to(device),
@@ -155,10 +429,30 @@ def training(
         "sin": criterion_sin.to(device),
     }
 
-    output_checkpoints_path = os.path.join(output_model_path, "checkpoints")
-    create_missing_folders(output_checkpoints_path)
+    checkpoint_manager = CheckpointManager(
+        output_model_path, model, keep_top_n=training_params.get("keep_top_n", 3)
+    )
+    metrics_log_path = os.path.join(output_model_path, "metrics.jsonl")
+    resumed_metrics_log_path = None
+    if training_params.get("resume_from") is not None:
+        resumed_metrics_log_path = os.path.join(
+            os.path.dirname(training_params["resume_from"]), "metrics.jsonl"
+        )
+    if (
+        resumed_metrics_log_path is not None
+        and os.path.isfile(resumed_metrics_log_path)
+        and not os.path.exists(metrics_log_path)
+    ):
+        # the log of the resumed run continues in this run's folder
+        shutil.copyfile(resumed_metrics_log_path, metrics_log_path)
+    metrics_log = MetricsLog(
+        metrics_log_path,
+        run_id=training_params.get("run_id", os.path.basename(output_model_path)),
+    )
 
-    train_steps_loss_values = {"nikud": [], "dagesh": [], "sin": []}
+    train_steps_loss_values = {
+        class_name: deque(maxlen=TRAIN_STEPS_LOSS_WINDOW) for class_name in CLASSES_LIST
+    }
     train_epochs_loss_values = {"nikud": [], "dagesh": [], "sin": []}
     dev_loss_values = {"nikud": [], "dagesh": [], "sin": []}
     dev_accuracy_values = {
@@ -169,13 +463,167 @@ def training(
         "all_nikud_word": [],
     }
 
-    for epoch in tqdm(range(training_params["n_epochs"]), desc="Training"):
+    best_model = None
+    eval_every_steps = training_params.get("eval_every_steps")
+    early_stopping_metric = training_params.get("early_stopping_metric", "all_nikud_letter")
+    early_stopping_patience = training_params.get("early_stopping_patience")
+    periodic_dev_loader = dev_subsample_loader or dev_loader
+    scheduler = None
+    if training_params.get("lr_scheduler") == "plateau":
+        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
+            optimizer,
+            mode="max",
+            factor=training_params.get("lr_scheduler_factor", 0.5),
+            patience=training_params.get("lr_scheduler_patience", 1),
+        )
+    best_metric = 0.0
+    evaluations_without_improvement = 0
+    num_evaluations = 0
+    global_step = 0
+    # global_step when the current epoch started, where a mid-epoch resume restarts
+    epoch_start_step = 0
+    # no training step since best_model was saved
+    best_is_current = False
+    stop_training = False
+
+    def evaluate_on_dev(epoch, step, next_epoch):
+        """Dev evaluation with its logging, checkpoints and stopping rule; returns True to stop training."""
+        nonlocal best_accuracy, best_model, best_metric, evaluations_without_improvement
+        nonlocal num_evaluations, best_is_current, stop_training
+        dev_loss, dev_accuracy, letter_accuracy, word_accuracy, loss = evaluate_dev(
+            model, periodic_dev_loader, criteria, device
+        )
         model.train()
+        for class_name in CLASSES_LIST:
+            dev_loss_values[class_name].append(dev_loss[class_name])
+            dev_accuracy_values[class_name].append(dev_accuracy[class_name])
+        dev_accuracy_values["all_nikud_letter"].append(letter_accuracy)
+        dev_accuracy_values["all_nikud_word"].append(word_accuracy)
+
+        msg = (
+            f"Epoch {epoch + 1}/{training_params['n_epochs']}"
+            f"{'' if step is None else f', step {step + 1}'}\n"
+            f'mean loss Dev nikud: {dev_loss["nikud"]}, '
+            f'mean loss Dev dagesh: {dev_loss["dagesh"]}, '
+            f'mean loss Dev sin: {dev_loss["sin"]}, '
+            f"Dev all nikud types letter Accuracy: {letter_accuracy}, "
+            f'Dev nikud letter Accuracy: {dev_accuracy["nikud"]}, '
+            f'Dev dagesh letter Accuracy: {dev_accuracy["dagesh"]}, '
+            f'Dev sin letter Accuracy: {dev_accuracy["sin"]}, '
+            f"Dev word Accuracy: {word_accuracy}"
+        )
+        logger.debug(msg)
+
+        metrics_log.log_dev(
+            epoch,
+            dev_loss,
+            {name: values[-1] for name, values in dev_accuracy_values.items()},
+            step=step,
+        )
+
+        metric = dev_accuracy_values[early_stopping_metric][-1]
+        if metric > best_metric:
+            best_metric = metric
+            evaluations_without_improvement = 0
+        else:
+            evaluations_without_improvement += 1
+        if scheduler is not None:
+            scheduler.step(metric)
+
+        is_best = letter_accuracy > best_accuracy
+        if is_best:
+            best_accuracy = letter_accuracy
+        is_checkpoint = num_evaluations % training_params["checkpoints_frequency"] == 0
+        num_evaluations += 1
+        # written in the background from a CPU copy of the weights
+        snapshot = checkpoint_manager.save(
+            epoch,
+            model,
+            optimizer,
+            letter_accuracy,
+            is_best=is_best,
+            is_checkpoint=is_checkpoint,
+            step=step,
+            resume_state={
+                "next_epoch": next_epoch,
+                "num_evaluations": num_evaluations,
+                "global_step": global_step if next_epoch > epoch else epoch_start_step,
+                "best_accuracy": best_accuracy,
+                "best_metric": best_metric,
+                "evaluations_without_improvement": evaluations_without_improvement,
+                "train_epochs_loss_values": train_epochs_loss_values,
+                "dev_loss_values": dev_loss_values,
+                "dev_accuracy_values": dev_accuracy_values,
+                **(
+                    {"train_sampler": train_sampler.state_dict()}
+                    if train_sampler is not None
+                    else {}
+                ),
+                **({"scheduler": scheduler.state_dict()} if scheduler is not None else {}),
+            },
+        )
+        if is_best:
+            best_model = {**snapshot, "loss": float(loss)}
+            best_is_current = True
+
+        if (
+            early_stopping_patience is not None
+            and evaluations_without_improvement >= early_stopping_patience
+        ):
+            logger.info(
+                f"early stopping: no {early_stopping_metric} improvement in "
+                f"{evaluations_without_improvement} dev evaluations"
+            )
+            stop_training = True
+        return stop_training
+
+    start_epoch = 0
+    if training_params.get("resume_from") is not None:
+        start_epoch, resume_state = resume(
+            training_params["resume_from"], model, optimizer, device
+        )
+        best_accuracy = resume_state.get("best_accuracy", best_accuracy)
+        train_epochs_loss_values = resume_state.get(
+            "train_epochs_loss_values", train_epochs_loss_values
+        )
+        dev_loss_values = resume_state.get("dev_loss_values", dev_loss_values)
+        dev_accuracy_values = resume_state.get("dev_accuracy_values", dev_accuracy_values)
+        best_metric = resume_state.get("best_metric", best_metric)
+        evaluations_without_improvement = resume_state.get(
+            "evaluations_without_improvement", evaluations_without_improvement
+        )
+        num_evaluations = resume_state.get("num_evaluations", num_evaluations)
+        global_step = resume_state.get("global_step", global_step)
+        if train_sampler is not None and "train_sampler" in resume_state:
+            train_sampler.load_state_dict(resume_state["train_sampler"])
+        if scheduler is not None and "scheduler" in resume_state:
+            scheduler.load_state_dict(resume_state["scheduler"])
+        metrics_log.log_resume(start_epoch)
+        logger.info(f"resumed training at epoch {start_epoch + 1}")
+
+    epoch = start_epoch - 1
+    for epoch in tqdm(
+        range(start_epoch, training_params["n_epochs"]),
+        desc="Training",
+        initial=start_epoch,
+        total=training_params["n_epochs"],
+    ):
+        model.train()
+        epoch_start_step = global_step
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         train_loss = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
         relevant_count = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
 
+        epoch_start_time = time.time()
+        epoch_letters = 0
         for index_data, data in enumerate(train_loader):
-            (inputs, attention_mask, labels) = data
+            if train_sampler is not None:
+                # the loader of a sampler returns the sentence indices last
+                *data, batch_indices = data
+            (inputs, attention_mask, labels) = data[:3]
+            # batches of packed sentences number the sentences of every row
+            segment_ids = data[3].to(device) if len(data) > 3 else None
 
             if max_length is None:
                 max_length = labels.shape[1]
@@ -185,17 +633,53 @@ def training(
             labels = labels.to(device)
 
             optimizer.zero_grad()
-            nikud_probs, dagesh_probs, sin_probs = model(inputs, attention_mask)
+            # packed: the heads and the loss only see the positions with a label
+            positions = (labels != Nikud.PAD_OR_IRRELEVANT).any(dim=2)
+            packed_labels = labels[positions]
+            epoch_letters += len(packed_labels)
+            nikud_probs, dagesh_probs, sin_probs = model(
+                inputs, attention_mask, positions=positions, segment_ids=segment_ids
+            )
+            if teacher_model is not None:
+                with torch.no_grad():
+                    teacher_probs = teacher_model(
+                        inputs,
+                        attention_mask,
+                        positions=positions,
+                        segment_ids=segment_ids,
+                    )
+            if train_sampler is not None:
+                sentence_loss = torch.zeros(inputs.shape[0], device=device)
+                sentence_relevant = torch.zeros(inputs.shape[0], device=device)
+                sentence_of_position = positions.nonzero()[:, 0]
 
             for i, (probs, class_name) in enumerate(
                 zip([nikud_probs, dagesh_probs, sin_probs], CLASSES_LIST)
             ):
-                reshaped_tensor = (
-                    torch.transpose(probs, 1, 2)
-                    .contiguous()
-                    .view(probs.shape[0], probs.shape[2], probs.shape[1])
-                )
-                loss = criteria[class_name](reshaped_tensor, labels[:, :, i]).to(device)
+                loss = criteria[class_name](probs, packed_labels[:, i]).to(device)
+                if train_sampler is not None:
+                    # per sentence loss of this same forward pass, for the sampler
+                    with torch.no_grad():
+                        sentence_loss.index_add_(
+                            0,
+                            sentence_of_position,
+                            F.cross_entropy(
+                                probs,
+                                packed_labels[:, i],
+                                ignore_index=Nikud.PAD_OR_IRRELEVANT,
+                                reduction="none",
+                            ),
+                        )
+                        sentence_relevant += (labels[:, :, i] != -1).sum(1)
+                if teacher_model is not None:
+                    loss = distillation_loss(
+                        probs,
+                        teacher_probs[i],
+                        packed_labels[:, i],
+                        loss,
+                        temperature,
+                        alpha,
+                    )
 
                 num_relevant = (labels[:, :, i] != -1).sum()
                 train_loss[class_name] += loss.item() * num_relevant
@@ -203,12 +687,22 @@ def training(
 
                 loss.backward(retain_graph=True)
 
-            for i, class_name in enumerate(CLASSES_LIST):
-                train_steps_loss_values[class_name].append(
-                    float(train_loss[class_name] / relevant_count[class_name])
+            if train_sampler is not None:
+                train_sampler.record_losses(
+                    batch_indices.numpy(),
+                    (sentence_loss / sentence_relevant.clamp(min=1)).cpu().numpy(),
                 )
 
+            step_loss = {
+                class_name: float(train_loss[class_name] / relevant_count[class_name])
+                for class_name in CLASSES_LIST
+            }
+            for class_name in CLASSES_LIST:
+                train_steps_loss_values[class_name].append(step_loss[class_name])
+            metrics_log.log_step(epoch, index_data, step_loss)
+
             optimizer.step()
+            best_is_current = False
             if (index_data + 1) % 100 == 0:
                 msg = f"epoch: {epoch} , index_data: {index_data + 1}\n"
                 for i, class_name in enumerate(CLASSES_LIST):
@@ -216,10 +710,24 @@ def training(
 
                 logger.debug(msg[:-2])
 
+            global_step += 1
+            if eval_every_steps is not None and global_step % eval_every_steps == 0:
+                # a run resumed from a mid-epoch checkpoint restarts that epoch
+                last_step = index_data + 1 == len(train_loader)
+                if evaluate_on_dev(epoch, index_data, epoch + 1 if last_step else epoch):
+                    break
+
         for i, class_name in enumerate(CLASSES_LIST):
             train_epochs_loss_values[class_name].append(
                 float(train_loss[class_name] / relevant_count[class_name])
             )
+        metrics_log.log_train_epoch(
+            epoch,
+            {
+                class_name: train_epochs_loss_values[class_name][-1]
+                for class_name in CLASSES_LIST
+            },
+        )
 
         for class_name in train_loss.keys():
             train_loss[class_name] /= relevant_count[class_name]
@@ -227,183 +735,281 @@ def training(
         msg = f"Epoch {epoch + 1}/{training_params['n_epochs']}\n"
         for i, class_name in enumerate(CLASSES_LIST):
             msg += f"mean loss train {class_name}: {train_loss[class_name]}, "
+        msg += f"train letters/sec: {epoch_letters / (time.time() - epoch_start_time):.1f}, "
         logger.debug(msg[:-2])
 
-        model.eval()
-        dev_loss = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
-        dev_accuracy = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
-        relevant_count = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
-        correct_preds = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
-        un_masks = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
-        predictions = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
-        labels_class = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
-
-        all_nikud_types_correct_preds_letter = 0.0
-
-        letter_count = 0.0
-        correct_words_count = 0.0
-        word_count = 0.0
-        with torch.no_grad():
-            for index_data, data in enumerate(dev_loader):
-                (inputs, attention_mask, labels) = data
-                inputs = inputs.to(device)
-                attention_mask = attention_mask.to(device)
-                labels = labels.to(device)
-
-                nikud_probs, dagesh_probs, sin_probs = model(inputs, attention_mask)
-
-                for i, (probs, class_name) in enumerate(
-                    zip([nikud_probs, dagesh_probs, sin_probs], CLASSES_LIST)
-                ):
-                    reshaped_tensor = (
-                        torch.transpose(probs, 1, 2)
-                        .contiguous()
-                        .view(probs.shape[0], probs.shape[2], probs.shape[1])
-                    )
-                    loss = criteria[class_name](reshaped_tensor, labels[:, :, i]).to(
-                        device
-                    )
-                    un_masked = labels[:, :, i] != -1
-                    num_relevant = un_masked.sum()
-                    relevant_count[class_name] += num_relevant
-                    _, preds = torch.max(probs, 2)
-                    dev_loss[class_name] += loss.item() * num_relevant
-                    correct_preds[class_name] += torch.sum(
-                        preds[un_masked] == labels[:, :, i][un_masked]
-                    )
-                    un_masks[class_name] = un_masked
-                    predictions[class_name] = preds
-                    labels_class[class_name] = labels[:, :, i]
+        if eval_every_steps is None:
+            evaluate_on_dev(epoch, None, epoch + 1)
+        if stop_training:
+            break
+
+    if dev_subsample_loader is not None:
+        # the periodic evaluations ran on a subsample: the final model and the best
+        # one are compared on all the dev data, the better one stays best_model.pth
+        final_state = checkpoint_manager.snapshot(model)
+        final_accuracy, final_loss = evaluate_full_dev(
+            model, dev_loader, criteria, device, metrics_log, epoch, "final", logger
+        )
+        best_accuracy = final_accuracy
+        if best_model is not None and not best_is_current:
+            model.load_state_dict(best_model["model_state_dict"], strict=False)
+            best_accuracy, _ = evaluate_full_dev(
+                model, dev_loader, criteria, device, metrics_log, epoch, "best", logger
+            )
+            model.load_state_dict(final_state, strict=False)
+        no_best = best_model is None and not os.path.exists(
+            os.path.join(output_model_path, BEST_FILE)
+        )
+        if no_best or (not best_is_current and final_accuracy > best_accuracy):
+            logger.info("the final model is the best on all the dev data, saved as best")
+            best_model = {**checkpoint_manager.save_best(epoch, model), "loss": final_loss}
+            best_accuracy = final_accuracy
 
-                un_mask_all_or = torch.logical_or(
-                    torch.logical_or(un_masks["nikud"], un_masks["dagesh"]),
-                    un_masks["sin"],
-                )
+    checkpoint_manager.close()
+    metrics_log.close()
+    return (
+        best_model,
+        best_accuracy,
+        train_epochs_loss_values,
+        {name: list(values) for name, values in train_steps_loss_values.items()},
+        dev_loss_values,
+        dev_accuracy_values,
+    )
 
-                correct = {
-                    class_name: (torch.ones(un_mask_all_or.shape) == 1).to(device)
-                    for class_name in CLASSES_LIST
-                }
 
-                for i, class_name in enumerate(CLASSES_LIST):
-                    correct[class_name][un_masks[class_name]] = (
-                        predictions[class_name][un_masks[class_name]]
-                        == labels_class[class_name][un_masks[class_name]]
-                    )
+def evaluate_full_dev(
+    model, dev_loader, criteria, device, metrics_log, epoch, model_name, logger
+):
+    """
+    Evaluates model on all the dev data after training and logs it to metrics_log.
+
+    Returns:
+        Tuple[float, float]: All nikud types letter accuracy and the last batch loss.
+    """
+    dev_loss, dev_accuracy, letter_accuracy, word_accuracy, loss = evaluate_dev(
+        model, dev_loader, criteria, device
+    )
+    metrics_log.log_full_dev(
+        epoch,
+        dev_loss,
+        {
+            **dev_accuracy,
+            "all_nikud_letter": letter_accuracy,
+            "all_nikud_word": word_accuracy,
+        },
+        model_name,
+    )
+    logger.info(
+        f"Full dev ({model_name} model) all nikud types letter Accuracy: {letter_accuracy}, "
+        f"Full dev word Accuracy: {word_accuracy}"
+    )
+    return letter_accuracy, float(loss)
 
-                letter_correct_mask = torch.logical_and(
-                    torch.logical_and(correct["sin"], correct["dagesh"]),
-                    correct["nikud"],
-                )
-                all_nikud_types_correct_preds_letter += torch.sum(
-                    letter_correct_mask[un_mask_all_or]
-                )
 
-                letter_correct_mask[~un_mask_all_or] = True
-                correct_num, total_words_num = calc_num_correct_words(
-                    inputs.cpu(), letter_correct_mask
-                )
+def evaluate_dev(model, dev_loader, criteria, device="cpu"):
+    """
+    Loss and accuracy of model on the dev data, as tracked by training().
 
-                word_count += total_words_num
-                correct_words_count += correct_num
-                letter_count += un_mask_all_or.sum()
+    Returns:
+        Tuple[dict, dict, float, float, torch.Tensor]: Mean loss and letter accuracy per
+            class, all nikud types letter and word accuracy, and the last batch loss.
+    """
+    model.eval()
+    dev_loss = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
+    dev_accuracy = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
+    relevant_count = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
+    correct_preds = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
+    un_masks = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
+    predictions = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
+    labels_class = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
 
-        for class_name in CLASSES_LIST:
-            dev_loss[class_name] /= relevant_count[class_name]
-            dev_accuracy[class_name] = float(
-                correct_preds[class_name].double() / relevant_count[class_name]
-            )
+    all_nikud_types_correct_preds_letter = 0.0
 
-            dev_loss_values[class_name].append(float(dev_loss[class_name]))
-            dev_accuracy_values[class_name].append(float(dev_accuracy[class_name]))
+    letter_count = 0.0
+    correct_words_count = 0.0
+    word_count = 0.0
+    with torch.no_grad():
+        for index_data, data in enumerate(dev_loader):
+            (inputs, attention_mask, labels) = data
+            inputs = inputs.to(device)
+            attention_mask = attention_mask.to(device)
+            labels = labels.to(device)
 
-        dev_all_nikud_types_accuracy_letter = float(
-            all_nikud_types_correct_preds_letter / letter_count
-        )
+            nikud_probs, dagesh_probs, sin_probs = model(inputs, attention_mask)
 
-        dev_accuracy_values["all_nikud_letter"].append(
-            dev_all_nikud_types_accuracy_letter
-        )
+            for i, (probs, class_name) in enumerate(
+                zip([nikud_probs, dagesh_probs, sin_probs], CLASSES_LIST)
+            ):
+                reshaped_tensor = (
+                    torch.transpose(probs, 1, 2)
+                    .contiguous()
+                    .view(probs.shape[0], probs.shape[2], probs.shape[1])
+                )
+                loss = criteria[class_name](reshaped_tensor, labels[:, :, i]).to(
+                    device
+                )
+                un_masked = labels[:, :, i] != -1
+                num_relevant = un_masked.sum()
+                relevant_count[class_name] += num_relevant
+                _, preds = torch.max(probs, 2)
+                dev_loss[class_name] += loss.item() * num_relevant
+                correct_preds[class_name] += torch.sum(
+                    preds[un_masked] == labels[:, :, i][un_masked]
+                )
+                un_masks[class_name] = un_masked
+                predictions[class_name] = preds
+                labels_class[class_name] = labels[:, :, i]
 
-        word_all_nikud_accuracy = correct_words_count / word_count
-        dev_accuracy_values["all_nikud_word"].append(word_all_nikud_accuracy)
+            un_mask_all_or = torch.logical_or(
+                torch.logical_or(un_masks["nikud"], un_masks["dagesh"]),
+                un_masks["sin"],
+            )
 
-        msg = (
-            f"Epoch {epoch + 1}/{training_params['n_epochs']}\n"
-            f'mean loss Dev nikud: {train_loss["nikud"]}, '
-            f'mean loss Dev dagesh: {train_loss["dagesh"]}, '
-            f'mean loss Dev sin: {train_loss["sin"]}, '
-            f"Dev all nikud types letter Accuracy: {dev_all_nikud_types_accuracy_letter}, "
-            f'Dev nikud letter Accuracy: {dev_accuracy["nikud"]}, '
-            f'Dev dagesh letter Accuracy: {dev_accuracy["dagesh"]}, '
-            f'Dev sin letter Accuracy: {dev_accuracy["sin"]}, '
-            f"Dev word Accuracy: {word_all_nikud_accuracy}"
-        )
-        logger.debug(msg)
+            correct = {
+                class_name: (torch.ones(un_mask_all_or.shape) == 1).to(device)
+                for class_name in CLASSES_LIST
+            }
 
-        save_progress_details(
-            dev_accuracy_values,
-            train_epochs_loss_values,
-            dev_loss_values,
-            train_steps_loss_values,
-        )
+            for i, class_name in enumerate(CLASSES_LIST):
+                correct[class_name][un_masks[class_name]] = (
+                    predictions[class_name][un_masks[class_name]]
+                    == labels_class[class_name][un_masks[class_name]]
+                )
 
-        if dev_all_nikud_types_accuracy_letter > best_accuracy:
-            best_accuracy = dev_all_nikud_types_accuracy_letter
-            best_model = {
-                "epoch": epoch,
-                "model_state_dict": model.state_dict(),
-                "optimizer_state_dict": optimizer.state_dict(),
-                "loss": loss,
-            }
+            letter_correct_mask = torch.logical_and(
+                torch.logical_and(correct["sin"], correct["dagesh"]),
+                correct["nikud"],
+            )
+            all_nikud_types_correct_preds_letter += torch.sum(
+                letter_correct_mask[un_mask_all_or]
+            )
 
-        if epoch % training_params["checkpoints_frequency"] == 0:
-            save_checkpoint_path = os.path.join(
-                output_checkpoints_path, f"checkpoint_model_epoch_{epoch + 1}.pth"
+            letter_correct_mask[~un_mask_all_or] = True
+            correct_num, total_words_num = calc_num_correct_words(
+                inputs.cpu(), letter_correct_mask
             )
-            checkpoint = {
-                "epoch": epoch,
-                "model_state_dict": model.state_dict(),
-                "optimizer_state_dict": optimizer.state_dict(),
-                "loss": loss,
-            }
-            torch.save(checkpoint["model_state_dict"], save_checkpoint_path)
 
-    save_model_path = os.path.join(output_model_path, "best_model.pth")
-    torch.save(best_model["model_state_dict"], save_model_path)
+            word_count += total_words_num
+            correct_words_count += correct_num
+            letter_count += un_mask_all_or.sum()
+
+    for class_name in CLASSES_LIST:
+        dev_loss[class_name] = float(dev_loss[class_name] / relevant_count[class_name])
+        dev_accuracy[class_name] = float(
+            correct_preds[class_name].double() / relevant_count[class_name]
+        )
+
     return (
-        best_model,
-        best_accuracy,
-        train_epochs_loss_values,
-        train_steps_loss_values,
-        dev_loss_values,
-        dev_accuracy_values,
+        dev_loss,
+        dev_accuracy,
+        float(all_nikud_types_correct_preds_letter / letter_count),
+        float(correct_words_count / word_count),
+        loss,
     )
 
 
-def save_progress_details(
-    accuracy_dev_values,
-    epochs_loss_train_values,
-    loss_dev_values,
-    steps_loss_train_values,
+def distillation_loss(
+    student_logits, teacher_logits, labels, hard_loss, temperature, alpha
 ):
-    epochs_data_path = "epochs_data"
-    create_missing_folders(epochs_data_path)
-
-    save_dict_as_json(
-        steps_loss_train_values, epochs_data_path, "steps_loss_train_values.json"
-    )
-    save_dict_as_json(
-        epochs_loss_train_values, epochs_data_path, "epochs_loss_train_values.json"
+    """
+    Blends the soft-label loss against a teacher with the loss against the gold labels.
+
+    Args:
+        student_logits (torch.Tensor): (..., classes) logits of the student, e.g.
+            (batch, length, classes) or packed (num_positions, classes).
+        teacher_logits (torch.Tensor): Logits of the teacher, same shape.
+        labels (torch.Tensor): (...) gold labels, -1 where irrelevant.
+        hard_loss (torch.Tensor): Loss of the student against labels.
+        temperature (float): Softmax temperature of both distributions.
+        alpha (float): Weight of the soft-label loss.
+
+    Returns:
+        torch.Tensor: alpha * T^2 * KL(teacher || student) + (1 - alpha) * hard_loss.
+    """
+    relevant = labels != -1
+    if not relevant.any():
+        return hard_loss
+    soft_loss = F.kl_div(
+        F.log_softmax(student_logits[relevant] / temperature, dim=-1),
+        F.softmax(teacher_logits[relevant] / temperature, dim=-1),
+        reduction="batchmean",
     )
-    save_dict_as_json(loss_dev_values, epochs_data_path, "loss_dev_values.json")
-    save_dict_as_json(accuracy_dev_values, epochs_data_path, "accuracy_dev_values.json")
+    return alpha * temperature**2 * soft_loss + (1 - alpha) * hard_loss
 
 
-def save_dict_as_json(dict, file_path, file_name):
-    json_data = json.dumps(dict, indent=4)
-    with open(os.path.join(file_path, file_name), "w") as json_file:
-        json_file.write(json_data)
+def speed_accuracy_report(models, data_loader, plots_folder, device="cpu"):
+    """
+    Times and scores models on the same data, e.g. a distilled student against its teacher.
+
+    Args:
+        models (Dict[str, torch.nn.Module]): Models by name.
+        data_loader: Batches of (inputs, attention_mask, labels).
+        plots_folder (str): Confusion matrices are saved to a sub folder per model.
+        device (str): Device the models run on.
+
+    Returns:
+        Dict[str, dict]: Parameter count, prediction chars/sec, letter and word accuracy per model.
+    """
+    report = {}
+    for name, model in models.items():
+        model.eval()
+        # every sentence has a start and an end token
+        num_chars = 0
+        for _, attention_mask, _ in data_loader:
+            num_chars += int(attention_mask.sum()) - 2 * attention_mask.shape[0]
+
+        start = time.perf_counter()
+        predict(model, data_loader, device)
+        duration = time.perf_counter() - start
+
+        model_plots_folder = os.path.join(plots_folder, name)
+        create_missing_folders(model_plots_folder)
+        word_level_correct, letter_level_correct = evaluate(
+            model, data_loader, model_plots_folder, device
+        )
+        report[name] = {
+            "parameters": sum(p.numel() for p in model.parameters()),
+            "predict_sec": duration,
+            "chars_per_sec": num_chars / duration if duration > 0 else None,
+            "letter_level_correct": float(letter_level_correct),
+            "word_level_correct": float(word_level_correct),
+        }
+    return report
+
+
+def plot_confusion_matrices(true_labels, predicted_labels, plots_folder=None):
+    """
+    Draws the confusion matrix of every class.
+
+    Args:
+        true_labels (Dict[str, np.ndarray]): Gold labels of the relevant positions, per class.
+        predicted_labels (Dict[str, np.ndarray]): Predicted labels of the same positions.
+        plots_folder (str, optional): Folder of the images, shown when not given.
+    """
+    for i, name in enumerate(CLASSES_LIST):
+        index_labels = np.unique(true_labels[name])
+        cm = confusion_matrix(
+            true_labels[name], predicted_labels[name], labels=index_labels
+        )
+
+        vowel_label = [Nikud.id_2_label[name][l] for l in index_labels]
+        unique_vowels_names = [
+            Nikud.sign_2_name[int(vowel)] for vowel in vowel_label if vowel != "WITHOUT"
+        ]
+        if "WITHOUT" in vowel_label:
+            unique_vowels_names += ["WITHOUT"]
+        cm_df = pd.DataFrame(cm, index=unique_vowels_names, columns=unique_vowels_names)
+
+        # Display confusion matrix
+        plt.figure(figsize=(10, 8))
+        sns.heatmap(cm_df, annot=True, cmap="Blues", fmt="d")
+        plt.title("Confusion Matrix")
+        plt.xlabel("True Label")
+        plt.ylabel("Predicted Label")
+        if plots_folder is None:
+            plt.show()
+        else:
+            plt.savefig(os.path.join(plots_folder, f"Confusion_Matrix_{name}.jpg"))
 
 
 def evaluate(model, test_data, plots_folder=None, device="cpu"):
@@ -520,30 +1126,7 @@ def evaluate(model, test_data, plots_folder=None, device="cpu"):
             dagesh_letter_level_correct += torch.sum(correct_dagesh[not_mask_all_or])
             sin_letter_level_correct += torch.sum(correct_sin[not_mask_all_or])
 
-    for i, name in enumerate(CLASSES_LIST):
-        index_labels = np.unique(true_labels[name])
-        cm = confusion_matrix(
-            true_labels[name], predicted_labels_2_report[name], labels=index_labels
-        )
-
-        vowel_label = [Nikud.id_2_label[name][l] for l in index_labels]
-        unique_vowels_names = [
-            Nikud.sign_2_name[int(vowel)] for vowel in vowel_label if vowel != "WITHOUT"
-        ]
-        if "WITHOUT" in vowel_label:
-            unique_vowels_names += ["WITHOUT"]
-        cm_df = pd.DataFrame(cm, index=unique_vowels_names, columns=unique_vowels_names)
-
-        # Display confusion matrix
-        plt.figure(figsize=(10, 8))
-        sns.heatmap(cm_df, annot=True, cmap="Blues", fmt="d")
-        plt.title("Confusion Matrix")
-        plt.xlabel("True Label")
-        plt.ylabel("Predicted Label")
-        if plots_folder is None:
-            plt.show()
-        else:
-            plt.savefig(os.path.join(plots_folder, f"Confusion_Matrix_{name}.jpg"))
+    plot_confusion_matrices(true_labels, predicted_labels_2_report, plots_folder)
 
     all_nikud_types_letter_level_correct = (
         all_nikud_types_letter_level_correct / letters_count
@@ -559,3 +1142,162 @@ def evaluate(model, test_data, plots_folder=None, device="cpu"):
     print(f"word_level_correct = {all_nikud_types_word_level_correct}")
 
     return all_nikud_types_word_level_correct, all_nikud_types_letter_level_correct
+
+
+SENTENCE_SCORES = [
+    "letters",
+    "correct_letters",
+    "correct_nikud",
+    "correct_dagesh",
+    "correct_sin",
+    "words",
+    "correct_words",
+]
+
+
+def sentence_scores(model, batches, device="cpu", confusion=None, return_confidence=False):
+    """
+    Counts, per sentence, what evaluate() sums over the whole data, so the same
+    forward pass can be scored for any group of sentences afterwards.
+
+    Args:
+        model (torch.nn.Module): Model to score.
+        batches (Iterable): Batches of (inputs, attention_mask, labels); they are
+            not modified, so a list of batches can be scored by several models.
+        device (str): Device the model runs on.
+        confusion (dict, optional): Filled with the "true" and "predicted" labels
+            of the relevant positions of every class, for plot_confusion_matrices().
+        return_confidence (bool): Also return the "confidence" of every sentence,
+            as predict() computes it.
+
+    Returns:
+        Dict[str, np.ndarray]: One count per sentence for every name in SENTENCE_SCORES.
+    """
+    model.to(device)
+    model.eval()
+
+    scores = {name: [] for name in SENTENCE_SCORES}
+    confidences = []
+    true_labels = {class_name: [] for class_name in CLASSES_LIST}
+    predicted_labels = {class_name: [] for class_name in CLASSES_LIST}
+    with torch.no_grad():
+        for inputs, attention_mask, labels in batches:
+            logits = model(inputs.to(device), attention_mask.to(device))
+            labels = labels.to(device)
+
+            correct = {}
+            not_mask_all_or = torch.zeros(labels.shape[:2], dtype=torch.bool).to(device)
+            for i, (probs, class_name) in enumerate(zip(logits, CLASSES_LIST)):
+                not_masked = labels[:, :, i] != -1
+                preds = torch.max(probs, 2).indices
+                correct[class_name] = (preds == labels[:, :, i]) | ~not_masked
+                not_mask_all_or |= not_masked
+                if confusion is not None:
+                    true_labels[class_name].append(labels[:, :, i][not_masked].cpu().numpy())
+                    predicted_labels[class_name].append(preds[not_masked].cpu().numpy())
+
+            if return_confidence:
+                # the positions predict() runs the heads on, from the gold labels
+                mask_cant_be = cant_be_masks(labels)
+                positions = ~mask_cant_be.all(dim=2) & attention_mask.to(device).bool()
+                confidences.append(
+                    sentence_confidence(
+                        tuple(head[positions] for head in logits),
+                        mask_cant_be[positions],
+                        positions,
+                    )
+                    .cpu()
+                    .numpy()
+                )
+
+            letter_correct_mask = torch.logical_and(
+                torch.logical_and(correct["sin"], correct["dagesh"]), correct["nikud"]
+            )
+            scores["letters"].append(not_mask_all_or.sum(1).cpu().numpy())
+            scores["correct_letters"].append(
+                (letter_correct_mask & not_mask_all_or).sum(1).cpu().numpy()
+            )
+            for class_name in CLASSES_LIST:
+                scores[f"correct_{class_name}"].append(
+                    (correct[class_name] & not_mask_all_or).sum(1).cpu().numpy()
+                )
+
+            # calc_num_correct_words overwrites the tokens it is given
+            inputs = inputs.cpu().clone().numpy()
+            letter_correct_mask = letter_correct_mask.cpu().numpy()
+            words_counts = [
+                calc_num_correct_words(inputs[row : row + 1], letter_correct_mask[row : row + 1])
+                for row in range(inputs.shape[0])
+            ]
+            scores["correct_words"].append(np.array([c for c, _ in words_counts]))
+            scores["words"].append(np.array([w for _, w in words_counts]))
+
+    if confusion is not None:
+        for name, labels_per_class in [("true", true_labels), ("predicted", predicted_labels)]:
+            confusion[name] = {
+                class_name: np.concatenate(values) if values else np.zeros(0, np.int64)
+                for class_name, values in labels_per_class.items()
+            }
+    scores = {
+        name: np.concatenate(values).astype(np.int64) if values else np.zeros(0, np.int64)
+        for name, values in scores.items()
+    }
+    if return_confidence:
+        scores["confidence"] = (
+            np.concatenate(confidences) if confidences else np.zeros(0, np.float32)
+        )
+    return scores
+
+
+def sentence_scores_by_length(
+    model, prepared_data, batch_size, device="cpu", confusion=None, return_confidence=False
+):
+    """
+    sentence_scores() on batches of sentences of similar length, returned in the
+    order of the sentences. The batches are built as they are scored, so the
+    padded tensors of the whole data are never held at once.
+    """
+    batches = prepared_data.length_batches(batch_size)
+    scores = sentence_scores(
+        model,
+        prepared_data.loader(batch_size, batch_sampler=batches),
+        device,
+        confusion=confusion,
+        return_confidence=return_confidence,
+    )
+    order = np.concatenate(batches) if batches else np.zeros(0, dtype=np.int64)
+    ordered_scores = {}
+    for name, values in scores.items():
+        ordered_scores[name] = np.empty_like(values)
+        ordered_scores[name][order] = values
+    return ordered_scores
+
+
+def group_accuracy(scores, groups):
+    """
+    Sums sentence_scores() over groups of sentences and turns them into accuracies.
+
+    Args:
+        scores (Dict[str, np.ndarray]): Output of sentence_scores().
+        groups (Dict[str, np.ndarray]): Sentence indices of every group.
+
+    Returns:
+        Dict[str, dict]: Letter and word level accuracy (overall and per class) and counts per group.
+    """
+    results = {}
+    for group, indices in groups.items():
+        totals = {name: int(scores[name][indices].sum()) for name in SENTENCE_SCORES}
+        letters, words = totals["letters"], totals["words"]
+        results[group] = {
+            "letter_level_correct": totals["correct_letters"] / letters if letters else None,
+            "word_level_correct": totals["correct_words"] / words if words else None,
+            **{
+                f"{class_name}_letter_level_correct": (
+                    totals[f"correct_{class_name}"] / letters if letters else None
+                )
+                for class_name in CLASSES_LIST
+            },
+            "letters": letters,
+            "words": words,
+        }
+    return results
@@ -56,3 +56,19 @@ def generate_word_and_letter_accuracy_plot(word_and_letter_accuracy_dict, title,
         plt.show()
     else:
         plt.savefig(os.path.join(plot_folder, 'word_and_letter_accuracy_plot.jpg'))
+
+
+def plot_metrics_log(metrics_log_reader, plot_folder=None):
+    """
+    Draws the training plots from a MetricsLogReader, reading only the records
+    added to its log since the previous call, so it can follow a running training.
+    """
+    metrics_log_reader.update()
+    generate_plot_by_nikud_dagesh_sin_dict(metrics_log_reader.train_epochs_loss_values, "Train epochs loss", "Loss",
+                                           plot_folder)
+    generate_plot_by_nikud_dagesh_sin_dict(metrics_log_reader.train_steps_loss_values, "Train steps loss", "Loss",
+                                           plot_folder)
+    generate_plot_by_nikud_dagesh_sin_dict(metrics_log_reader.dev_loss_values, "Dev epochs loss", "Loss", plot_folder)
+    generate_plot_by_nikud_dagesh_sin_dict(metrics_log_reader.dev_accuracy_values, "Dev accuracy", "Accuracy",
+                                           plot_folder)
+    generate_word_and_letter_accuracy_plot(metrics_log_reader.dev_accuracy_values, "Accuracy", plot_folder)
@@ -0,0 +1,267 @@
+# general
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+from concurrent.futures import Future
+
+from src.instrumentation import get_instrumentation
+from src.utiles_data import extract_text_to_compare_nakdimon
+
+MAX_BATCH_REQUESTS = 32
+BATCH_WAIT_SEC = 0.005
+
+
+def parse_request(line, plain=False):
+    """
+    A request of one line of the serve protocol.
+
+    Args:
+        line (str): A JSON object {"text": ..., "id": ..., "keep_marks": ...,
+            "compare_nakdimon": ...}, or with plain, the text itself.
+        plain (bool): Read the line as the text to diacritize.
+
+    Returns:
+        dict: The request, with a "text".
+    """
+    if plain:
+        return {"text": line.rstrip("\n")}
+    request = json.loads(line)
+    if not isinstance(request, dict) or not isinstance(request.get("text"), str):
+        raise ValueError('a request is a JSON object with a "text" string')
+    return request
+
+
+def format_response(response, plain=False):
+    """The line of a response: JSON, or with plain, the diacritized text."""
+    if plain:
+        return response.get("text", "").replace("\n", " ") + "\n"
+    return json.dumps(response, ensure_ascii=False) + "\n"
+
+
+class BatchingServer:
+    """
+    Runs the requests of every client through one resident Diacritizer.
+
+    Requests queue up and a single worker takes up to max_batch_requests of
+    them at a time, waiting at most batch_wait for the batch to fill, and
+    predicts the segments of all of them in one pass (the same segment once).
+    When a batch fails, its requests are predicted again one by one, so only
+    the failing ones get an error response.
+
+    Args:
+        diacritizer (Diacritizer): The loaded prediction path.
+        max_batch_requests (int): Requests predicted together at most.
+        batch_wait (float): Seconds the worker waits for more requests.
+        logger (logging.Logger, optional): Logger of the failed batches.
+    """
+
+    def __init__(
+        self,
+        diacritizer,
+        max_batch_requests=MAX_BATCH_REQUESTS,
+        batch_wait=BATCH_WAIT_SEC,
+        logger=None,
+    ):
+        self.diacritizer = diacritizer
+        self.max_batch_requests = max_batch_requests
+        self.batch_wait = batch_wait
+        self.logger = logger
+        self.instrumentation = get_instrumentation()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, request):
+        """Queues a request, returns the Future of its response."""
+        future = Future()
+        self._queue.put((request, future))
+        return future
+
+    def close(self):
+        """Stops the worker once the queued requests are done."""
+        self._queue.put(None)
+        self._worker.join()
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch_requests:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=max(remaining, 0))
+            except queue.Empty:
+                break
+            if item is None:
+                # stop after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self.instrumentation.count("serve_batches")
+            self.instrumentation.count("serve_requests", len(batch))
+            for keep_marks in (False, True):
+                group = [
+                    (request, future)
+                    for request, future in batch
+                    if bool(request.get("keep_marks", False)) == keep_marks
+                ]
+                if group:
+                    self._predict(group, keep_marks)
+
+    def _predict(self, group, keep_marks):
+        try:
+            segments = [
+                self.diacritizer.split_text(request["text"]) for request, _ in group
+            ]
+            unique = list(
+                dict.fromkeys(
+                    segment for request_segments in segments for segment in request_segments
+                )
+            )
+            predicted = dict(
+                zip(
+                    unique,
+                    self.diacritizer.predict_segments(unique, keep_marks=keep_marks),
+                )
+            )
+        except Exception as e:
+            if len(group) > 1:
+                # one by one, so only the failing request gets an error
+                if self.logger:
+                    self.logger.exception("serve: batch failed, retrying every request")
+                for item in group:
+                    self._predict([item], keep_marks)
+                return
+            if self.logger:
+                self.logger.exception("serve: request failed")
+            request, future = group[0]
+            future.set_result({"id": request.get("id"), "error": str(e) or repr(e)})
+            return
+        for (request, future), request_segments in zip(group, segments):
+            text = "".join(predicted[segment] for segment in request_segments)
+            if request.get("compare_nakdimon"):
+                text = extract_text_to_compare_nakdimon(text)
+            future.set_result({"id": request.get("id"), "text": text})
+
+
+def serve_stream(server, lines, write, plain=False):
+    """
+    Answers every request line of lines, in order, with write(response line).
+
+    The requests are submitted as they are read and answered by a writer
+    thread, so a client sending many lines gets them batched together.
+    """
+    pending = queue.Queue()
+
+    def write_responses():
+        while True:
+            future = pending.get()
+            if future is None:
+                return
+            write(format_response(future.result(), plain=plain))
+
+    writer = threading.Thread(target=write_responses, daemon=True)
+    writer.start()
+    try:
+        for line in lines:
+            if not line.strip() and not plain:
+                continue
+            try:
+                request = parse_request(line, plain=plain)
+            except ValueError as e:
+                future = Future()
+                future.set_result({"id": None, "error": str(e)})
+            else:
+                future = server.submit(request)
+            pending.put(future)
+    finally:
+        pending.put(None)
+        writer.join()
+
+
+def serve_stdio(server, stdin, stdout, plain=False):
+    """Serves the request lines of stdin until its end, answering on stdout."""
+
+    def write(line):
+        stdout.write(line)
+        stdout.flush()
+
+    serve_stream(server, stdin, write, plain=plain)
+
+
+def socket_in_use(socket_path):
+    """Whether a server answers on the Unix domain socket at socket_path."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+def remove_stale_socket(socket_path):
+    """
+    Removes the socket a stopped server left at socket_path. Fails if the path
+    is not a socket or if a server still answers on it.
+    """
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{socket_path} exists and is not a socket")
+    if socket_in_use(socket_path):
+        raise RuntimeError(f"a server is already serving on {socket_path}")
+    os.remove(socket_path)
+
+
+def serve_unix_socket(server, socket_path, plain=False, logger=None):
+    """
+    Serves the request lines of every connection to a Unix domain socket,
+    until interrupted. Only the user running the server can connect.
+    """
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            lines = (line.decode("utf-8") for line in self.rfile)
+
+            def write(line):
+                self.wfile.write(line.encode("utf-8"))
+                self.wfile.flush()
+
+            serve_stream(server, lines, write, plain=plain)
+
+    remove_stale_socket(socket_path)
+    # the socket is created by bind() with these permissions, before any chmod
+    old_umask = os.umask(0o177)
+    try:
+        unix_server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    finally:
+        os.umask(old_umask)
+    with unix_server:
+        os.chmod(socket_path, 0o600)
+        msg = f"serving on {socket_path}"
+        if logger:
+            logger.info(msg)
+        else:
+            print(msg)
+        try:
+            unix_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
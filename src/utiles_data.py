@@ -1,9 +1,9 @@
 # general
 import os.path
+from array import array
 from datetime import datetime
-from pathlib import Path
 from typing import List, Tuple
-from uuid import uuid1
+import random
 import re
 import glob2
 
@@ -15,12 +15,17 @@ from tqdm import tqdm
 # ML
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    Dataset,
+    Sampler,
+    SequentialSampler,
+)
 
 from src.running_params import DEBUG_MODE, MAX_LENGTH_SEN
 
 matplotlib.use("agg")
-unique_key = str(uuid1())
 
 
 class Nikud:
@@ -290,71 +295,586 @@ class Letter:
         return "לא ידוע ({})".format(hex(ord(letter)))
 
 
+NIKUD_PATTERN = re.compile("[" + "".join(sorted(Nikud.all_nikud_chr)) + "]")
+SENTENCE_END_PATTERN = re.compile(r"[.?!”] |\t")
+SEPARATOR_LINE = "------------------"
+
+
 def text_contains_nikud(text):
-    return len(set(text) & Nikud.all_nikud_chr) > 0
+    return NIKUD_PATTERN.search(text) is not None
 
 
-def combine_sentences(list_sentences, max_length=0, is_train=False):
-    all_new_sentences = []
+CAN_DAGESH = 1
+CAN_SIN = 2
+CAN_NIKUD = 4
+
+
+def capability_code(letter):
+    """Flags of the marks a letter can take, by the rules of Letter.get_label_letter."""
+    l = Letter(letter)
+    return (
+        (CAN_DAGESH if l.can_dagesh(letter) else 0)
+        | (CAN_SIN if l.can_sin(letter) else 0)
+        | (CAN_NIKUD if l.can_nikud(letter) else 0)
+    )
+
+
+# by code point; the letters after the Hebrew block take no mark
+CAPABILITY_TABLE = np.array(
+    [capability_code(chr(code)) for code in range(ord(Letters.hebrew[-1]) + 1)],
+    dtype=np.int8,
+)
+
+
+def capability_codes(text):
+    """int8 capability code of every character of text."""
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    in_table = codes < len(CAPABILITY_TABLE)
+    return np.where(in_table, CAPABILITY_TABLE[np.where(in_table, codes, 0)], 0).astype(
+        np.int8
+    )
+
+
+class _NormalizeTable(dict):
+    """str.translate table of Letter.normalize, filled on first use of every character."""
+
+    def __missing__(self, code):
+        letter = chr(code)
+        self[code] = Letter(letter).normalize(letter)
+        return self[code]
+
+
+NORMALIZE_TABLE = _NormalizeTable()
+STRIP_NIKUD_TABLE = {ord(c): None for c in Nikud.all_nikud_chr}
+
+
+def iter_lines(text):
+    """Yields the lines of text, each keeping its trailing newline."""
+    start = 0
+    end = text.find("\n")
+    while end != -1:
+        yield text[start : end + 1]
+        start = end + 1
+        end = text.find("\n", start)
+    yield text[start:]
+
+
+def split_long_sentence(sen, max_length):
+    """
+    Splits a sentence longer than max_length into parts of at most max_length.
+
+    The sentence is first cut after every sentence ending (". ", "? ", "! ", "” ", tab),
+    then every part that is still too long is cut before its last space.
+    """
+    parts_start = 0
+    for match in SENTENCE_END_PATTERN.finditer(sen):
+        yield from _split_part(sen[parts_start : match.end()], max_length)
+        parts_start = match.end()
+    yield from _split_part(sen[parts_start:], max_length)
+
+
+def _split_part(p, max_length):
+    if len(p) < max_length:
+        yield p
+        return
+    prev = 0
+    while prev <= len(p):
+        part = p[prev : (prev + max_length)]
+        last_space = part.rfind(" ")
+        if last_space == -1:
+            next = prev + max_length
+        else:
+            next = prev + max_length - len(part) + last_space
+        if next <= prev:
+            # the only space opens the window, cut it as is
+            next = prev + max_length
+        yield p[prev:next]
+        prev = next
+
+
+def iter_segments(lines, max_length=0, is_train=False):
+    """
+    Streams the segments the model runs on out of the lines of a text.
+
+    Consecutive lines are merged while the segment stays shorter than max_length,
+    a separator line or an empty line closes the current segment, and lines longer
+    than max_length are split with split_long_sentence. When is_train is set, lines
+    without nikud are dropped and separators are not emitted.
+
+    Args:
+        lines (Iterable[str]): Lines of the text, each keeping its trailing newline.
+        max_length (int): Maximum length of a segment.
+        is_train (bool): Whether the segments are used for training.
+
+    Yields:
+        str: The next segment.
+    """
     new_sen = ""
-    index = 0
-    while index < len(list_sentences):
-        sen = list_sentences[index]
+    for line in lines:
+        queue = [line]
+        index = 0
+        while index < len(queue):
+            sen = queue[index]
+            index += 1
+            contains_nikud = text_contains_nikud(sen)
+
+            if not contains_nikud and (SEPARATOR_LINE in sen or sen == "\n"):
+                if len(new_sen) > 0:
+                    yield new_sen
+                    if not is_train:
+                        yield sen
+                    new_sen = ""
+                    continue
 
-        if not text_contains_nikud(sen) and (
-            "------------------" in sen or sen == "\n"
-        ):
-            if len(new_sen) > 0:
-                all_new_sentences.append(new_sen)
-                if not is_train:
-                    all_new_sentences.append(sen)
-                new_sen = ""
-                index += 1
+            if not contains_nikud and is_train:
                 continue
 
-        if not text_contains_nikud(sen) and is_train:
-            index += 1
-            continue
+            if len(sen) > max_length:
+                queue.extend(split_long_sentence(sen, max_length))
+                continue
 
-        if len(sen) > max_length:
-            update_sen = sen.replace(". ", f". {unique_key}")
-            update_sen = update_sen.replace("? ", f"? {unique_key}")
-            update_sen = update_sen.replace("! ", f"! {unique_key}")
-            update_sen = update_sen.replace("” ", f"” {unique_key}")
-            update_sen = update_sen.replace("\t", f"\t{unique_key}")
-            part_sentence = update_sen.split(unique_key)
-
-            good_parts = []
-            for p in part_sentence:
-                if len(p) < max_length:
-                    good_parts.append(p)
-                else:
-                    prev = 0
-                    while prev <= len(p):
-                        part = p[prev : (prev + max_length)]
-                        last_space = 0
-                        if " " in part:
-                            last_space = part[::-1].index(" ") + 1
-                        next = prev + max_length - last_space
-                        part = p[prev:next]
-                        good_parts.append(part)
-                        prev = next
-            list_sentences = (
-                list_sentences[:index] + good_parts + list_sentences[index + 1 :]
+            if new_sen == "":
+                new_sen = sen
+            elif len(new_sen) + len(sen) < max_length:
+                new_sen += sen
+            else:
+                yield new_sen
+                new_sen = sen
+    if len(new_sen) > 0:
+        yield new_sen
+
+
+def combine_sentences(list_sentences, max_length=0, is_train=False):
+    return list(iter_segments(list_sentences, max_length=max_length, is_train=is_train))
+
+
+class NikudPreparedData(Dataset):
+    """
+    Columnar storage for tokenized sentences.
+
+    Token ids of all sentences are kept in one flat int16 buffer and their
+    (nikud, dagesh, sin) labels in one flat int8 buffer, with an offsets array
+    marking where every sentence starts. Padding is never stored: a row is padded
+    to max_length only when it is read, so a batch costs one allocation.
+    """
+
+    LABELS_PER_TOKEN = 3
+
+    def __init__(self, max_length, pad_token_id=1):
+        self.max_length = max_length
+        self.pad_token_id = pad_token_id
+        self._tokens = array("h")
+        self._labels = array("b")
+        self._offsets = array("q", [0])
+        self.tokens = None
+        self.labels = None
+        self.offsets = None
+
+    def append(self, input_ids, labels):
+        """
+        Adds one sentence.
+
+        Args:
+            input_ids (List[int]): Unpadded token ids, including special tokens.
+            labels (List[List[int]]): One [nikud, dagesh, sin] triplet per token.
+        """
+        assert self.tokens is None, "can't append to finalized data"
+        assert len(input_ids) == len(labels)
+        self._tokens.extend(input_ids)
+        for label in labels:
+            self._labels.extend(label)
+        self._offsets.append(self._offsets[-1] + len(input_ids))
+
+    def finalize(self):
+        self.tokens = np.frombuffer(self._tokens, dtype=np.int16)
+        self.labels = np.frombuffer(self._labels, dtype=np.int8).reshape(
+            -1, self.LABELS_PER_TOKEN
+        )
+        self.offsets = np.frombuffer(self._offsets, dtype=np.int64)
+        return self
+
+    @classmethod
+    def from_arrays(cls, tokens, labels, offsets, max_length, pad_token_id=1):
+        """Finalized data over existing token, label and offset arrays."""
+        prepared = cls(max_length, pad_token_id=pad_token_id)
+        prepared.tokens = np.ascontiguousarray(tokens, dtype=np.int16)
+        prepared.labels = np.ascontiguousarray(labels, dtype=np.int8).reshape(
+            -1, cls.LABELS_PER_TOKEN
+        )
+        prepared.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        return prepared
+
+    def save(self, path):
+        """Writes the finalized arrays to an uncompressed .npz file."""
+        np.savez(path, tokens=self.tokens, labels=self.labels, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, paths, max_length, pad_token_id=1):
+        """
+        Reads and concatenates files written by save().
+
+        Args:
+            paths (List[str]): .npz files, in the order of their sentences.
+            max_length (int): Length every row is padded or truncated to.
+            pad_token_id (int): Token id of the padding.
+        """
+        tokens, labels, lengths = [], [], []
+        for path in paths:
+            with np.load(path) as shard:
+                tokens.append(shard["tokens"])
+                labels.append(shard["labels"])
+                lengths.append(np.diff(shard["offsets"]))
+        lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+        return cls.from_arrays(
+            np.concatenate(tokens) if tokens else np.zeros(0, dtype=np.int16),
+            np.concatenate(labels) if labels else np.zeros((0, 3), dtype=np.int8),
+            np.concatenate([[0], np.cumsum(lengths)]),
+            max_length,
+            pad_token_id=pad_token_id,
+        )
+
+    def subset(self, indices):
+        """Finalized data of the given sentences only, in the given order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        starts, ends = self.offsets[indices], self.offsets[indices + 1]
+        rows = [np.arange(start, end) for start, end in zip(starts, ends)]
+        positions = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        return self.from_arrays(
+            self.tokens[positions],
+            self.labels[positions],
+            np.concatenate([[0], np.cumsum(ends - starts)]),
+            self.max_length,
+            pad_token_id=self.pad_token_id,
+        )
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.tokens.nbytes + self.labels.nbytes + self.offsets.nbytes
+
+    def row(self, idx):
+        """Returns zero-copy views of the unpadded token ids and labels of a sentence."""
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.tokens[start:end], self.labels[start:end]
+
+    def batch(self, indices):
+        """
+        Pads the given sentences into (input_ids, attention_mask, labels) tensors.
+        A batch of windows (lists of indices) is packed by packed_batch().
+        """
+        if len(indices) and isinstance(indices[0], list):
+            return self.packed_batch(indices)
+        batch_size = len(indices)
+        input_ids = torch.full(
+            (batch_size, self.max_length), self.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((batch_size, self.max_length), dtype=torch.long)
+        labels = torch.full(
+            (batch_size, self.max_length, self.LABELS_PER_TOKEN),
+            Nikud.PAD_OR_IRRELEVANT,
+            dtype=torch.long,
+        )
+        for i, idx in enumerate(indices):
+            tokens, row_labels = self.row(idx)
+            length = len(tokens)
+            input_ids[i, :length] = torch.from_numpy(tokens)
+            attention_mask[i, :length] = 1
+            labels[i, :length] = torch.from_numpy(row_labels)
+        return input_ids, attention_mask, labels
+
+    def packed_batch(self, windows):
+        """
+        Packs the sentences of every window one after the other into one row.
+
+        Returns:
+            Tuple[torch.Tensor, ...]: (input_ids, attention_mask, labels, segment_ids),
+                segment_ids numbering the sentences of every row from 1, 0 at the padding.
+                The special tokens between the sentences keep their PAD_OR_IRRELEVANT labels.
+        """
+        batch_size = len(windows)
+        input_ids = torch.full(
+            (batch_size, self.max_length), self.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((batch_size, self.max_length), dtype=torch.long)
+        labels = torch.full(
+            (batch_size, self.max_length, self.LABELS_PER_TOKEN),
+            Nikud.PAD_OR_IRRELEVANT,
+            dtype=torch.long,
+        )
+        segment_ids = torch.zeros((batch_size, self.max_length), dtype=torch.long)
+        for i, window in enumerate(windows):
+            start = 0
+            for segment, idx in enumerate(window, start=1):
+                tokens, row_labels = self.row(idx)
+                end = start + len(tokens)
+                input_ids[i, start:end] = torch.from_numpy(tokens)
+                attention_mask[i, start:end] = 1
+                labels[i, start:end] = torch.from_numpy(row_labels)
+                segment_ids[i, start:end] = segment
+                start = end
+        return input_ids, attention_mask, labels, segment_ids
+
+    def length_batches(self, batch_size):
+        """
+        Batches of the sentences sorted by length: the rows of a batch have about
+        the same length, so a batch trimmed to its longest row holds little padding.
+        """
+        order = np.argsort(self.lengths, kind="stable")
+        return [
+            order[start : start + batch_size].tolist()
+            for start in range(0, len(order), batch_size)
+        ]
+
+    def loader(self, batch_size, batch_sampler=None, with_indices=False):
+        """
+        DataLoader that builds each batch with a single call to batch().
+
+        Args:
+            batch_size (int): Number of sentences per batch, used when no sampler is given.
+            batch_sampler (Sampler, optional): Yields lists of sentence indices.
+            with_indices (bool): Append the sentence indices of every batch to it,
+                as a LongTensor after the tensors of batch().
+        """
+        if batch_sampler is None:
+            batch_sampler = BatchSampler(
+                SequentialSampler(self), batch_size=batch_size, drop_last=False
             )
-            continue
-        if new_sen == "":
-            new_sen = sen
-        elif len(new_sen) + len(sen) < max_length:
-            new_sen += sen
+        dataset = _IndexedBatches(self) if with_indices else self
+        return DataLoader(dataset, sampler=batch_sampler, batch_size=None)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if not -len(self) <= idx < len(self):
+                raise IndexError(idx)
+            input_ids, attention_mask, labels = self.batch([idx % len(self)])
+            return input_ids[0], attention_mask[0], labels[0]
+        if isinstance(idx, slice):
+            idx = range(*idx.indices(len(self)))
+        return self.batch(idx)
+
+
+class _IndexedBatches(Dataset):
+    """The batches of a NikudPreparedData, each followed by its sentence indices."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, indices):
+        return (*self.data.batch(indices), torch.as_tensor(indices, dtype=torch.long))
+
+
+def pack_windows(lengths, window_length):
+    """
+    Best fit decreasing packing of sentences into windows of window_length tokens.
+
+    Args:
+        lengths (np.ndarray): Number of tokens of every sentence, each at most window_length.
+        window_length (int): Tokens in a window.
+
+    Returns:
+        List[List[int]]: The indices of the sentences of every window.
+    """
+    windows = []
+    # windows by the number of tokens still free in them
+    free = [[] for _ in range(window_length + 1)]
+    for idx in np.argsort(-np.asarray(lengths), kind="stable"):
+        length = int(lengths[idx])
+        space = next(
+            (space for space in range(length, window_length + 1) if free[space]), None
+        )
+        if space is None:
+            window = len(windows)
+            windows.append([])
+            space = window_length
         else:
-            all_new_sentences.append(new_sen)
-            new_sen = sen
+            window = free[space].pop()
+        windows[window].append(int(idx))
+        free[space - length].append(window)
+    return windows
 
-        index += 1
-    if len(new_sen) > 0:
-        all_new_sentences.append(new_sen)
-    return all_new_sentences
+
+class PackedBatchSampler(Sampler):
+    """
+    Training batches of windows, each packing several sentences into one row of
+    window_length tokens, so the rows hold little padding. The sentences are
+    packed once; every epoch shuffles the windows.
+
+    Args:
+        lengths (np.ndarray): Number of tokens of every sentence.
+        window_length (int): Tokens in a window, the max_length of the data.
+        batch_size (int): Windows per batch.
+        seed (int): Seed of the shuffling.
+    """
+
+    def __init__(self, lengths, window_length, batch_size, seed=0):
+        self.windows = pack_windows(lengths, window_length)
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+        self.fill_ratio = float(np.sum(lengths)) / max(len(self.windows) * window_length, 1)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        order = rng.permutation(len(self.windows))
+        self.epoch += 1
+        for start in range(0, len(order), self.batch_size):
+            yield [self.windows[window] for window in order[start : start + self.batch_size]]
+
+    def __len__(self):
+        return (len(self.windows) + self.batch_size - 1) // self.batch_size
+
+
+class NikudInferenceData(NikudPreparedData):
+    """
+    Tokenized sentences to predict. Instead of labels, every token keeps the
+    capability code of its original letter (CAN_DAGESH | CAN_SIN | CAN_NIKUD),
+    from which predict() masks the marks the letter can't take.
+    """
+
+    LABELS_PER_TOKEN = 1
+
+    def append(self, input_ids, capabilities):
+        """
+        Adds one sentence.
+
+        Args:
+            input_ids (List[int]): Unpadded token ids, including special tokens.
+            capabilities (np.ndarray): int8 capability code of every token.
+        """
+        assert self.tokens is None, "can't append to finalized data"
+        assert len(input_ids) == len(capabilities)
+        self._tokens.extend(input_ids)
+        self._labels.frombytes(np.asarray(capabilities, dtype=np.int8).tobytes())
+        self._offsets.append(self._offsets[-1] + len(input_ids))
+
+    def batch(self, indices):
+        """Pads the given sentences into (input_ids, attention_mask, capabilities) tensors."""
+        batch_size = len(indices)
+        input_ids = torch.full(
+            (batch_size, self.max_length), self.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((batch_size, self.max_length), dtype=torch.long)
+        capabilities = torch.zeros((batch_size, self.max_length), dtype=torch.int8)
+        for i, idx in enumerate(indices):
+            tokens, row_capabilities = self.row(idx)
+            length = len(tokens)
+            input_ids[i, :length] = torch.from_numpy(tokens)
+            attention_mask[i, :length] = 1
+            capabilities[i, :length] = torch.from_numpy(row_capabilities[:, 0])
+        return input_ids, attention_mask, capabilities
+
+
+class HardExampleBatchSampler(Sampler):
+    """
+    Training batches that oversample the sentences with the highest recent loss.
+
+    training() records the loss of every sentence it trains on; each epoch draws
+    hard_fraction of its sentences with probability proportional to that loss and
+    the rest uniformly without replacement. With curriculum_epochs, the first
+    epochs only draw from the easiest sentences (by length and loss), a pool
+    growing from curriculum_start of the data to all of it.
+
+    The loader of the training data returns the sentence indices with every
+    batch (loader(with_indices=True)), so the losses reach their sentences in
+    any DataLoader setup.
+
+    Args:
+        lengths (np.ndarray): Number of tokens of every sentence.
+        batch_size (int): Number of sentences per batch.
+        hard_fraction (float): Share of every epoch drawn by loss.
+        curriculum_epochs (int): Number of epochs until all sentences are drawn from.
+        curriculum_start (float): Share of the easiest sentences drawn from at the first epoch.
+        loss_decay (float): Weight of the previous loss of a sentence when a new one is recorded.
+        seed (int): Seed of the draws.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        hard_fraction=0.5,
+        curriculum_epochs=0,
+        curriculum_start=0.3,
+        loss_decay=0.5,
+        seed=0,
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.hard_fraction = hard_fraction
+        self.curriculum_epochs = curriculum_epochs
+        self.curriculum_start = curriculum_start
+        self.loss_decay = loss_decay
+        self.losses = np.full(len(self.lengths), np.nan, dtype=np.float32)
+        self.epoch = 0
+        self.rng = np.random.default_rng(seed)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def record_losses(self, indices, losses):
+        indices = np.asarray(indices)
+        losses = np.asarray(losses, dtype=np.float32)
+        previous = self.losses[indices]
+        self.losses[indices] = np.where(
+            np.isnan(previous),
+            losses,
+            self.loss_decay * previous + (1 - self.loss_decay) * losses,
+        )
+
+    def _known_losses(self):
+        # a sentence not trained on yet counts as the hardest one, so it gets drawn
+        if np.isnan(self.losses).all():
+            return np.ones(len(self.losses), dtype=np.float32)
+        return np.where(np.isnan(self.losses), np.nanmax(self.losses), self.losses)
+
+    def _pool(self):
+        if self.epoch >= self.curriculum_epochs:
+            return np.arange(len(self.lengths))
+        share = self.curriculum_start + (1 - self.curriculum_start) * (
+            self.epoch / self.curriculum_epochs
+        )
+        size = min(len(self.lengths), max(self.batch_size, int(share * len(self.lengths))))
+        length_rank = np.argsort(np.argsort(self.lengths, kind="stable"), kind="stable")
+        loss_rank = np.argsort(np.argsort(self._known_losses(), kind="stable"), kind="stable")
+        return np.argsort(length_rank + loss_rank, kind="stable")[:size]
+
+    def __iter__(self):
+        pool = self._pool()
+        num_hard = int(round(len(pool) * self.hard_fraction))
+        uniform = self.rng.permutation(pool)[: len(pool) - num_hard]
+        losses = self._known_losses()[pool].astype(np.float64)
+        p = losses / losses.sum() if losses.sum() > 0 else None
+        hard = self.rng.choice(pool, size=num_hard, replace=True, p=p)
+        order = self.rng.permutation(np.concatenate([uniform, hard]))
+        for start in range(0, len(order), self.batch_size):
+            yield order[start : start + self.batch_size].tolist()
+
+    def __len__(self):
+        return -(-len(self._pool()) // self.batch_size)
+
+    def state_dict(self):
+        return {
+            "losses": torch.from_numpy(self.losses.copy()),
+            "epoch": self.epoch,
+            "rng": self.rng.bit_generator.state,
+        }
+
+    def load_state_dict(self, state):
+        self.losses = state["losses"].numpy().copy()
+        self.epoch = state["epoch"]
+        self.rng.bit_generator.state = state["rng"]
 
 
 class NikudDataset(Dataset):
@@ -366,16 +886,26 @@ class NikudDataset(Dataset):
         logger=None,
         max_length=0,
         is_train=False,
+        files=None,
     ):
         self.max_length = max_length
         self.tokenizer = tokenizer
         self.is_train = is_train
         self.data = None
         self.origin_data = None
+        # marks already in a text read with read_inference_text(keep_marks=True)
+        self.existing_labels = None
+        # source file of every sentence: self.files[self.sentence_files[i]]
+        self.files = []
+        self.sentence_files = np.zeros(0, dtype=np.int32)
         if folder is not None:
             self.data, self.origin_data = self.read_data_folder(folder, logger)
+        elif files is not None:
+            self.data, self.origin_data = self.read_data_files(files, logger)
         elif file is not None:
             self.data, self.origin_data = self.read_data(file, logger)
+            self.files = [file]
+            self.sentence_files = np.zeros(len(self.data), dtype=np.int32)
         self.prepered_data = None
 
     def read_data_folder(self, folder_path: str, logger=None):
@@ -385,16 +915,23 @@ class NikudDataset(Dataset):
             logger.debug(msg)
         else:
             print(msg)
-        all_data = []
-        all_origin_data = []
         if DEBUG_MODE:
             all_files = all_files[0:2]
+        return self.read_data_files(all_files, logger)
+
+    def read_data_files(self, all_files, logger=None):
+        all_data = []
+        all_origin_data = []
+        sentence_files = array("i")
         for file in all_files:
             if "not_use" in file or "NakdanResults" in file:
                 continue
             data, origin_data = self.read_data(file, logger)
             all_data.extend(data)
             all_origin_data.extend(origin_data)
+            sentence_files.extend([len(self.files)] * len(data))
+            self.files.append(file)
+        self.sentence_files = np.array(sentence_files, dtype=np.int32)
         return all_data, all_origin_data
 
     def read_data(self, filepath: str, logger=None) -> List[Tuple[str, list]]:
@@ -461,12 +998,23 @@ class NikudDataset(Dataset):
         #     logger.debug(msg)
         # else:
         #     print(msg)
-        data = []
-        orig_data = []
         # with open(filepath, "r", encoding="utf-8") as file:
         #     file_data = file.read()
-        data_list = self.split_text(text)
-        # print("data_list", data_list)
+        return self.read_single_segments(self.split_text(text))
+
+    def read_single_segments(
+        self, data_list, drop_orphan_marks=False
+    ) -> List[Tuple[str, list]]:
+        """
+        Parses segments of split_text() with their marks into Letter objects.
+
+        Args:
+            data_list (List[str]): The segments.
+            drop_orphan_marks (bool): Drop the marks that don't follow a Hebrew
+                letter (e.g. after a digit) instead of failing on them.
+        """
+        data = []
+        orig_data = []
         for sen in tqdm(data_list, desc=f"Source: {data}"):
             if sen == "":
                 continue
@@ -488,7 +1036,7 @@ class NikudDataset(Dataset):
                 label = []
                 l = Letter(sen[index])
                 if not (l.letter not in Nikud.all_nikud_chr):
-                    if sen[index - 1] == "\n":
+                    if drop_orphan_marks or sen[index - 1] == "\n":
                         index += 1
                         continue
                 assert l.letter not in Nikud.all_nikud_chr
@@ -514,114 +1062,97 @@ class NikudDataset(Dataset):
         self.origin_data = orig_data
         return data, orig_data
 
+    def add_replay_data(self, files, num_sentences, logger=None, seed=0):
+        """
+        Adds a random sample of num_sentences sentences from files, reading only as
+        many of the files (in a seeded random order) as the sample needs.
+        """
+        rnd = random.Random(seed)
+        files = list(files)
+        rnd.shuffle(files)
+        replay_data, replay_origin_data, replay_files = [], [], []
+        for file in files:
+            if len(replay_data) >= num_sentences:
+                break
+            data, origin_data = self.read_data(file, logger)
+            replay_data.extend(data)
+            replay_origin_data.extend(origin_data)
+            replay_files.extend([len(self.files)] * len(data))
+            self.files.append(file)
+        sample = sorted(rnd.sample(range(len(replay_data)), min(num_sentences, len(replay_data))))
+        self.data.extend(replay_data[i] for i in sample)
+        self.origin_data.extend(replay_origin_data[i] for i in sample)
+        self.sentence_files = np.concatenate(
+            [self.sentence_files, np.array([replay_files[i] for i in sample], dtype=np.int32)]
+        )
+        return len(sample)
+
     def split_text(self, file_data):
-        file_data = file_data.replace("\n", f"\n{unique_key}")
-        data_list = file_data.split(unique_key)
-        data_list = combine_sentences(
-            data_list, is_train=self.is_train, max_length=MAX_LENGTH_SEN
+        return list(
+            iter_segments(
+                iter_lines(file_data), max_length=MAX_LENGTH_SEN, is_train=self.is_train
+            )
         )
-        return data_list
 
     def show_data_labels(self, plots_folder=None):
-        nikud = [
-            Nikud.id_2_label["nikud"][label.nikud]
-            for _, label_list in self.data
-            for label in label_list
-            if label.nikud != -1
-        ]
-        dagesh = [
-            Nikud.id_2_label["dagesh"][label.dagesh]
-            for _, label_list in self.data
-            for label in label_list
-            if label.dagesh != -1
-        ]
-        sin = [
-            Nikud.id_2_label["sin"][label.sin]
-            for _, label_list in self.data
-            for label in label_list
-            if label.sin != -1
-        ]
-
-        vowels = nikud + dagesh + sin
-        unique_vowels, label_counts = np.unique(vowels, return_counts=True)
-        unique_vowels_names = [
-            Nikud.sign_2_name[int(vowel)]
-            for vowel in unique_vowels
-            if vowel != "WITHOUT"
-        ] + ["WITHOUT"]
-        fig, ax = plt.subplots(figsize=(16, 6))
-
-        bar_positions = np.arange(len(unique_vowels))
-        bar_width = 0.15
-        ax.bar(bar_positions, list(label_counts), bar_width)
-
-        ax.set_title("Distribution of Vowels in dataset")
-        ax.set_xlabel("Vowels")
-        ax.set_ylabel("Count")
-        ax.legend(loc="right", bbox_to_anchor=(1, 0.85))
-        ax.set_xticks(bar_positions)
-        ax.set_xticklabels(unique_vowels_names, rotation=30, ha="right", fontsize=8)
-
-        if plots_folder is None:
-            plt.show()
-        else:
-            plt.savefig(os.path.join(plots_folder, "show_data_labels.jpg"))
+        plot_label_histograms(label_histograms(self.data), plots_folder=plots_folder)
 
     def calc_max_length(self, maximum=MAX_LENGTH_SEN):
         if self.max_length > maximum:
             self.max_length = maximum
         return self.max_length
 
-    def prepare_data(self, name="train"):
-        dataset = []
-        for index, (sentence, label) in tqdm(
-            enumerate(self.data), desc=f"prepare data {name}"
-        ):
-            encoded_sequence = self.tokenizer.encode_plus(
-                sentence,
-                add_special_tokens=True,
-                max_length=self.max_length,
-                padding="max_length",
-                truncation=True,
-                return_attention_mask=True,
-                return_tensors="pt",
-            )
-            label_lists = [
-                [letter.nikud, letter.dagesh, letter.sin] for letter in label
-            ]
-            label = torch.tensor(
-                [
-                    [
-                        Nikud.PAD_OR_IRRELEVANT,
-                        Nikud.PAD_OR_IRRELEVANT,
-                        Nikud.PAD_OR_IRRELEVANT,
-                    ]
-                ]
-                + label_lists[: (self.max_length - 1)]
-                + [
-                    [
-                        Nikud.PAD_OR_IRRELEVANT,
-                        Nikud.PAD_OR_IRRELEVANT,
-                        Nikud.PAD_OR_IRRELEVANT,
-                    ]
-                    for i in range(self.max_length - len(label) - 1)
-                ]
-            )
+    def read_inference_text(self, text, keep_marks=False):
+        """
+        Reads text to predict: the marks already in it are dropped and neither
+        Letter objects nor labels are built.
+
+        Args:
+            text (str): Text to predict.
+            keep_marks (bool): Parse the marks already in the text instead, into
+                self.existing_labels, for predict_keeping_marks().
+
+        Returns:
+            Tuple[List[Tuple[str, None]], List[str]]: The normalized sentences
+                (without labels) and the original ones.
+        """
+        return self.read_inference_segments(self.split_text(text), keep_marks)
+
+    def read_inference_segments(self, segments, keep_marks=False):
+        """read_inference_text() of a text already split by split_text()."""
+        if keep_marks:
+            data, _ = self.read_single_segments(segments, drop_orphan_marks=True)
+            self.existing_labels = existing_label_rows(data, self.max_length)
+            self.data = [(sentence, None) for sentence, _ in data]
+            return self.data, self.origin_data
+        self.origin_data = [
+            sen.translate(STRIP_NIKUD_TABLE) for sen in segments if sen != ""
+        ]
+        self.data = [(sen.translate(NORMALIZE_TABLE), None) for sen in self.origin_data]
+        return self.data, self.origin_data
 
-            dataset.append(
-                (
-                    encoded_sequence["input_ids"][0],
-                    encoded_sequence["attention_mask"][0],
-                    label,
-                )
-            )
+    def prepare_data(self, name="train"):
+        self.prepered_data = prepare_sentences(
+            self.tokenizer, self.data, self.max_length, name=name
+        )
 
-        self.prepered_data = dataset
+    def prepare_inference_data(self, name="inference"):
+        self.prepered_data = prepare_inference_sentences(
+            self.tokenizer,
+            [sentence for sentence, _ in self.data],
+            self.origin_data,
+            self.max_length,
+            name=name,
+        )
 
     def back_2_text(self, labels):
+        return "".join(self.back_2_sentences(labels))
+
+    def back_2_sentences(self, labels):
+        """The text of every sentence with its predicted marks."""
         nikud = Nikud()
-        all_text = ""
-        for indx_sentance, (input_ids, _, label) in enumerate(self.prepered_data):
+        sentences = []
+        for indx_sentance in range(len(self.prepered_data)):
             new_line = ""
             for indx_char, c in enumerate(self.origin_data[indx_sentance]):
                 new_line += (
@@ -630,14 +1161,185 @@ class NikudDataset(Dataset):
                     + nikud.id_2_char(labels[indx_sentance, indx_char + 1, 2], "sin")
                     + nikud.id_2_char(labels[indx_sentance, indx_char + 1, 0], "nikud")
                 )
-            all_text += new_line
-        return all_text
+            sentences.append(new_line)
+        return sentences
 
     def __len__(self):
-        return self.data.shape[0]
+        return len(self.data)
 
     def __getitem__(self, idx):
-        row = self.data[idx]
+        if self.prepered_data is None:
+            return self.data[idx]
+        return self.prepered_data[idx]
+
+
+def prepare_sentences(tokenizer, data, max_length, name="train"):
+    """
+    Tokenizes parsed sentences into a NikudPreparedData.
+
+    Args:
+        tokenizer: Character level tokenizer (one token per letter).
+        data (List[Tuple[str, List[Letter]]]): Normalized sentences and their letters.
+        max_length (int): Length every row is padded or truncated to.
+        name (str): Name shown in the progress bar.
+
+    Returns:
+        NikudPreparedData: The finalized columnar dataset.
+    """
+    prepared = NikudPreparedData(max_length, pad_token_id=tokenizer.pad_token_id)
+    for sentence, label in tqdm(data, desc=f"prepare data {name}"):
+        input_ids = tokenizer.encode_plus(
+            sentence,
+            add_special_tokens=True,
+            max_length=max_length,
+            truncation=True,
+        )["input_ids"]
+        label_lists = (
+            [[Nikud.PAD_OR_IRRELEVANT] * 3]
+            + [[letter.nikud, letter.dagesh, letter.sin] for letter in label]
+            + [[Nikud.PAD_OR_IRRELEVANT] * 3] * len(input_ids)
+        )
+        prepared.append(input_ids, label_lists[: len(input_ids)])
+    return prepared.finalize()
+
+
+def label_array(data):
+    """
+    Labels of every parsed letter as one compact array.
+
+    Args:
+        data (List[Tuple[str, List[Letter]]]): Normalized sentences and their letters.
+
+    Returns:
+        np.ndarray: int8 array of shape (num_letters, 3), the nikud, dagesh and sin label ids.
+    """
+    labels = np.fromiter(
+        (
+            label_id
+            for _, letters in data
+            for letter in letters
+            for label_id in (letter.nikud, letter.dagesh, letter.sin)
+        ),
+        dtype=np.int8,
+    )
+    return labels.reshape(-1, 3)
+
+
+def existing_label_rows(data, max_length):
+    """
+    Labels of parsed sentences laid out as predict() returns them: one row of
+    max_length per sentence, the start token and the padding PAD_OR_IRRELEVANT.
+
+    Args:
+        data (List[Tuple[str, List[Letter]]]): Normalized sentences and their letters.
+        max_length (int): Length of the rows, start token included.
+
+    Returns:
+        np.ndarray: (sentences, max_length, 3) int8 labels.
+    """
+    rows = np.full((len(data), max_length, 3), Nikud.PAD_OR_IRRELEVANT, dtype=np.int8)
+    labels = label_array(data)
+    start = 0
+    for index, (sentence, _) in enumerate(data):
+        length = min(len(sentence), max_length - 2)
+        rows[index, 1 : 1 + length] = labels[start : start + length]
+        start += len(sentence)
+    return rows
+
+
+WITHOUT_LABELS = np.array(
+    [Nikud.label_2_id[name]["WITHOUT"] for name in ["nikud", "dagesh", "sin"]],
+    dtype=np.int8,
+)
+
+
+def marked_labels(labels):
+    """Bool mask of the labels of (..., 3) that hold a mark, neither WITHOUT nor PAD_OR_IRRELEVANT."""
+    return (labels != Nikud.PAD_OR_IRRELEVANT) & (labels != WITHOUT_LABELS)
+
+
+def label_histograms(data):
+    """
+    Counts every label id of every class with one bincount per class.
+
+    Returns:
+        Dict[str, np.ndarray]: Count of every label id, by class. The
+            PAD_OR_IRRELEVANT positions are not counted.
+    """
+    return array_label_histograms(label_array(data))
+
+
+def array_label_histograms(labels):
+    """label_histograms() of a (num_letters, 3) label array; PAD_OR_IRRELEVANT labels are not counted."""
+    histograms = {}
+    for i, name in enumerate(["nikud", "dagesh", "sin"]):
+        column = labels[:, i]
+        histograms[name] = np.bincount(
+            column[column != Nikud.PAD_OR_IRRELEVANT],
+            minlength=len(Nikud.label_2_id[name]),
+        )
+    return histograms
+
+
+def plot_label_histograms(histograms, plots_folder=None):
+    """Bar plot of the labels of all the classes, the WITHOUT labels of all classes in one bar."""
+    counts = {}
+    for name, histogram in histograms.items():
+        for label_id, count in enumerate(histogram):
+            label = Nikud.id_2_label[name][label_id]
+            counts[label] = counts.get(label, 0) + int(count)
+    signs = sorted(sign for sign, count in counts.items() if sign != "WITHOUT" and count)
+    names = [Nikud.sign_2_name[sign] for sign in signs] + ["WITHOUT"]
+    label_counts = [counts[sign] for sign in signs] + [counts.get("WITHOUT", 0)]
+
+    fig, ax = plt.subplots(figsize=(16, 6))
+
+    bar_positions = np.arange(len(names))
+    bar_width = 0.15
+    ax.bar(bar_positions, label_counts, bar_width)
+
+    ax.set_title("Distribution of Vowels in dataset")
+    ax.set_xlabel("Vowels")
+    ax.set_ylabel("Count")
+    ax.set_xticks(bar_positions)
+    ax.set_xticklabels(names, rotation=30, ha="right", fontsize=8)
+
+    if plots_folder is None:
+        plt.show()
+    else:
+        plt.savefig(os.path.join(plots_folder, "show_data_labels.jpg"))
+    plt.close(fig)
+
+
+def prepare_inference_sentences(
+    tokenizer, sentences, origin_sentences, max_length, name="inference"
+):
+    """
+    Tokenizes sentences to predict into a NikudInferenceData.
+
+    Args:
+        tokenizer: Character level tokenizer (one token per letter).
+        sentences (List[str]): Normalized sentences.
+        origin_sentences (List[str]): The same sentences before normalization,
+            whose letters decide which marks every token can take.
+        max_length (int): Length every row is padded or truncated to.
+        name (str): Name shown in the progress bar.
+    """
+    prepared = NikudInferenceData(max_length, pad_token_id=tokenizer.pad_token_id)
+    for sentence, origin in tqdm(
+        zip(sentences, origin_sentences), total=len(sentences), desc=f"prepare data {name}"
+    ):
+        input_ids = tokenizer.encode_plus(
+            sentence,
+            add_special_tokens=True,
+            max_length=max_length,
+            truncation=True,
+        )["input_ids"]
+        capabilities = np.zeros(len(input_ids), dtype=np.int8)
+        codes = capability_codes(origin)[: max(len(input_ids) - 1, 0)]
+        capabilities[1 : 1 + len(codes)] = codes
+        prepared.append(input_ids, capabilities)
+    return prepared.finalize()
 
 
 def get_sub_folders_paths(main_folder):
@@ -656,82 +1358,95 @@ def create_missing_folders(folder_path):
         os.makedirs(folder_path)
 
 
-def info_folder(folder, num_files, num_hebrew_letters):
-    """
-    Recursively counts the number of files and the number of Hebrew letters in all subfolders of the given folder path.
-
-    Args:
-        folder (str): The path of the folder to be analyzed.
-        num_files (int): The running total of the number of files encountered so far.
-        num_hebrew_letters (int): The running total of the number of Hebrew letters encountered so far.
-
-    Returns:
-        Tuple[int, int]: A tuple containing the total number of files and the total number of Hebrew letters.
-    """
-    for filename in os.listdir(folder):
-        file_path = os.path.join(folder, filename)
-        if filename.lower().endswith(".txt") and os.path.isfile(file_path):
-            num_files += 1
-            dataset = NikudDataset(None, file=file_path)
-            for line in dataset.data:
-                for c in line[0]:
-                    if c in Letters.hebrew:
-                        num_hebrew_letters += 1
-
-        elif os.path.isdir(file_path) and filename != ".git":
-            sub_folder = file_path
-            n1, n2 = info_folder(sub_folder, num_files, num_hebrew_letters)
-            num_files += n1
-            num_hebrew_letters += n2
-    return num_files, num_hebrew_letters
+def _nikud_chr(name):
+    return chr(Nikud.nikud_dict[name])
+
+
+# the rewrite rules of extract_text_to_compare_nakdimon, applied in order.
+# a rule is either (old, new) for str.replace or (compiled pattern, new) for re.sub
+COMPARE_NAKDIMON_RULES = [
+    ("|", ""),
+    (
+        _nikud_chr("KUBUTZ") + "ו" + _nikud_chr("METEG"),
+        "ו" + _nikud_chr("DAGESH OR SHURUK"),
+    ),
+    (_nikud_chr("HOLAM") + "ו" + _nikud_chr("METEG"), "ו"),
+    ("ו" + _nikud_chr("HOLAM") + _nikud_chr("KAMATZ"), "ו" + _nikud_chr("KAMATZ")),
+    (_nikud_chr("METEG"), ""),
+    (
+        _nikud_chr("KAMATZ") + _nikud_chr("HIRIK"),
+        _nikud_chr("KAMATZ") + "י" + _nikud_chr("HIRIK"),
+    ),
+    (
+        _nikud_chr("PATAKH") + _nikud_chr("HIRIK"),
+        _nikud_chr("PATAKH") + "י" + _nikud_chr("HIRIK"),
+    ),
+    (_nikud_chr("PUNCTUATION MAQAF"), ""),
+    (_nikud_chr("PUNCTUATION PASEQ"), ""),
+    (_nikud_chr("KAMATZ_KATAN"), _nikud_chr("KAMATZ")),
+    (re.compile(_nikud_chr("KUBUTZ") + "ו" + "(?=[א-ת])"), "ו"),
+    (_nikud_chr("REDUCED_KAMATZ") + "ו", "ו"),
+    (_nikud_chr("DAGESH OR SHURUK") * 2, _nikud_chr("DAGESH OR SHURUK")),
+    ("\u05be", "-"),
+    (
+        "י"
+        + _nikud_chr("SHVA")
+        + "הו"
+        + _nikud_chr("HOLAM")
+        + _nikud_chr("KAMATZ")
+        + "ה",
+        "יהוה",
+    ),
+]
+COMPARE_NAKDIMON_CHUNK_SIZE = 1 << 16
+# characters of a text without whitespace held before it is cut elsewhere
+COMPARE_NAKDIMON_MAX_REST = 4 * COMPARE_NAKDIMON_CHUNK_SIZE
+# the last whitespace of a chunk, the text is cut after it
+_LAST_WHITESPACE = re.compile(r"\s\S*\Z")
+# the last character that no rule reads or writes (the rules only touch the
+# Hebrew block and "|"), the text can be cut before it too
+_LAST_OUTSIDE_RULES = re.compile(r"[^\u0590-\u05ff|][\u0590-\u05ff|]*\Z")
 
 
 def extract_text_to_compare_nakdimon(text):
-    res = text.replace("|", "")
-    res = res.replace(
-        chr(Nikud.nikud_dict["KUBUTZ"]) + "ו" + chr(Nikud.nikud_dict["METEG"]),
-        "ו" + chr(Nikud.nikud_dict["DAGESH OR SHURUK"]),
-    )
-    res = res.replace(
-        chr(Nikud.nikud_dict["HOLAM"]) + "ו" + chr(Nikud.nikud_dict["METEG"]), "ו"
-    )
-    res = res.replace(
-        "ו" + chr(Nikud.nikud_dict["HOLAM"]) + chr(Nikud.nikud_dict["KAMATZ"]),
-        "ו" + chr(Nikud.nikud_dict["KAMATZ"]),
-    )
-    res = res.replace(chr(Nikud.nikud_dict["METEG"]), "")
-    res = res.replace(
-        chr(Nikud.nikud_dict["KAMATZ"]) + chr(Nikud.nikud_dict["HIRIK"]),
-        chr(Nikud.nikud_dict["KAMATZ"]) + "י" + chr(Nikud.nikud_dict["HIRIK"]),
-    )
-    res = res.replace(
-        chr(Nikud.nikud_dict["PATAKH"]) + chr(Nikud.nikud_dict["HIRIK"]),
-        chr(Nikud.nikud_dict["PATAKH"]) + "י" + chr(Nikud.nikud_dict["HIRIK"]),
-    )
-    res = res.replace(chr(Nikud.nikud_dict["PUNCTUATION MAQAF"]), "")
-    res = res.replace(chr(Nikud.nikud_dict["PUNCTUATION PASEQ"]), "")
-    res = res.replace(
-        chr(Nikud.nikud_dict["KAMATZ_KATAN"]), chr(Nikud.nikud_dict["KAMATZ"])
-    )
+    res = text
+    for old, new in COMPARE_NAKDIMON_RULES:
+        if isinstance(old, str):
+            res = res.replace(old, new)
+        else:
+            res = old.sub(new, res)
+    return res
 
-    res = re.sub(chr(Nikud.nikud_dict["KUBUTZ"]) + "ו" + "(?=[א-ת])", "ו", res)
-    res = res.replace(chr(Nikud.nikud_dict["REDUCED_KAMATZ"]) + "ו", "ו")
 
-    res = res.replace(
-        chr(Nikud.nikud_dict["DAGESH OR SHURUK"]) * 2,
-        chr(Nikud.nikud_dict["DAGESH OR SHURUK"]),
-    )
-    res = res.replace("\u05be", "-")
-    res = res.replace("יְהוָֹה", "יהוה")
+def iter_extract_text_to_compare_nakdimon(chunks):
+    """
+    Streaming version of extract_text_to_compare_nakdimon.
 
-    return res
+    No rule matches or produces whitespace, so the text can be cut at any whitespace
+    and every piece normalized on its own. With chunks of about
+    COMPARE_NAKDIMON_CHUNK_SIZE characters all the rule passes stay in cache, and a
+    whole file never has to be held in memory. A run without whitespace longer than
+    COMPARE_NAKDIMON_MAX_REST is cut before a character outside the Hebrew block.
 
+    Args:
+        chunks (Iterable[str]): Consecutive pieces of the text, e.g. reads of a file.
 
-def orgenize_data(main_folder, logger):
-    x = NikudDataset(None)
-    x.delete_files(os.path.join(Path(main_folder).parent, "train"))
-    x.delete_files(os.path.join(Path(main_folder).parent, "dev"))
-    x.delete_files(os.path.join(Path(main_folder).parent, "test"))
-    x.split_data(
-        main_folder, main_folder_name=os.path.basename(main_folder), logger=logger
-    )
+    Yields:
+        str: Consecutive pieces of the normalized text.
+    """
+    # the text after the last cut, in pieces so that holding it stays linear
+    rest, rest_length = [], 0
+    for chunk in chunks:
+        match = _LAST_WHITESPACE.search(chunk)
+        cut = None if match is None else match.start() + 1
+        if cut is None and rest_length + len(chunk) > COMPARE_NAKDIMON_MAX_REST:
+            match = _LAST_OUTSIDE_RULES.search(chunk)
+            cut = None if match is None else match.start()
+        if cut is None:
+            rest.append(chunk)
+            rest_length += len(chunk)
+            continue
+        rest.append(chunk[:cut])
+        yield extract_text_to_compare_nakdimon("".join(rest))
+        rest, rest_length = [chunk[cut:]], len(chunk) - cut
+    yield extract_text_to_compare_nakdimon("".join(rest))
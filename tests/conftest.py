@@ -0,0 +1,75 @@
+import pytest
+import torch
+from transformers import RobertaConfig
+
+from src.models import ModelConfig, build_model
+from src.utiles_data import Nikud
+
+LABEL_SIZES = (
+    len(Nikud.label_2_id["nikud"]),
+    len(Nikud.label_2_id["dagesh"]),
+    len(Nikud.label_2_id["sin"]),
+)
+
+
+def tiny_config(**kwargs):
+    """Config of a DNikudModel small enough to run with random weights on the CPU."""
+    config = RobertaConfig(
+        vocab_size=64,
+        hidden_size=16,
+        num_hidden_layers=3,
+        num_attention_heads=2,
+        intermediate_size=32,
+        max_position_embeddings=80,
+        pad_token_id=1,
+    )
+    config = ModelConfig(dict=dict(config.__dict__))
+    config.__dict__.update(kwargs)
+    return config
+
+
+def tiny_model(config):
+    torch.manual_seed(0)
+    return build_model(config, *LABEL_SIZES).eval()
+
+
+@pytest.fixture
+def config():
+    return tiny_config()
+
+
+class CharTokenizer:
+    """One token per character, in the vocabulary of tiny_config()."""
+
+    pad_token_id = 1
+
+    def encode_plus(self, text, add_special_tokens=True, max_length=None, truncation=True):
+        ids = [0] + [5 + ord(char) % 59 for char in text] + [2]
+        return {"input_ids": ids[:max_length]}
+
+
+DIACRITIZED_TEXT = (
+    "שָׁלוֹם עוֹלָם.\n"
+    "הַבַּיִת הַגָּדוֹל.\n"
+    "\n"
+    "סֵפֶר טוֹב מְאֹד, שִׂמְחָה רַבָּה.\n"
+    "יֶלֶד קָטָן.\n"
+)
+
+
+@pytest.fixture
+def tokenizer():
+    return CharTokenizer()
+
+
+@pytest.fixture
+def labeled_dataset(tmp_path, tokenizer):
+    """A NikudDataset of DIACRITIZED_TEXT in two sub folders, prepared for evaluation."""
+    from src.utiles_data import NikudDataset
+
+    for folder in ["a", "b"]:
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "text.txt").write_text(DIACRITIZED_TEXT, encoding="utf-8")
+    dataset = NikudDataset(tokenizer, folder=str(tmp_path), max_length=60)
+    dataset.prepare_data(name="test")
+    return dataset
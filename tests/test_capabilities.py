@@ -0,0 +1,51 @@
+import torch
+
+from src.models_utils import cant_be_masks
+from src.utiles_data import (
+    CAPABILITY_TABLE,
+    Letter,
+    Nikud,
+    NikudDataset,
+    capability_codes,
+    prepare_inference_sentences,
+    prepare_sentences,
+)
+
+# the Hebrew block, its neighbours, and characters of every normalize() rule
+CHARACTERS = [chr(code) for code in range(0x0590, 0x0600)] + list(
+    " !\"'(),-.:;?\n\tab51–[]’“…װ"
+)
+
+
+def old_mask(letter):
+    """The cant-be mask predict() read from the label tensor of an unmarked letter."""
+    l = Letter(letter)
+    l.get_label_letter([])
+    return [label == Nikud.PAD_OR_IRRELEVANT for label in (l.nikud, l.dagesh, l.sin)]
+
+
+def test_capability_codes_give_the_old_masks_of_every_letter():
+    codes = torch.from_numpy(capability_codes("".join(CHARACTERS))).unsqueeze(0)
+    masks = cant_be_masks(codes)[0]
+    for letter, mask in zip(CHARACTERS, masks):
+        assert mask.tolist() == old_mask(letter), hex(ord(letter))
+
+
+def test_letters_after_the_table_take_no_mark():
+    text = "".join(chr(code) for code in [len(CAPABILITY_TABLE), 0x05F0, 0x1F600])
+    assert not capability_codes(text).any()
+
+
+def test_inference_data_masks_match_the_labeled_masks(tokenizer):
+    text = "שלום עולם, בית-ספר גדול! ךםןףץ 15 abc\n"
+    dataset = NikudDataset(tokenizer, max_length=60)
+    # the old inference path built label tensors from unmarked letters
+    data, origin_data = dataset.read_single_segments(dataset.split_text(text))
+    labeled = prepare_sentences(tokenizer, data, 60)
+    inference = prepare_inference_sentences(
+        tokenizer, [sentence for sentence, _ in data], origin_data, 60
+    )
+    indices = list(range(len(labeled)))
+    assert torch.equal(
+        cant_be_masks(inference.batch(indices)[2]), cant_be_masks(labeled.batch(indices)[2])
+    )
@@ -0,0 +1,101 @@
+import shutil
+import threading
+
+import numpy as np
+import pytest
+import torch
+
+from conftest import tiny_config, tiny_model
+from src.checkpoints import (
+    BEST_FILE,
+    ENCODER_FILE,
+    LATEST_FILE,
+    CheckpointManager,
+    load_model_weights,
+)
+from src.models import ModelConfig
+
+
+def test_truncated_encoder_skips_dropped_layers(tmp_path, config):
+    full = tiny_model(config)
+    path = tmp_path / "full.pth"
+    torch.save(full.state_dict(), path)
+
+    truncated = tiny_model(tiny_config(encoder_num_layers=1))
+    load_model_weights(truncated, path)
+    state = truncated.state_dict()
+    for name, weights in full.state_dict().items():
+        if not name.startswith(("model.encoder.layer.1.", "model.encoder.layer.2.")):
+            assert torch.equal(state[name], weights), name
+
+
+def test_unexpected_weights_fail_the_load(tmp_path, config):
+    state = tiny_model(config).state_dict()
+    state["model.encoder.extra.weight"] = torch.zeros(1)
+    path = tmp_path / "extra.pth"
+    torch.save(state, path)
+    with pytest.raises(RuntimeError, match="Unexpected"):
+        load_model_weights(tiny_model(config), path)
+
+
+def test_another_architecture_fails_the_load(tmp_path, config):
+    path = tmp_path / "student.pth"
+    torch.save(tiny_model(ModelConfig.student_from(config, 8, 1)).state_dict(), path)
+    with pytest.raises(RuntimeError):
+        load_model_weights(tiny_model(config), path)
+
+
+def test_resume_state_is_copied_when_queued(tmp_path, config):
+    model = tiny_model(config)
+    optimizer = torch.optim.SGD(
+        [p for p in model.parameters() if p.requires_grad], lr=0.1
+    )
+    manager = CheckpointManager(str(tmp_path), model)
+    # hold the writer until training has changed the state it was given
+    release = threading.Event()
+    manager._queue.put(release.wait)
+    resume_state = {"losses": [1.0], "sampler": {"losses": np.zeros(2)}}
+    manager.save(0, model, optimizer, 0.5, resume_state=resume_state)
+    resume_state["losses"].append(2.0)
+    resume_state["sampler"]["losses"][:] = 3.0
+    release.set()
+    manager.close()
+
+    saved = torch.load(tmp_path / LATEST_FILE, weights_only=False)["resume_state"]
+    assert saved["losses"] == [1.0]
+    np.testing.assert_array_equal(saved["sampler"]["losses"], np.zeros(2))
+
+
+def save_best_and_latest(tmp_path, config):
+    model = tiny_model(config)
+    optimizer = torch.optim.SGD(
+        [p for p in model.parameters() if p.requires_grad], lr=0.1
+    )
+    manager = CheckpointManager(str(tmp_path / "run"), model)
+    manager.save(0, model, optimizer, 0.5, is_best=True)
+    return model, manager
+
+
+def test_closed_best_model_loads_on_its_own(tmp_path, config):
+    model, manager = save_best_and_latest(tmp_path, config)
+    manager.close()
+    # deployed like models/Dnikud_best_model.pth, without the encoder next to it
+    deployed = tmp_path / "models" / "Dnikud_best_model.pth"
+    deployed.parent.mkdir()
+    shutil.copyfile(tmp_path / "run" / BEST_FILE, deployed)
+    target = tiny_model(config)
+    with torch.no_grad():
+        for weights in target.parameters():
+            weights.zero_()
+    loaded = load_model_weights(target, deployed)
+    for name, weights in model.state_dict().items():
+        assert torch.equal(loaded.state_dict()[name], weights), name
+
+
+def test_missing_encoder_names_the_file(tmp_path, config):
+    _, manager = save_best_and_latest(tmp_path, config)
+    manager.close()
+    copied = tmp_path / "latest_copy.pth"
+    shutil.copyfile(tmp_path / "run" / LATEST_FILE, copied)
+    with pytest.raises(FileNotFoundError, match=ENCODER_FILE):
+        load_model_weights(tiny_model(config), copied)
@@ -0,0 +1,95 @@
+import pytest
+
+from conftest import DIACRITIZED_TEXT
+from src.corpus_manifest import (
+    MANIFEST_FILE,
+    build_manifest,
+    diff_manifest,
+    load_manifest,
+    save_manifest,
+)
+from src.utiles_data import NikudDataset
+
+
+def write_corpus(folder, texts):
+    for name, text in texts.items():
+        path = folder / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text, encoding="utf-8")
+
+
+def test_diff_manifest(tmp_path):
+    write_corpus(
+        tmp_path,
+        {"kept.txt": "אחד", "edited.txt": "שניים", "old_name.txt": "שלושה"},
+    )
+    previous = build_manifest(str(tmp_path))
+    save_manifest(previous, str(tmp_path / MANIFEST_FILE))
+    assert load_manifest(str(tmp_path)) == previous
+
+    write_corpus(tmp_path, {"edited.txt": "שניים ועוד", "new/added.txt": "ארבעה"})
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "old_name.txt").rename(tmp_path / "sub" / "new_name.txt")
+    current = build_manifest(str(tmp_path))
+    assert sorted(current) == [
+        "edited.txt",
+        "kept.txt",
+        "new/added.txt",
+        "sub/new_name.txt",
+    ]
+
+    changed, unchanged = diff_manifest(previous, current)
+    assert sorted(changed) == ["edited.txt", "new/added.txt"]
+    assert sorted(unchanged) == ["kept.txt", "sub/new_name.txt"]
+    assert diff_manifest(current, current) == ([], list(current))
+
+
+@pytest.fixture
+def replay_files(tmp_path):
+    texts = {f"old_{i}.txt": DIACRITIZED_TEXT for i in range(4)}
+    write_corpus(tmp_path, texts)
+    return [str(tmp_path / name) for name in texts]
+
+
+def replayed(tokenizer, tmp_path, replay_files, num_sentences, seed=0):
+    write_corpus(tmp_path, {"new.txt": DIACRITIZED_TEXT})
+    dataset = NikudDataset(tokenizer, files=[str(tmp_path / "new.txt")], is_train=True)
+    num_new = len(dataset.data)
+    num_replay = dataset.add_replay_data(replay_files, num_sentences, seed=seed)
+    return dataset, num_new, num_replay
+
+
+@pytest.mark.parametrize("num_sentences", [0, 3, 7])
+def test_add_replay_data_samples_num_sentences(
+    tokenizer, tmp_path, replay_files, num_sentences
+):
+    dataset, num_new, num_replay = replayed(
+        tokenizer, tmp_path, replay_files, num_sentences
+    )
+    assert num_replay == num_sentences
+    assert len(dataset.data) == len(dataset.origin_data) == num_new + num_replay
+    assert len(dataset.sentence_files) == len(dataset.data)
+    # every replayed sentence points at the file it was read from
+    for i in range(num_new, len(dataset.data)):
+        assert dataset.files[dataset.sentence_files[i]] in replay_files
+    # only as many files as the sample needs are read
+    sentences_per_file = num_new
+    assert len(dataset.files) == 1 + -(-num_sentences // sentences_per_file)
+
+
+def test_add_replay_data_is_capped_by_the_old_data(tokenizer, tmp_path, replay_files):
+    dataset, num_new, num_replay = replayed(tokenizer, tmp_path, replay_files, 1000)
+    assert num_replay == len(replay_files) * num_new
+    assert sorted(dataset.files[1:]) == sorted(replay_files)
+
+
+def test_add_replay_data_is_deterministic(tokenizer, tmp_path, replay_files):
+    def sample(seed):
+        dataset, num_new, _ = replayed(tokenizer, tmp_path, replay_files, 5, seed)
+        return (
+            dataset.origin_data[num_new:],
+            [dataset.files[i] for i in dataset.sentence_files[num_new:]],
+        )
+
+    assert sample(0) == sample(0)
+    assert sample(0) != sample(1)
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from conftest import DIACRITIZED_TEXT
+from src import corpus_stats as corpus_stats_module
+from src.corpus_stats import (
+    corpus_stats,
+    empty_stats,
+    file_stats,
+    folder_stats,
+    histograms,
+    info_folder,
+    merge_stats,
+)
+from src.utiles_data import Letters, NikudDataset, label_histograms
+
+# a nested folder, every file with another number of copies of the text
+NESTED_FILES = ["top.txt", "a/one.txt", "a/b/two.txt", "c/d/e/three.txt"]
+
+
+def hebrew_letters(text):
+    return sum(char in Letters.hebrew for char in text)
+
+
+@pytest.fixture
+def nested_folder(tmp_path):
+    folder = tmp_path / "corpus"
+    for copies, name in enumerate(NESTED_FILES, start=1):
+        path = folder / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(DIACRITIZED_TEXT * copies, encoding="utf-8")
+    (folder / "a" / "notes.md").write_text("לא קורפוס", encoding="utf-8")
+    return folder
+
+
+def test_info_folder_counts_every_file_once(nested_folder, tmp_path):
+    num_files, num_hebrew_letters = info_folder(
+        str(nested_folder), str(tmp_path / "cache.json"), num_workers=1
+    )
+    assert num_files == len(NESTED_FILES)
+    copies = len(NESTED_FILES) * (len(NESTED_FILES) + 1) // 2
+    assert num_hebrew_letters == copies * hebrew_letters(DIACRITIZED_TEXT)
+
+
+def test_folder_stats_match_the_dataset(nested_folder):
+    total, per_file = folder_stats(str(nested_folder), num_workers=1)
+    assert sorted(per_file) == sorted(
+        str(nested_folder / name) for name in NESTED_FILES
+    )
+
+    dataset = NikudDataset(None, folder=str(nested_folder))
+    assert total["files"] == len(NESTED_FILES)
+    assert total["sentences"] == len(dataset.data)
+    assert total["letters"] == sum(len(letters) for _, letters in dataset.data)
+    for name, histogram in label_histograms(dataset.data).items():
+        np.testing.assert_array_equal(histograms(total)[name], histogram)
+    lengths = np.bincount([len(sentence) for sentence, _ in dataset.data])
+    assert total["sentence_lengths"] == lengths.tolist()
+
+
+def test_second_call_is_served_from_the_cache(nested_folder, tmp_path, monkeypatch):
+    cache_path = str(tmp_path / "cache.json")
+    first = folder_stats(str(nested_folder), cache_path, num_workers=1)
+
+    def no_parsing(file_path):
+        raise AssertionError(f"{file_path} was parsed again")
+
+    monkeypatch.setattr(corpus_stats_module, "file_stats", no_parsing)
+    assert folder_stats(str(nested_folder), cache_path, num_workers=1) == first
+    monkeypatch.undo()
+
+    # only the edited file is parsed again
+    edited = nested_folder / NESTED_FILES[0]
+    edited.write_text(DIACRITIZED_TEXT * 5, encoding="utf-8")
+    parsed = []
+
+    def counting_file_stats(file_path):
+        parsed.append(file_path)
+        return file_stats(file_path)
+
+    monkeypatch.setattr(corpus_stats_module, "file_stats", counting_file_stats)
+    total, _ = folder_stats(str(nested_folder), cache_path, num_workers=1)
+    assert parsed == [str(edited)]
+    added = 4 * hebrew_letters(DIACRITIZED_TEXT)
+    assert total["hebrew_letters"] == first[0]["hebrew_letters"] + added
+
+
+def test_merge_stats_with_one_and_many_workers(nested_folder):
+    files = [str(nested_folder / name) for name in NESTED_FILES]
+    one_worker = corpus_stats(files, num_workers=1)
+    many_workers = corpus_stats(files, num_workers=3)
+    assert one_worker == many_workers
+
+    # the merge doesn't depend on the order of the files
+    _, per_file = one_worker
+    reverse = empty_stats()
+    for file in reversed(files):
+        merge_stats(reverse, per_file[file])
+    assert reverse == one_worker[0]
@@ -0,0 +1,71 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+import src.data_split
+from src.data_split import ShardWriter, load_split, load_split_manifest, split_corpus
+from conftest import DIACRITIZED_TEXT
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_shards_hold_the_added_sentences_in_order(tmp_path, seed):
+    rng = random.Random(seed)
+    shard_size = rng.randint(1, 6)
+    writer = ShardWriter(str(tmp_path), "train", shard_size, 60, pad_token_id=1)
+    all_lengths = []
+    for _ in range(rng.randint(0, 8)):
+        lengths = np.array(
+            [rng.randint(3, 10) for _ in range(rng.randint(0, 15))], dtype=np.int64
+        )
+        tokens = np.arange(lengths.sum()) + sum(map(int, all_lengths))
+        labels = np.stack([tokens % 7] * 3, axis=1).astype(np.int8)
+        writer.add(tokens, labels, lengths)
+        all_lengths.extend(lengths)
+    shards = writer.close()
+
+    assert [shard["sentences"] for shard in shards] == [
+        min(shard_size, len(all_lengths) - start)
+        for start in range(0, len(all_lengths), shard_size)
+    ]
+    if not shards:
+        return
+    manifest = {
+        "max_length": 60,
+        "pad_token_id": 1,
+        "splits": {"train": {"shards": shards}},
+    }
+    data = load_split(str(tmp_path), "train", manifest=manifest)
+    np.testing.assert_array_equal(data.lengths, all_lengths)
+    np.testing.assert_array_equal(data.tokens, np.arange(sum(map(int, all_lengths))))
+
+
+def write_corpus(folder):
+    for name in ["a", "b", "c"]:
+        os.makedirs(folder / name)
+        (folder / name / "text.txt").write_text(DIACRITIZED_TEXT, encoding="utf-8")
+
+
+def test_failed_split_keeps_the_previous_one(tmp_path, tokenizer, monkeypatch):
+    write_corpus(tmp_path / "corpus")
+    output_folder = str(tmp_path / "prepared")
+    split_corpus(str(tmp_path / "corpus"), output_folder, tokenizer, num_workers=1)
+    manifest = load_split_manifest(output_folder)
+
+    def fail(self):
+        raise RuntimeError("split failed")
+
+    monkeypatch.setattr(src.data_split.ShardWriter, "close", fail)
+    with pytest.raises(RuntimeError):
+        split_corpus(
+            str(tmp_path / "corpus"), output_folder, tokenizer, shard_size=1, num_workers=1
+        )
+    assert load_split_manifest(output_folder) == manifest
+    for split in src.data_split.SPLITS:
+        assert len(load_split(output_folder, split)) == manifest["splits"][split]["sentences"]
+
+    monkeypatch.undo()
+    split_corpus(str(tmp_path / "corpus"), output_folder, tokenizer, shard_size=1, num_workers=1)
+    assert sorted(os.listdir(output_folder)) == ["dev", "split_manifest.json", "test", "train"]
+    assert len(os.listdir(os.path.join(output_folder, "train"))) == len(load_split(output_folder, "train"))
@@ -0,0 +1,112 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from conftest import LABEL_SIZES, tiny_model
+from src.checkpoints import load_model_weights
+from src.models import DNikudStudentModel, ModelConfig, build_model
+from src.models_utils import distillation_loss, evaluate, speed_accuracy_report
+
+
+def random_logits(seed, shape=(3, 7, 5)):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(*shape, generator=generator)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_distillation_loss_is_the_blend_of_both_losses(seed):
+    student, teacher = random_logits(seed), random_logits(seed + 100)
+    labels = torch.randint(
+        0, 5, student.shape[:-1], generator=torch.Generator().manual_seed(seed)
+    )
+    labels[0, :3] = -1
+    hard_loss = F.cross_entropy(
+        student.reshape(-1, 5), labels.reshape(-1), ignore_index=-1
+    )
+    temperature, alpha = 2.0, 0.3
+
+    relevant = labels != -1
+    teacher_probs = F.softmax(teacher[relevant] / temperature, dim=-1)
+    student_log_probs = F.log_softmax(student[relevant] / temperature, dim=-1)
+    kl = (teacher_probs * (teacher_probs.log() - student_log_probs)).sum()
+    kl = kl / int(relevant.sum())
+    expected = alpha * temperature**2 * kl + (1 - alpha) * hard_loss
+
+    loss = distillation_loss(student, teacher, labels, hard_loss, temperature, alpha)
+    torch.testing.assert_close(loss, expected)
+
+    # the teacher's logits at the irrelevant positions change nothing
+    teacher[0, :3] = 1000.0
+    loss = distillation_loss(student, teacher, labels, hard_loss, temperature, alpha)
+    torch.testing.assert_close(loss, expected)
+
+
+def test_distillation_loss_edge_cases():
+    student = random_logits(0)
+    labels = torch.zeros(student.shape[:-1], dtype=torch.long)
+    hard_loss = torch.tensor(1.5)
+    # no soft loss against itself, only the gold labels with alpha 0
+    torch.testing.assert_close(
+        distillation_loss(student, student, labels, hard_loss, 2.0, 0.4),
+        0.6 * hard_loss,
+    )
+    torch.testing.assert_close(
+        distillation_loss(student, random_logits(1), labels, hard_loss, 2.0, 0.0),
+        hard_loss,
+    )
+    # nothing relevant, nothing to distill
+    assert distillation_loss(
+        student, random_logits(1), torch.full_like(labels, -1), hard_loss, 2.0, 0.5
+    ) is hard_loss
+
+
+def test_distillation_loss_trains_only_the_student():
+    student = random_logits(0).requires_grad_()
+    teacher = random_logits(1).requires_grad_()
+    labels = torch.zeros(student.shape[:-1], dtype=torch.long)
+    hard_loss = torch.tensor(0.0)
+    loss = distillation_loss(student, teacher.detach(), labels, hard_loss, 2.0, 1.0)
+    loss.backward()
+    assert student.grad.abs().sum() > 0
+    assert teacher.grad is None
+
+
+def test_student_config_and_checkpoint_load(config, tmp_path, labeled_dataset):
+    student_config = ModelConfig.student_from(config, hidden_size=8, num_layers=2)
+    config_path = tmp_path / "student_config.yml"
+    student_config.save_to_file(str(config_path))
+    loaded_config = ModelConfig.load_from_file(str(config_path))
+    assert loaded_config.dnikud_model_type == "student"
+    assert loaded_config.vocab_size == config.vocab_size
+
+    student = tiny_model(student_config)
+    weights_path = tmp_path / "student.pth"
+    torch.save(student.state_dict(), weights_path)
+    torch.manual_seed(1)
+    loaded = build_model(loaded_config, *LABEL_SIZES)
+    loaded = load_model_weights(loaded, weights_path).eval()
+    assert isinstance(loaded, DNikudStudentModel)
+
+    input_ids, attention_mask, _ = labeled_dataset.prepered_data[:3]
+    with torch.no_grad():
+        for expected, actual in zip(
+            student(input_ids, attention_mask), loaded(input_ids, attention_mask)
+        ):
+            assert torch.equal(expected, actual)
+
+
+def test_speed_accuracy_report_scores_like_evaluate(config, labeled_dataset, tmp_path):
+    teacher = tiny_model(config)
+    student = tiny_model(ModelConfig.student_from(config, hidden_size=8, num_layers=1))
+    loader = labeled_dataset.prepered_data.loader(batch_size=2)
+    report = speed_accuracy_report(
+        {"teacher": teacher, "student": student}, loader, str(tmp_path)
+    )
+    for name, model in [("teacher", teacher), ("student", student)]:
+        word_level_correct, letter_level_correct = evaluate(
+            model, loader, str(tmp_path)
+        )
+        assert report[name]["letter_level_correct"] == float(letter_level_correct)
+        assert report[name]["word_level_correct"] == float(word_level_correct)
+        assert report[name]["parameters"] == sum(p.numel() for p in model.parameters())
+    assert report["student"]["parameters"] < report["teacher"]["parameters"]
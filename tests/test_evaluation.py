@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from conftest import tiny_model
+from src.models_utils import (
+    evaluate,
+    group_accuracy,
+    predict_by_length,
+    sentence_scores,
+    sentence_scores_by_length,
+)
+
+
+def test_scores_by_length_are_in_sentence_order(config, labeled_dataset):
+    model = tiny_model(config)
+    prepared_data = labeled_dataset.prepered_data
+    in_order = sentence_scores(model, prepared_data.loader(batch_size=3))
+    by_length = sentence_scores_by_length(model, prepared_data, batch_size=3)
+    for name, values in in_order.items():
+        np.testing.assert_array_equal(by_length[name], values, err_msg=name)
+
+
+def test_scores_give_the_accuracy_of_evaluate(config, labeled_dataset, tmp_path):
+    model = tiny_model(config)
+    prepared_data = labeled_dataset.prepered_data
+    word_level_correct, letter_level_correct = evaluate(
+        model, prepared_data.loader(batch_size=3), str(tmp_path)
+    )
+    confusion = {}
+    scores = sentence_scores_by_length(model, prepared_data, 3, confusion=confusion)
+    accuracy = group_accuracy(scores, {"all": np.arange(len(labeled_dataset))})["all"]
+    assert accuracy["letter_level_correct"] == pytest.approx(float(letter_level_correct))
+    assert accuracy["word_level_correct"] == pytest.approx(float(word_level_correct))
+    relevant = (prepared_data[:][2] != -1).numpy()
+    for index, class_name in enumerate(["nikud", "dagesh", "sin"]):
+        assert len(confusion["true"][class_name]) == relevant[:, :, index].sum()
+        assert len(confusion["predicted"][class_name]) == relevant[:, :, index].sum()
+
+
+def test_scores_confidence_is_the_confidence_of_predict(config, labeled_dataset):
+    model = tiny_model(config)
+    prepared_data = labeled_dataset.prepered_data
+    _, confidence = predict_by_length(model, prepared_data, 3, return_confidence=True)
+    scores = sentence_scores_by_length(model, prepared_data, 3, return_confidence=True)
+    np.testing.assert_allclose(scores["confidence"], confidence, atol=1e-5)
@@ -0,0 +1,100 @@
+import threading
+from collections import OrderedDict
+
+import pytest
+
+from conftest import tiny_model
+from handler import EndpointHandler
+from src.diacritizer import Diacritizer
+from src.instrumentation import get_instrumentation
+
+PARAGRAPHS = [
+    "שלום עולם.\nהבית הגדול.\n",
+    "ספר טוב מאד, שמחה רבה.\nילד קטן.\n",
+    "בוקר טוב.\n",
+]
+DOCUMENT = "\n".join(PARAGRAPHS)
+# the empty line between the paragraphs is predicted once
+UNIQUE_SEGMENTS = [PARAGRAPHS[0], "\n", *PARAGRAPHS[1:]]
+
+
+def make_handler(config, tokenizer, max_documents=1000):
+    """An EndpointHandler of a tiny model, without loading the released weights."""
+    handler = EndpointHandler.__new__(EndpointHandler)
+    handler.diacritizer = Diacritizer(tiny_model(config), tokenizer, max_length=60)
+    handler.instrumentation = get_instrumentation()
+    handler.documents = OrderedDict()
+    handler.documents_lock = threading.Lock()
+    handler.max_documents = max_documents
+    return handler
+
+
+@pytest.fixture
+def handler(config, tokenizer):
+    return make_handler(config, tokenizer)
+
+
+@pytest.fixture
+def predicted(handler, monkeypatch):
+    """The segments every call of predict_segments() predicts."""
+    calls = []
+    predict_segments = handler.diacritizer.predict_segments
+
+    def recording_predict_segments(segments, keep_marks=False):
+        calls.append(list(segments))
+        return predict_segments(segments, keep_marks=keep_marks)
+
+    monkeypatch.setattr(
+        handler.diacritizer, "predict_segments", recording_predict_segments
+    )
+    return calls
+
+
+def test_unchanged_document_reuses_its_segments(handler, predicted):
+    expected = handler.predict_single_text(DOCUMENT)
+    predicted.clear()
+    assert handler.predict_document("doc", DOCUMENT) == expected
+    assert predicted == [UNIQUE_SEGMENTS]
+    assert handler({"document_id": "doc", "text": DOCUMENT}) == expected
+    assert len(predicted) == 1
+
+
+def test_an_edit_predicts_only_its_paragraph(handler, predicted):
+    handler.predict_document("doc", DOCUMENT)
+    edited_paragraph = PARAGRAPHS[1].replace("קטן", "גדול מאוד")
+    edited = DOCUMENT.replace(PARAGRAPHS[1], edited_paragraph)
+    predicted.clear()
+    result = handler.predict_document("doc", edited)
+    assert predicted == [[edited_paragraph]]
+    assert result == handler.predict_single_text(edited)
+    # only the segments of the last version stay cached
+    assert (False, PARAGRAPHS[1]) not in handler.documents["doc"]
+
+
+def test_keep_marks_is_part_of_the_key(handler, predicted):
+    handler.predict_document("doc", DOCUMENT)
+    predicted.clear()
+    result = handler.predict_document("doc", DOCUMENT, keep_marks=True)
+    assert predicted == [UNIQUE_SEGMENTS]
+    assert result == handler.predict_single_text(DOCUMENT, keep_marks=True)
+    assert all(keep_marks for keep_marks, _ in handler.documents["doc"])
+
+
+def test_least_recently_used_document_is_evicted(config, tokenizer):
+    handler = make_handler(config, tokenizer, max_documents=2)
+    handler.predict_document("a", PARAGRAPHS[0])
+    handler.predict_document("b", PARAGRAPHS[1])
+    # a new version of a makes b the least recently used
+    handler.predict_document("a", PARAGRAPHS[0])
+    handler.predict_document("c", PARAGRAPHS[2])
+    assert list(handler.documents) == ["a", "c"]
+
+
+def test_forget_document(handler, predicted):
+    handler.predict_document("doc", DOCUMENT)
+    handler.forget_document("doc")
+    handler.forget_document("unknown")
+    assert "doc" not in handler.documents
+    predicted.clear()
+    handler.predict_document("doc", DOCUMENT)
+    assert predicted == [UNIQUE_SEGMENTS]
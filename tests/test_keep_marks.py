@@ -0,0 +1,32 @@
+import pytest
+
+from conftest import tiny_model
+from src.diacritizer import Diacritizer
+from src.utiles_data import NikudDataset
+
+QAMATS = "ָ"
+DAGESH = "ּ"
+SHALOM = "שָׁלוֹם"
+
+
+@pytest.mark.parametrize(
+    "text, origin",
+    [
+        (f"abc{QAMATS} שלום", "abc שלום"),
+        (f"{SHALOM} 5{DAGESH}", "שלום 5"),
+        (f"{QAMATS}א .{DAGESH}{QAMATS}", "א ."),
+    ],
+)
+def test_keep_marks_drops_the_orphan_marks(text, origin):
+    dataset = NikudDataset(None, max_length=60)
+    data, origin_data = dataset.read_inference_text(text, keep_marks=True)
+    assert origin_data == [origin]
+    # normalized, letter for letter
+    assert len(data[0][0]) == len(origin)
+
+
+def test_keep_marks_predicts_text_with_orphan_marks(config, tokenizer):
+    diacritizer = Diacritizer(tiny_model(config), tokenizer, max_length=60)
+    predicted = diacritizer.predict_text(f"{SHALOM} 5{DAGESH}", keep_marks=True)
+    assert predicted.startswith(SHALOM)
+    assert predicted.rstrip("\n").endswith("5")
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+from src.lexicon import Lexicon, iter_words, predict_with_lexicon
+from src.utiles_data import NikudDataset, label_array
+
+AMBIGUOUS_TEXT = "סֵפֶר טוֹב.\nסְפַר טוֹב.\nיֶלֶד.\n"
+
+
+@pytest.fixture
+def lexicon(labeled_dataset):
+    return Lexicon.build(labeled_dataset.data, labeled_dataset.origin_data)
+
+
+def dataset_words(dataset):
+    """Every word of the dataset with its labels, as parsed."""
+    labels = label_array(dataset.data)
+    start = 0
+    for (sentence, _), origin in zip(dataset.data, dataset.origin_data):
+        for word_start, word_end in iter_words(origin):
+            yield origin[word_start:word_end], labels[
+                start + word_start : start + word_end
+            ]
+        start += len(sentence)
+
+
+def test_build_save_and_memory_mapped_load(lexicon, labeled_dataset, tmp_path):
+    words = dict(dataset_words(labeled_dataset))
+    assert len(lexicon) == len(words)
+    for word, word_labels in words.items():
+        np.testing.assert_array_equal(lexicon.lookup(word), word_labels)
+        # every word of the text is in both of its copies
+        assert lexicon.lookup(word, min_count=2) is not None
+
+    lexicon.save(str(tmp_path / "lexicon"))
+    loaded = Lexicon.load(str(tmp_path / "lexicon"), mmap=True)
+    assert isinstance(loaded.labels, np.memmap)
+    assert loaded.meta["words"] == len(words)
+    assert loaded.meta["sentences"] == len(labeled_dataset.data)
+    for name in ["keys", "offsets", "labels", "ambiguity", "counts"]:
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(lexicon, name))
+    for word in words:
+        np.testing.assert_array_equal(loaded.lookup(word), lexicon.lookup(word))
+
+
+def test_ambiguous_rare_and_unknown_words(tmp_path):
+    path = tmp_path / "ambiguous.txt"
+    path.write_text(AMBIGUOUS_TEXT, encoding="utf-8")
+    dataset = NikudDataset(None, file=str(path))
+    lexicon = Lexicon.build(dataset.data, dataset.origin_data)
+
+    assert lexicon.lookup("ספר") is None
+    assert lexicon.lookup("טוב", min_count=2) is not None
+    assert lexicon.lookup("טוב", min_count=3) is None
+    assert lexicon.lookup("ילד") is not None
+    assert lexicon.lookup("ילד", min_count=2) is None
+    assert lexicon.lookup("בית") is None
+
+
+def test_cover_rows_are_the_gold_labels(lexicon, labeled_dataset):
+    prepared_data = labeled_dataset.prepered_data
+    covered, labels = lexicon.cover(
+        labeled_dataset.origin_data, prepared_data.max_length
+    )
+    assert covered.all()
+    assert labels.shape == (len(prepared_data), prepared_data.max_length, 3)
+    for index, row in enumerate(labels):
+        _, gold = prepared_data.row(index)
+        np.testing.assert_array_equal(row[: len(gold)], gold)
+        assert (row[len(gold) :] == -1).all()
+
+
+def test_predict_with_lexicon_predicts_only_the_uncovered_sentences(
+    labeled_dataset,
+):
+    # only the first paragraph (and the empty one) is known
+    lexicon = Lexicon.build(labeled_dataset.data[:1], labeled_dataset.origin_data[:1])
+    prepared_data = labeled_dataset.prepered_data
+    origin = labeled_dataset.origin_data
+    expected_rest = [
+        index
+        for index, sentence in enumerate(origin)
+        if sentence.strip() and sentence != origin[0]
+    ]
+    assert expected_rest
+
+    predicted = []
+
+    def predict_fn(subset):
+        predicted.append(subset)
+        return np.full((len(subset), subset.max_length, 3), 7, dtype=np.int8)
+
+    labels, covered = predict_with_lexicon(lexicon, prepared_data, origin, predict_fn)
+    assert len(predicted) == 1
+    assert np.flatnonzero(~covered).tolist() == expected_rest
+    for i, index in enumerate(expected_rest):
+        for subset_row, row in zip(predicted[0].row(i), prepared_data.row(index)):
+            np.testing.assert_array_equal(subset_row, row)
+    assert (labels[~covered] == 7).all()
+    for index in np.flatnonzero(covered):
+        _, gold = prepared_data.row(index)
+        np.testing.assert_array_equal(labels[index, : len(gold)], gold)
+
+    # nothing to predict, no call
+    labels, covered = predict_with_lexicon(
+        Lexicon.build(labeled_dataset.data, origin), prepared_data, origin, predict_fn
+    )
+    assert covered.all() and len(predicted) == 1
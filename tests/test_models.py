@@ -0,0 +1,131 @@
+import random
+
+import pytest
+import torch
+
+from conftest import tiny_config, tiny_model
+from src.models import ModelConfig, run_lstms
+
+PAD = 1
+ATOL = 1e-8
+
+
+def sentence(rng, length):
+    return [0] + [rng.randint(3, 63) for _ in range(length - 2)] + [2]
+
+
+def padded(rows, width):
+    input_ids = torch.full((len(rows), width), PAD, dtype=torch.long)
+    attention_mask = torch.zeros((len(rows), width), dtype=torch.long)
+    for i, row in enumerate(rows):
+        input_ids[i, : len(row)] = torch.tensor(row)
+        attention_mask[i, : len(row)] = 1
+    return input_ids, attention_mask
+
+
+def double_model(model_type):
+    config = tiny_config()
+    if model_type == "student":
+        config = ModelConfig.student_from(config, hidden_size=8, num_layers=2)
+    # float64, so only a real difference shows above ATOL
+    return tiny_model(config).double()
+
+
+def real_logits(logits, attention_mask):
+    """The logits of the real tokens, row after row."""
+    return [head[attention_mask.bool()] for head in logits]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_lstm_outputs_do_not_depend_on_padding(seed):
+    rng = random.Random(seed)
+    torch.manual_seed(seed)
+    lstms = [
+        torch.nn.LSTM(4, 4, bidirectional=True, batch_first=True).double(),
+        torch.nn.LSTM(8, 4, bidirectional=True, batch_first=True).double(),
+    ]
+    lengths = [rng.randint(1, 12) for _ in range(3)]
+    hidden = torch.randn(len(lengths), 12, 4, dtype=torch.float64)
+    outputs = []
+    for width in [12, 30]:
+        attention_mask = torch.zeros(len(lengths), width, dtype=torch.long)
+        for i, length in enumerate(lengths):
+            attention_mask[i, :length] = 1
+        # the padding holds garbage, it must not reach the real tokens
+        wide = torch.randn(len(lengths), width, 4, dtype=torch.float64) * 100
+        wide[:, :12][attention_mask[:, :12].bool()] = hidden[attention_mask[:, :12].bool()]
+        output = run_lstms(lstms, wide, attention_mask)
+        outputs.append(output[attention_mask.bool()])
+        assert not output[~attention_mask.bool()].any()
+    torch.testing.assert_close(outputs[0], outputs[1], atol=ATOL, rtol=0)
+
+
+@pytest.mark.parametrize("model_type", ["full", "student"])
+@pytest.mark.parametrize("seed", range(3))
+def test_logits_do_not_depend_on_padding_or_trimming(model_type, seed):
+    rng = random.Random(seed)
+    model = double_model(model_type)
+    rows = [sentence(rng, rng.randint(3, 20)) for _ in range(4)]
+    results = []
+    with torch.no_grad():
+        for width, trim in [(20, True), (60, True), (60, False)]:
+            model.trim_padding = trim
+            input_ids, attention_mask = padded(rows, width)
+            logits = model(input_ids, attention_mask)
+            assert all(head.shape[1] == width for head in logits)
+            results.append(real_logits(logits, attention_mask))
+    for other in results[1:]:
+        for expected, actual in zip(results[0], other):
+            torch.testing.assert_close(actual, expected, atol=ATOL, rtol=0)
+
+
+@pytest.mark.parametrize("model_type", ["full", "student"])
+@pytest.mark.parametrize("seed", range(3))
+def test_packed_sentences_match_a_row_each(model_type, seed):
+    rng = random.Random(seed)
+    model = double_model(model_type)
+    windows = [
+        [sentence(rng, rng.randint(3, 12)) for _ in range(rng.randint(1, 4))]
+        for _ in range(3)
+    ]
+    rows = [row for window in windows for row in window]
+    width = max(sum(map(len, window)) for window in windows) + 3
+    packed_ids = torch.full((len(windows), width), PAD, dtype=torch.long)
+    packed_mask = torch.zeros((len(windows), width), dtype=torch.long)
+    segment_ids = torch.zeros((len(windows), width), dtype=torch.long)
+    for i, window in enumerate(windows):
+        start = 0
+        for segment, row in enumerate(window, start=1):
+            packed_ids[i, start : start + len(row)] = torch.tensor(row)
+            packed_mask[i, start : start + len(row)] = 1
+            segment_ids[i, start : start + len(row)] = segment
+            start += len(row)
+
+    with torch.no_grad():
+        packed = model(packed_ids, packed_mask, segment_ids=segment_ids)
+        input_ids, attention_mask = padded(rows, width)
+        separate = model(input_ids, attention_mask)
+    for expected, actual in zip(
+        real_logits(separate, attention_mask), real_logits(packed, packed_mask)
+    ):
+        torch.testing.assert_close(actual, expected, atol=ATOL, rtol=0)
+
+
+@pytest.mark.parametrize("model_type", ["full", "student"])
+@pytest.mark.parametrize("seed", range(3))
+def test_logits_at_positions_match_the_full_logits(model_type, seed):
+    rng = random.Random(seed)
+    model = double_model(model_type)
+    rows = [sentence(rng, rng.randint(3, 20)) for _ in range(4)]
+    input_ids, attention_mask = padded(rows, 24)
+    positions = attention_mask.bool() & (torch.rand(input_ids.shape) < 0.6)
+    positions[0] = False
+    with torch.no_grad():
+        full = model(input_ids, attention_mask)
+        gathered = model(input_ids, attention_mask, positions=positions)
+    rows_index, columns_index = positions.nonzero(as_tuple=True)
+    for full_head, gathered_head in zip(full, gathered):
+        assert gathered_head.shape[0] == int(positions.sum())
+        torch.testing.assert_close(
+            gathered_head, full_head[rows_index, columns_index], atol=ATOL, rtol=0
+        )
@@ -0,0 +1,123 @@
+import random
+import re
+
+import pytest
+
+import src.utiles_data
+
+from src.utiles_data import (
+    Nikud,
+    extract_text_to_compare_nakdimon,
+    iter_extract_text_to_compare_nakdimon,
+)
+
+
+def old_extract_text_to_compare_nakdimon(text):
+    """extract_text_to_compare_nakdimon before the rule table, the reference."""
+    res = text.replace("|", "")
+    res = res.replace(
+        chr(Nikud.nikud_dict["KUBUTZ"]) + "ו" + chr(Nikud.nikud_dict["METEG"]),
+        "ו" + chr(Nikud.nikud_dict["DAGESH OR SHURUK"]),
+    )
+    res = res.replace(
+        chr(Nikud.nikud_dict["HOLAM"]) + "ו" + chr(Nikud.nikud_dict["METEG"]), "ו"
+    )
+    res = res.replace(
+        "ו" + chr(Nikud.nikud_dict["HOLAM"]) + chr(Nikud.nikud_dict["KAMATZ"]),
+        "ו" + chr(Nikud.nikud_dict["KAMATZ"]),
+    )
+    res = res.replace(chr(Nikud.nikud_dict["METEG"]), "")
+    res = res.replace(
+        chr(Nikud.nikud_dict["KAMATZ"]) + chr(Nikud.nikud_dict["HIRIK"]),
+        chr(Nikud.nikud_dict["KAMATZ"]) + "י" + chr(Nikud.nikud_dict["HIRIK"]),
+    )
+    res = res.replace(
+        chr(Nikud.nikud_dict["PATAKH"]) + chr(Nikud.nikud_dict["HIRIK"]),
+        chr(Nikud.nikud_dict["PATAKH"]) + "י" + chr(Nikud.nikud_dict["HIRIK"]),
+    )
+    res = res.replace(chr(Nikud.nikud_dict["PUNCTUATION MAQAF"]), "")
+    res = res.replace(chr(Nikud.nikud_dict["PUNCTUATION PASEQ"]), "")
+    res = res.replace(
+        chr(Nikud.nikud_dict["KAMATZ_KATAN"]), chr(Nikud.nikud_dict["KAMATZ"])
+    )
+
+    res = re.sub(chr(Nikud.nikud_dict["KUBUTZ"]) + "ו" + "(?=[א-ת])", "ו", res)
+    res = res.replace(chr(Nikud.nikud_dict["REDUCED_KAMATZ"]) + "ו", "ו")
+
+    res = res.replace(
+        chr(Nikud.nikud_dict["DAGESH OR SHURUK"]) * 2,
+        chr(Nikud.nikud_dict["DAGESH OR SHURUK"]),
+    )
+    res = res.replace("\u05be", "-")
+    res = res.replace("\u05d9\u05b0\u05d4\u05d5\u05b9\u05b8\u05d4", "יהוה")
+
+    return res
+
+
+# letters and marks the rules look for, and some that none of them touch
+ALPHABET = (
+    [chr(code) for code in Nikud.nikud_dict.values()]
+    + list("וייהאבת")
+    + ["|", "\u05be", "-", " ", " ", "\n", "\t", "a", "."]
+)
+# whole words the rules match, so the longer rules fire too
+PIECES = [
+    "\u05d9\u05b0\u05d4\u05d5\u05b9\u05b8\u05d4",
+    "\u05d5\u05b9" + chr(Nikud.nikud_dict["METEG"]),
+    "\u05bb\u05d5\u05bc",
+    "\u05e9\u05c1\u05b8\u05dc\u05d5\u05b9\u05dd",
+]
+
+
+def random_text(rng, length):
+    return "".join(
+        rng.choice(PIECES) if rng.random() < 0.05 else rng.choice(ALPHABET)
+        for _ in range(length)
+    )
+
+
+def random_chunks(rng, text):
+    cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, 5)))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_normalizer_matches_old_normalizer(seed):
+    rng = random.Random(seed)
+    text = random_text(rng, rng.randint(0, 200))
+    assert extract_text_to_compare_nakdimon(text) == old_extract_text_to_compare_nakdimon(
+        text
+    )
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_streaming_normalizer_matches_old_normalizer(seed):
+    rng = random.Random(seed)
+    text = random_text(rng, rng.randint(0, 200))
+    assert "".join(
+        iter_extract_text_to_compare_nakdimon(random_chunks(rng, text))
+    ) == old_extract_text_to_compare_nakdimon(text)
+
+
+def test_streaming_normalizer_of_no_chunks():
+    assert "".join(iter_extract_text_to_compare_nakdimon([])) == ""
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_streaming_normalizer_cuts_long_runs_without_whitespace(seed, monkeypatch):
+    monkeypatch.setattr(src.utiles_data, "COMPARE_NAKDIMON_MAX_REST", 8)
+    rng = random.Random(seed)
+    text = "".join(
+        char for char in random_text(rng, rng.randint(0, 300)) if not char.isspace()
+    )
+    chunks = [text[start : start + 7] for start in range(0, len(text), 7)]
+    assert "".join(
+        iter_extract_text_to_compare_nakdimon(chunks)
+    ) == old_extract_text_to_compare_nakdimon(text)
+
+
+def test_streaming_normalizer_is_linear_without_whitespace():
+    # quadratic scanning of the held text would take minutes here
+    text = "וֹ" * 200_000
+    chunks = [text[start : start + 100] for start in range(0, len(text), 100)]
+    assert "".join(iter_extract_text_to_compare_nakdimon(chunks)) == text
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+import torch
+
+from src.utiles_data import Nikud, NikudPreparedData
+
+
+def old_padded_rows(tokenizer, data, max_length):
+    """The (input_ids, attention_mask, labels) rows of prepare_data before the columnar storage."""
+    rows = []
+    for sentence, letters in data:
+        ids = tokenizer.encode_plus(sentence, max_length=max_length)["input_ids"]
+        input_ids = ids + [tokenizer.pad_token_id] * (max_length - len(ids))
+        attention_mask = [1] * len(ids) + [0] * (max_length - len(ids))
+        label_lists = [[letter.nikud, letter.dagesh, letter.sin] for letter in letters]
+        labels = (
+            [[Nikud.PAD_OR_IRRELEVANT] * 3]
+            + label_lists[: max_length - 1]
+            + [[Nikud.PAD_OR_IRRELEVANT] * 3] * (max_length - len(letters) - 1)
+        )
+        rows.append((input_ids, attention_mask, labels))
+    return rows
+
+
+def assert_rows(batch, expected_rows):
+    input_ids, attention_mask, labels = batch
+    for i, (row_ids, row_mask, row_labels) in enumerate(expected_rows):
+        assert input_ids[i].tolist() == row_ids
+        assert attention_mask[i].tolist() == row_mask
+        assert labels[i].tolist() == row_labels
+
+
+def test_batch_matches_the_old_padded_rows(labeled_dataset, tokenizer):
+    prepared_data = labeled_dataset.prepered_data
+    expected = old_padded_rows(tokenizer, labeled_dataset.data, prepared_data.max_length)
+    assert len(prepared_data) == len(expected)
+    assert_rows(prepared_data.batch(list(range(len(prepared_data)))), expected)
+    for idx in range(len(prepared_data)):
+        assert_rows(prepared_data.batch([idx]), [expected[idx]])
+
+
+def test_subset_keeps_the_rows_in_the_given_order(labeled_dataset, tokenizer):
+    prepared_data = labeled_dataset.prepered_data
+    expected = old_padded_rows(tokenizer, labeled_dataset.data, prepared_data.max_length)
+    indices = [3, 0, 3, len(prepared_data) - 1]
+    subset = prepared_data.subset(indices)
+    assert len(subset) == len(indices)
+    assert_rows(subset.batch(list(range(len(subset)))), [expected[i] for i in indices])
+
+
+def test_save_and_load_keep_the_rows(labeled_dataset, tmp_path):
+    prepared_data = labeled_dataset.prepered_data
+    half = len(prepared_data) // 2
+    paths = [str(tmp_path / "first.npz"), str(tmp_path / "second.npz")]
+    prepared_data.subset(range(half)).save(paths[0])
+    prepared_data.subset(range(half, len(prepared_data))).save(paths[1])
+    loaded = NikudPreparedData.load(
+        paths, prepared_data.max_length, pad_token_id=prepared_data.pad_token_id
+    )
+    np.testing.assert_array_equal(loaded.tokens, prepared_data.tokens)
+    np.testing.assert_array_equal(loaded.labels, prepared_data.labels)
+    np.testing.assert_array_equal(loaded.offsets, prepared_data.offsets)
+    for expected, actual in zip(
+        prepared_data.batch(list(range(len(prepared_data)))),
+        loaded.batch(list(range(len(loaded)))),
+    ):
+        assert torch.equal(expected, actual)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 4, 100])
+def test_length_batches_cover_every_sentence_once(labeled_dataset, batch_size):
+    prepared_data = labeled_dataset.prepered_data
+    batches = prepared_data.length_batches(batch_size)
+    assert all(len(batch) <= batch_size for batch in batches)
+    indices = [idx for batch in batches for idx in batch]
+    assert sorted(indices) == list(range(len(prepared_data)))
+    lengths = prepared_data.lengths[indices]
+    assert (np.diff(lengths) >= 0).all()
@@ -0,0 +1,43 @@
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from src.utiles_data import HardExampleBatchSampler
+
+
+def assert_batches_match_indices(prepared_data, batches):
+    count = 0
+    for input_ids, attention_mask, labels, indices in batches:
+        for row, idx in enumerate(indices.tolist()):
+            tokens, row_labels = prepared_data.row(idx)
+            assert input_ids[row, : len(tokens)].tolist() == tokens.tolist()
+            assert labels[row, : len(tokens)].tolist() == row_labels.tolist()
+        count += 1
+    return count
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_loader_returns_the_indices_of_every_batch(labeled_dataset, num_workers):
+    prepared_data = labeled_dataset.prepered_data
+    sampler = HardExampleBatchSampler(prepared_data.lengths, 2, hard_fraction=0.5)
+    loader = prepared_data.loader(2, batch_sampler=sampler, with_indices=True)
+    # workers prefetch ahead of the training step, the indices still come with the batch
+    loader = DataLoader(
+        loader.dataset,
+        sampler=sampler,
+        batch_size=None,
+        num_workers=num_workers,
+        prefetch_factor=4 if num_workers else None,
+    )
+    assert assert_batches_match_indices(prepared_data, loader) == len(sampler)
+
+
+def test_recorded_losses_reach_their_sentences(labeled_dataset):
+    prepared_data = labeled_dataset.prepered_data
+    sampler = HardExampleBatchSampler(prepared_data.lengths, 2, hard_fraction=0.0)
+    loader = prepared_data.loader(2, batch_sampler=sampler, with_indices=True)
+    batches = list(loader)
+    for *_, indices in batches:
+        sampler.record_losses(indices.numpy(), indices.float().numpy() + 1)
+    seen = torch.cat([indices for *_, indices in batches]).unique()
+    assert sampler.losses[seen.numpy()].tolist() == (seen.float() + 1).tolist()
@@ -0,0 +1,190 @@
+import random
+from uuid import uuid1
+
+import pytest
+
+from src.running_params import MAX_LENGTH_SEN
+from src.utiles_data import (
+    SEPARATOR_LINE,
+    NikudDataset,
+    iter_lines,
+    iter_segments,
+    text_contains_nikud,
+)
+
+unique_key = str(uuid1())
+
+
+class OldLoopStuck(Exception):
+    pass
+
+
+def old_combine_sentences(list_sentences, max_length=0, is_train=False):
+    """combine_sentences before the streaming segmenter, the reference."""
+    all_new_sentences = []
+    new_sen = ""
+    index = 0
+    while index < len(list_sentences):
+        sen = list_sentences[index]
+
+        if not text_contains_nikud(sen) and (
+            "------------------" in sen or sen == "\n"
+        ):
+            if len(new_sen) > 0:
+                all_new_sentences.append(new_sen)
+                if not is_train:
+                    all_new_sentences.append(sen)
+                new_sen = ""
+                index += 1
+                continue
+
+        if not text_contains_nikud(sen) and is_train:
+            index += 1
+            continue
+
+        if len(sen) > max_length:
+            update_sen = sen.replace(". ", f". {unique_key}")
+            update_sen = update_sen.replace("? ", f"? {unique_key}")
+            update_sen = update_sen.replace("! ", f"! {unique_key}")
+            update_sen = update_sen.replace("” ", f"” {unique_key}")
+            update_sen = update_sen.replace("\t", f"\t{unique_key}")
+            part_sentence = update_sen.split(unique_key)
+
+            good_parts = []
+            for p in part_sentence:
+                if len(p) < max_length:
+                    good_parts.append(p)
+                else:
+                    prev = 0
+                    while prev <= len(p):
+                        part = p[prev : (prev + max_length)]
+                        last_space = 0
+                        if " " in part:
+                            last_space = part[::-1].index(" ") + 1
+                        next = prev + max_length - last_space
+                        if next <= prev:
+                            # the old loop never terminated here
+                            raise OldLoopStuck()
+                        part = p[prev:next]
+                        good_parts.append(part)
+                        prev = next
+            list_sentences = (
+                list_sentences[:index] + good_parts + list_sentences[index + 1 :]
+            )
+            continue
+        if new_sen == "":
+            new_sen = sen
+        elif len(new_sen) + len(sen) < max_length:
+            new_sen += sen
+        else:
+            all_new_sentences.append(new_sen)
+            new_sen = sen
+
+        index += 1
+    if len(new_sen) > 0:
+        all_new_sentences.append(new_sen)
+    return all_new_sentences
+
+
+def old_split_lines(text):
+    return text.replace("\n", f"\n{unique_key}").split(unique_key)
+
+
+WORDS = ["שלום", "עולם", "שָׁלוֹם", "עוֹלָם", "ספר", "בַּיִת", "abc", "42", "”"]
+ENDINGS = [" ", " ", " ", ". ", "? ", "! ", "” ", "\t", ""]
+
+
+def random_line(rng, max_words):
+    return "".join(
+        rng.choice(WORDS) + rng.choice(ENDINGS)
+        for _ in range(rng.randint(0, max_words))
+    )
+
+
+def random_text(rng, max_words):
+    lines = []
+    for _ in range(rng.randint(0, 30)):
+        kind = rng.random()
+        if kind < 0.15:
+            lines.append("")
+        elif kind < 0.25:
+            lines.append(SEPARATOR_LINE + rng.choice(["", "---", " 1"]))
+        else:
+            lines.append(random_line(rng, max_words))
+    return "\n".join(lines) + rng.choice(["", "\n"])
+
+
+def assert_same_segments(text, max_length, is_train):
+    try:
+        expected = old_combine_sentences(
+            old_split_lines(text), max_length=max_length, is_train=is_train
+        )
+    except OldLoopStuck:
+        pytest.skip("the old segmenter does not terminate on this text")
+    assert (
+        list(iter_segments(iter_lines(text), max_length=max_length, is_train=is_train))
+        == expected
+    )
+
+
+def test_iter_lines_keeps_newlines():
+    text = "a\n\nb\nc"
+    assert list(iter_lines(text)) == old_split_lines(text)
+    assert list(iter_lines("a\n")) == ["a\n", ""]
+    assert "".join(iter_lines(text)) == text
+
+
+@pytest.mark.parametrize("is_train", [False, True])
+@pytest.mark.parametrize("seed", range(200))
+def test_segments_match_old_segmentation(seed, is_train):
+    rng = random.Random(seed)
+    assert_same_segments(random_text(rng, 12), rng.randint(8, 60), is_train)
+
+
+@pytest.mark.parametrize("is_train", [False, True])
+def test_separator_and_empty_lines(is_train):
+    text = f"שָׁלוֹם עוֹלָם\nספר\n\n{SEPARATOR_LINE}\nבַּיִת\n\n\n{SEPARATOR_LINE}\n"
+    assert_same_segments(text, 40, is_train)
+
+
+@pytest.mark.parametrize("is_train", [False, True])
+def test_lines_over_max_length(is_train):
+    line = "שָׁלוֹם עוֹלָם. ספר? " * 10 + "בַּיִת" * 20 + " עוֹלָם\tשלום"
+    assert_same_segments(f"קצר\n{line}\n{line}\n", 16, is_train)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_split_text_matches_old_split_text(seed):
+    rng = random.Random(seed)
+    text = random_text(rng, MAX_LENGTH_SEN // 3)
+    try:
+        expected = old_combine_sentences(
+            old_split_lines(text), max_length=MAX_LENGTH_SEN
+        )
+    except OldLoopStuck:
+        pytest.skip("the old segmenter does not terminate on this text")
+    assert NikudDataset(None).split_text(text) == expected
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_an_edit_changes_only_the_segments_of_its_paragraph(seed):
+    rng = random.Random(seed)
+    paragraphs = [
+        "".join(random_line(rng, 20) + "\n" for _ in range(rng.randint(1, 40)))
+        for _ in range(rng.randint(2, 5))
+    ]
+    edited = rng.randrange(len(paragraphs))
+    new_paragraphs = list(paragraphs)
+    new_paragraphs[edited] = random_line(rng, 20) + new_paragraphs[edited]
+    dataset = NikudDataset(None)
+    segments = dataset.split_text("\n".join(paragraphs))
+    new_segments = set(dataset.split_text("\n".join(new_paragraphs)))
+
+    # the edited paragraph, with the blank line before it
+    start = max(sum(len(paragraph) + 1 for paragraph in paragraphs[:edited]) - 1, 0)
+    end = start + len(paragraphs[edited]) + 1
+    offset = 0
+    for segment in segments:
+        if segment not in new_segments:
+            assert start <= offset and offset + len(segment) <= end
+        offset += len(segment)
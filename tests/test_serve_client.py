@@ -0,0 +1,113 @@
+import json
+import socket
+import threading
+
+import pytest
+
+from serve_client import predict_files
+
+
+def fake_server(socket_path, answer):
+    """
+    Serves one connection: reads every request until the client shuts down its
+    side, then writes the response lines answer(requests) gives and closes.
+    """
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1)
+
+    def serve():
+        with listener:
+            connection, _ = listener.accept()
+            with connection:
+                requests = [json.loads(line) for line in connection.makefile("r")]
+                connection.sendall(
+                    "".join(json.dumps(r) + "\n" for r in answer(requests)).encode()
+                )
+
+    server = threading.Thread(target=serve, daemon=True)
+    server.start()
+    return server
+
+
+def answered(request):
+    return {"id": request["id"], "text": request["text"] + " done"}
+
+
+def run_client(socket_path, files):
+    """predict_files() in a thread, failing the test if it hangs; returns its error."""
+    errors = []
+
+    def run():
+        try:
+            predict_files(socket_path, files)
+        except Exception as e:
+            errors.append(e)
+
+    client = threading.Thread(target=run, daemon=True)
+    client.start()
+    client.join(timeout=10)
+    assert not client.is_alive(), "predict_files hangs"
+    return errors[0] if errors else None
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return str(tmp_path / "dnikud.sock")
+
+
+def input_files(tmp_path, texts):
+    files = []
+    for i, text in enumerate(texts):
+        input_file = tmp_path / f"in_{i}.txt"
+        input_file.write_text(text, encoding="utf-8")
+        files.append((str(input_file), str(tmp_path / "out" / f"{i}.txt")))
+    return files
+
+
+def test_out_of_order_answers_go_to_their_files(tmp_path, socket_path):
+    files = input_files(tmp_path, ["אחד", "שניים", "שלושה"])
+    fake_server(socket_path, lambda requests: [answered(r) for r in reversed(requests)])
+    assert run_client(socket_path, files) is None
+    for (_, output_file), text in zip(files, ["אחד", "שניים", "שלושה"]):
+        with open(output_file, encoding="utf-8") as f:
+            assert f.read() == text + " done"
+
+
+@pytest.mark.parametrize(
+    "bad_file, error",
+    [("missing.txt", FileNotFoundError), ("latin1.txt", UnicodeDecodeError)],
+)
+def test_unreadable_file_fails_without_hanging(tmp_path, socket_path, bad_file, error):
+    files = input_files(tmp_path, ["אחד", "שניים"])
+    (tmp_path / "latin1.txt").write_bytes("שלום".encode("cp1255"))
+    files.insert(1, (str(tmp_path / bad_file), str(tmp_path / "out" / "bad.txt")))
+    server = fake_server(socket_path, lambda requests: [answered(r) for r in requests])
+    assert isinstance(run_client(socket_path, files), error)
+    server.join(timeout=10)
+    # what was sent before the unreadable file is still written
+    with open(files[0][1], encoding="utf-8") as f:
+        assert f.read() == "אחד done"
+
+
+def test_server_closing_early_fails(tmp_path, socket_path):
+    files = input_files(tmp_path, ["אחד", "שניים", "שלושה"])
+    fake_server(socket_path, lambda requests: [answered(requests[0])])
+    error = run_client(socket_path, files)
+    assert isinstance(error, RuntimeError)
+    assert "1 of 3" in str(error) and files[1][0] in str(error)
+
+
+def test_unexpected_answer_fails(tmp_path, socket_path):
+    files = input_files(tmp_path, ["אחד", "שניים"])
+    fake_server(socket_path, lambda requests: [answered(requests[0])] * 2)
+    error = run_client(socket_path, files)
+    assert isinstance(error, RuntimeError) and "id 0" in str(error)
+
+
+def test_server_error_names_the_file(tmp_path, socket_path):
+    files = input_files(tmp_path, ["אחד", "שניים"])
+    fake_server(socket_path, lambda requests: [{"id": 1, "error": "boom"}])
+    error = run_client(socket_path, files)
+    assert isinstance(error, RuntimeError)
+    assert files[1][0] in str(error) and "boom" in str(error)
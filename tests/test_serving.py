@@ -0,0 +1,64 @@
+import socket
+
+import pytest
+
+from src.serving import BatchingServer, remove_stale_socket
+
+
+class FailingDiacritizer:
+    """Upper cases every segment, fails on a batch with a segment holding "bad"."""
+
+    def __init__(self):
+        self.batches = []
+
+    def split_text(self, text):
+        return [text]
+
+    def predict_segments(self, segments, keep_marks=False):
+        self.batches.append(list(segments))
+        if any("bad" in segment for segment in segments):
+            raise AssertionError()
+        return [segment.upper() for segment in segments]
+
+
+def test_a_failing_request_does_not_fail_its_batch():
+    diacritizer = FailingDiacritizer()
+    server = BatchingServer(diacritizer, batch_wait=0.5)
+    futures = [
+        server.submit({"id": index, "text": text})
+        for index, text in enumerate(["good", "bad", "fine"])
+    ]
+    responses = [future.result(timeout=10) for future in futures]
+    server.close()
+
+    assert diacritizer.batches[0] == ["good", "bad", "fine"]
+    assert responses[0] == {"id": 0, "text": "GOOD"}
+    assert responses[2] == {"id": 2, "text": "FINE"}
+    assert responses[1]["id"] == 1 and responses[1]["error"]
+
+
+def test_stale_socket_is_removed(tmp_path):
+    path = str(tmp_path / "stale.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stopped:
+        stopped.bind(path)
+    remove_stale_socket(path)
+    assert not (tmp_path / "stale.sock").exists()
+    remove_stale_socket(path)
+
+
+def test_live_socket_is_kept(tmp_path):
+    path = str(tmp_path / "live.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as live:
+        live.bind(path)
+        live.listen()
+        with pytest.raises(RuntimeError, match="already serving"):
+            remove_stale_socket(path)
+    assert (tmp_path / "live.sock").exists()
+
+
+def test_other_file_is_kept(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("keep me")
+    with pytest.raises(FileExistsError):
+        remove_stale_socket(str(path))
+    assert path.read_text() == "keep me"
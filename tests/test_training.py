@@ -0,0 +1,75 @@
+import json
+import logging
+
+import torch
+from torch import nn
+
+from conftest import tiny_model
+from src.models_utils import training
+from src.utiles_data import Nikud
+
+
+def run_training(model, prepared_data, output_path, lr=1e-3, **params):
+    criterion = nn.CrossEntropyLoss(ignore_index=Nikud.PAD_OR_IRRELEVANT)
+    training_params = {"n_epochs": 2, "checkpoints_frequency": 1, **params}
+    return training(
+        model,
+        prepared_data.loader(batch_size=2),
+        prepared_data.loader(batch_size=2),
+        criterion,
+        criterion,
+        criterion,
+        training_params,
+        logging.getLogger("test_training"),
+        str(output_path),
+        torch.optim.Adam(model.parameters(), lr=lr),
+        # the periodic evaluations run on a subsample, the last one on all of it
+        dev_subsample_loader=prepared_data.subset(range(2)).loader(batch_size=2),
+    )
+
+
+def read_records(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_resume_keeps_the_evaluation_counters(config, labeled_dataset, tmp_path):
+    prepared_data = labeled_dataset.prepered_data
+    steps_per_epoch = len(prepared_data.loader(batch_size=2))
+    run_training(tiny_model(config), prepared_data, tmp_path / "run", eval_every_steps=1)
+    resume_state = torch.load(tmp_path / "run" / "latest.pth")["resume_state"]
+    assert resume_state["global_step"] == 2 * steps_per_epoch
+    assert resume_state["num_evaluations"] == 2 * steps_per_epoch
+
+    run_training(
+        tiny_model(config),
+        prepared_data,
+        tmp_path / "resumed",
+        eval_every_steps=1,
+        n_epochs=3,
+        resume_from=str(tmp_path / "run" / "latest.pth"),
+    )
+    resume_state = torch.load(tmp_path / "resumed" / "latest.pth")["resume_state"]
+    assert resume_state["global_step"] == 3 * steps_per_epoch
+    assert resume_state["num_evaluations"] == 3 * steps_per_epoch
+
+
+def test_full_dev_evaluation_is_logged_and_picks_the_best(
+    config, labeled_dataset, tmp_path
+):
+    # trains past the best subsample accuracy, so the best model is evaluated too
+    best_model, best_accuracy, *_ = run_training(
+        tiny_model(config), labeled_dataset.prepered_data, tmp_path, lr=3e-2, n_epochs=8
+    )
+    full_dev = [
+        record
+        for record in read_records(tmp_path / "metrics.jsonl")
+        if record["type"] == "full_dev"
+    ]
+    assert [record["model"] for record in full_dev] == ["final", "best"]
+    assert best_accuracy == max(
+        record["accuracy"]["all_nikud_letter"] for record in full_dev
+    )
+    saved = torch.load(tmp_path / "best_model.pth")
+    for name, value in best_model["model_state_dict"].items():
+        torch.testing.assert_close(saved["model_state_dict"][name], value)